@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Đóng gói kết quả /generate theo định dạng client yêu cầu:
+- json      : {image_base64: data URI ảnh đầu tiên, model, image_count} (tương thích cũ)
+- binary    : bytes thô image/png|image/jpeg của một ảnh (image_index)
+- multipart : multipart/mixed chứa toàn bộ N ảnh, không base64
+- urls      : JSON danh sách URL /images/{sha256} (ảnh lưu trong image cache)
+"""
+from __future__ import annotations
+
+import uuid
+from dataclasses import dataclass, field
+from typing import Iterator, List, Literal, Optional
+
+from fastapi.responses import Response, StreamingResponse
+
+ResponseFormatT = Literal["json", "binary", "multipart", "urls"]
+
+
+@dataclass
+class GenResult:
+    images: List[bytes]
+    mime: str
+    model: str
+    prompt_en: str
+    fallback: bool = False
+    digests: List[str] = field(default_factory=list)
+
+
+def negotiate_format(accept: Optional[str]) -> ResponseFormatT:
+    """Chọn định dạng từ header Accept; mặc định json."""
+    for item in (accept or "").split(","):
+        media = item.split(";", 1)[0].strip().lower()
+        if media in ("image/png", "image/jpeg", "image/*"):
+            return "binary"
+        if media == "multipart/mixed":
+            return "multipart"
+        if media == "application/json":
+            return "json"
+    return "json"
+
+
+def sniff_mime(data: bytes, default: str = "application/octet-stream") -> str:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+
+def binary_response(result: GenResult, index: int = 0, headers: Optional[dict] = None) -> Response:
+    if not 0 <= index < len(result.images):
+        index = 0
+    h = {"X-Image-Count": str(len(result.images)), "X-Image-Index": str(index), "X-Model": result.model}
+    h.update(headers or {})
+    return Response(content=result.images[index], media_type=result.mime, headers=h)
+
+
+def multipart_response(result: GenResult, headers: Optional[dict] = None) -> StreamingResponse:
+    boundary = uuid.uuid4().hex
+    ext = ".jpg" if result.mime == "image/jpeg" else ".png"
+
+    def parts() -> Iterator[bytes]:
+        for i, img in enumerate(result.images):
+            head = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {result.mime}\r\n"
+                f"Content-Length: {len(img)}\r\n"
+                f'Content-Disposition: inline; name="image"; filename="image-{i}{ext}"\r\n'
+                f"\r\n"
+            )
+            yield head.encode("ascii")
+            yield img  # không copy/encode lại bytes ảnh
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode("ascii")
+
+    h = {"X-Image-Count": str(len(result.images)), "X-Model": result.model}
+    h.update(headers or {})
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}", headers=h)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Cache ảnh đã sinh, lưu theo nội dung (content-addressed):
+
+    <root>/objects/ab/abcdef...   (sha256 của bytes ảnh)
+    <root>/index.sqlite3          (khoá yêu cầu -> danh sách digest, thời điểm truy cập)
+
+Khoá yêu cầu = sha256 của các tham số quyết định ảnh đầu ra (prompt EN,
+aspect ratio, mime, person policy, model, số ảnh). Khi tổng dung lượng
+vượt giới hạn, xoá các yêu cầu ít được dùng gần đây nhất (LRU).
+
+Blob trả ra dưới dạng URL (/images/<digest>) được ghim tới hạn `pin_seconds`
+(bảng blob_pins): dọn blob mồ côi bỏ qua blob còn ghim, kể cả khi yêu cầu
+chứa nó đã bị LRU xoá.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+
+def request_key(**params) -> str:
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    def __init__(self, root: str, *, max_bytes: int = 2 * 1024 ** 3,
+                 on_evict: Optional[Callable[[str], None]] = None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict  # gọi với digest của mỗi blob bị xoá (dọn dữ liệu dẫn xuất, vd. rendition)
+        self._objects = self.root / "objects"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, mime TEXT NOT NULL, accessed REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS entry_blobs (
+                key TEXT NOT NULL, idx INTEGER NOT NULL, digest TEXT NOT NULL,
+                PRIMARY KEY (key, idx));
+            CREATE INDEX IF NOT EXISTS entry_blobs_digest ON entry_blobs (digest);
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS blob_pins (
+                digest TEXT PRIMARY KEY, expires REAL NOT NULL);
+            """
+        )
+        self._db.commit()
+
+    # ----- blobs -----
+    def _blob_path(self, digest: str) -> Path:
+        return self._objects / digest[:2] / digest
+
+    def _write_file(self, digest: str, data: bytes) -> None:
+        path = self._blob_path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # tmp riêng cho mỗi lần ghi: nhiều thread cùng ghi một digest không giẫm lên nhau
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{digest[:8]}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def _store_blobs(self, images: List[bytes]) -> List[str]:
+        """
+        Dòng blobs (+ ghi lại file nếu vừa bị xoá). Gọi trong self._lock, cùng khối với bước
+        liên kết/ghim và trước _evict: giữa ghi và liên kết không có lượt dọn mồ côi nào chen vào.
+        """
+        digests = []
+        for data in images:
+            digest = hashlib.sha256(data).hexdigest()
+            # Lượt dọn mồ côi của thread khác có thể vừa xoá file -> kiểm tra lại trong lock
+            if not self._blob_path(digest).exists():
+                self._write_file(digest, data)
+            self._db.execute("INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)", (digest, len(data)))
+            digests.append(digest)
+        return digests
+
+    def put_blob(self, data: bytes, pin_seconds: float = 0) -> str:
+        """Lưu blob; pin_seconds > 0 -> giữ blob ít nhất chừng đó giây dù không thuộc yêu cầu nào."""
+        digest = hashlib.sha256(data).hexdigest()
+        if not self._blob_path(digest).exists():
+            self._write_file(digest, data)  # phần chậm làm ngoài lock
+        with self._lock:
+            self._store_blobs([data])
+            if pin_seconds > 0:
+                # Ghim lại thì kéo dài hạn, không bao giờ rút ngắn
+                self._db.execute(
+                    "INSERT INTO blob_pins (digest, expires) VALUES (?, ?) "
+                    "ON CONFLICT(digest) DO UPDATE SET expires = MAX(expires, excluded.expires)",
+                    (digest, time.time() + pin_seconds),
+                )
+            self._db.commit()
+            self._evict()
+        return digest
+
+    def get_blob(self, digest: str) -> Optional[bytes]:
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            return None
+        try:
+            return self._blob_path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    # ----- entries -----
+    def get(self, key: str) -> Optional[List[bytes]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT digest FROM entry_blobs WHERE key = ? ORDER BY idx", (key,)
+            ).fetchall()
+            if rows:
+                self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+        images = [self.get_blob(d) for (d,) in rows]
+        if not rows or any(img is None for img in images):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return images  # type: ignore[return-value]
+
+    def put(self, key: str, images: List[bytes], mime: str) -> List[str]:
+        for img in images:
+            digest = hashlib.sha256(img).hexdigest()
+            if not self._blob_path(digest).exists():
+                self._write_file(digest, img)  # phần chậm làm ngoài lock
+        with self._lock:
+            digests = self._store_blobs(images)
+            self._db.execute("DELETE FROM entry_blobs WHERE key = ?", (key,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, mime, accessed) VALUES (?, ?, ?)",
+                (key, mime, time.time()),
+            )
+            self._db.executemany(
+                "INSERT INTO entry_blobs (key, idx, digest) VALUES (?, ?, ?)",
+                [(key, i, d) for i, d in enumerate(digests)],
+            )
+            self._db.commit()
+            self._evict()
+        return digests
+
+    def _total_bytes(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _drop_orphans(self) -> int:
+        """Xoá blob không thuộc yêu cầu nào và không còn ghim; trả số byte giải phóng."""
+        freed = 0
+        orphans = self._db.execute(
+            "SELECT digest, size FROM blobs WHERE digest NOT IN (SELECT digest FROM entry_blobs)"
+            " AND digest NOT IN (SELECT digest FROM blob_pins)"
+        ).fetchall()
+        for digest, size in orphans:
+            self._blob_path(digest).unlink(missing_ok=True)
+            self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            freed += size
+            if self.on_evict is not None:
+                self.on_evict(digest)
+        return freed
+
+    def _evict(self) -> None:
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        # Blob URL hết hạn ghim đi trước, rồi mới tới yêu cầu LRU
+        self._db.execute("DELETE FROM blob_pins WHERE expires <= ?", (time.time(),))
+        total -= self._drop_orphans()
+        if total > self.max_bytes:
+            for (key,) in self._db.execute("SELECT key FROM entries ORDER BY accessed").fetchall():
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._db.execute("DELETE FROM entry_blobs WHERE key = ?", (key,))
+                total -= self._drop_orphans()
+                if total <= self.max_bytes:
+                    break
+        self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            pinned = self._db.execute("SELECT COUNT(*) FROM blob_pins WHERE expires > ?", (time.time(),)).fetchone()[0]
+            total = self._total_bytes()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "pinned_blobs": pinned,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Hàng đợi job bất đồng bộ cho /generate.
+
+- JobQueue giữ một asyncio.Queue có giới hạn và N worker coroutine.
+- Mỗi Job có stage/percent để /progress/{job_id} báo tiến độ thật,
+  và có thể bị huỷ qua /interrupt/{job_id}.
+- Job.subscribe() trả về hàng đợi nhận snapshot mỗi lần đổi trạng thái (cho SSE /events/{job_id}).
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+# stage -> percent mặc định khi chuyển stage
+STAGES = {
+    "queued": 0.0,
+    "translating": 10.0,
+    "generating": 40.0,
+    "encoding": 90.0,
+    "done": 100.0,
+}
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """Job đã bị huỷ qua /interrupt."""
+
+
+class QueueFull(Exception):
+    """Hàng đợi job đã đầy."""
+
+
+@dataclass
+class Job:
+    id: str
+    payload: Any
+    status: str = "queued"          # queued | running | done | failed | cancelled
+    stage: str = "queued"
+    percent: float = 0.0
+    result: Any = None
+    error: Optional[str] = None
+    exception: Optional[BaseException] = field(default=None, repr=False)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    # stage -> số giây (header Server-Timing); "queue" = thời gian chờ worker
+    timings: dict = field(default_factory=dict, repr=False)
+    _done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+    _cancelled: bool = field(default=False, repr=False)
+    _task: Optional[asyncio.Task] = field(default=None, repr=False)
+    _listeners: list = field(default_factory=list, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINAL_STATUSES
+
+    def set_stage(self, stage: str, percent: Optional[float] = None) -> None:
+        self.check_cancelled()
+        self.stage = stage
+        self.percent = STAGES.get(stage, self.percent) if percent is None else percent
+        self.updated_at = time.time()
+        self._notify()
+
+    def check_cancelled(self) -> None:
+        if self._cancelled:
+            raise JobCancelled(self.id)
+
+    def _finish(
+        self,
+        status: str,
+        *,
+        result: Any = None,
+        error: Optional[str] = None,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        self.status = status
+        self.result = result
+        self.error = error
+        self.exception = exception
+        if status == "done":
+            self.stage, self.percent = "done", 100.0
+        self.updated_at = time.time()
+        self._done.set()
+        self._notify()
+
+    def subscribe(self) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue()
+        self._listeners.append(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue) -> None:
+        if q in self._listeners:
+            self._listeners.remove(q)
+
+    def _notify(self) -> None:
+        if self._listeners:
+            snap = self.snapshot()
+            for q in self._listeners:
+                q.put_nowait(snap)
+
+    async def wait(self) -> Any:
+        await self._done.wait()
+        return self.result
+
+    def snapshot(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "percent": self.percent,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class JobQueue:
+    """
+    Hàng đợi có giới hạn + worker pool cố định.
+    runner(job) là coroutine thực hiện công việc và trả về kết quả.
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[Job], Awaitable[Any]],
+        *,
+        workers: int = 4,
+        maxsize: int = 64,
+        ttl_seconds: float = 600.0,
+    ):
+        self._runner = runner
+        self._workers_n = max(1, workers)
+        self._maxsize = max(1, maxsize)
+        self._ttl = ttl_seconds
+        self._queue: Optional[asyncio.Queue[Job]] = None
+        self._workers: list[asyncio.Task] = []
+        self._jobs: dict[str, Job] = {}
+        self._running = 0
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_n)]
+
+    async def stop(self) -> None:
+        for job in list(self._jobs.values()):
+            self.cancel(job.id)
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, payload: Any) -> Job:
+        if self._queue is None:
+            raise RuntimeError("job_queue_not_started")
+        self._prune()
+        job = Job(id=uuid.uuid4().hex, payload=payload)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull() from None
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job._cancelled = True
+        if job._task is not None:
+            job._task.cancel()
+        else:
+            # còn trong hàng đợi: worker sẽ bỏ qua khi lấy ra
+            job._finish("cancelled", error="cancelled")
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": self._running,
+            "workers": self._workers_n,
+            "capacity": self._maxsize,
+            "tracked_jobs": len(self._jobs),
+        }
+
+    def _prune(self) -> None:
+        now = time.time()
+        expired = [jid for jid, j in self._jobs.items() if j.finished and now - j.updated_at > self._ttl]
+        for jid in expired:
+            del self._jobs[jid]
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.finished:
+                    continue
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.updated_at = time.time()
+        job.timings["queue"] = job.updated_at - job.created_at
+        job._notify()
+        self._running += 1
+        job._task = asyncio.create_task(self._runner(job))
+        try:
+            await asyncio.wait({job._task})
+        finally:
+            self._running -= 1
+        task = job._task
+        if task.cancelled() or job._cancelled:
+            job._finish("cancelled", error="cancelled")
+            return
+        exc = task.exception()
+        if isinstance(exc, JobCancelled):
+            job._finish("cancelled", error="cancelled")
+        elif exc is not None:
+            job._finish("failed", error=str(getattr(exc, "detail", None) or exc), exception=exc)
+        else:
+            job._finish("done", result=task.result())
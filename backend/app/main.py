@@ -3,32 +3,90 @@
 FastAPI backend — VNHis2Image
 1) /ner        : trích xuất spans bằng spaCy spancat_v5
 2) /generate   : dịch VI->EN bằng Gemini rồi gọi Imagen 3 sinh ảnh
-3) /progress   : stub tiến độ cho UI
-4) /health, /  : kiểm tra tình trạng dịch vụ
+                 (chạy qua hàng đợi job; background=true trả job_id ngay)
+3) /progress   : tiến độ job (/progress/{job_id}, SSE /events/{job_id}), /interrupt/{job_id} để huỷ
+4) /health, /  : kiểm tra tình trạng dịch vụ (liveness); /ready: đã nạp xong model/client chưa
+5) /pipeline   : văn bản -> NER -> fields -> prompt theo template -> ảnh, trong một request
+6) /images/{sha256}/{rendition}: bản thumb/web (WebP) sinh theo yêu cầu trong pool tiến trình, có cache
+7) /metrics    : Prometheus (cần prometheus_client); /generate trả kèm header Server-Timing
+
+SERVICE_MODE=all|ner|generate cho phép chạy replica chỉ NER hoặc chỉ sinh ảnh.
+GEN_PROVIDER=google|stub chọn provider mặc định; request có thể gợi ý provider=auto|local|cloud.
+spaCy/google-genai/PIL được import lười; model nạp nền sau khi app đã nhận kết nối.
 """
 from __future__ import annotations
 
 import os
+import json
 import base64
+import asyncio
+import functools
+import logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from contextlib import asynccontextmanager
 from typing import Optional, Literal, List
-from collections import defaultdict
 
-import spacy
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 from dotenv import load_dotenv, find_dotenv
-from google import genai
-from google.genai import types
+
+from .jobs import Job, JobQueue, JobCancelled, QueueFull
+from .translate_cache import TranslationCache, cache_key as translation_key
+from .image_cache import ImageCache, request_key
+from .ner import MicroBatcher, doc_to_result
+from .ner_pool import NERProcessPool
+from .singleflight import SingleFlight
+from .providers import GenerationProvider, GoogleProvider, StubProvider
+from .resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    TokenBucket,
+    UpstreamPolicy,
+    classify_error,
+)
+from . import metrics
+from .metrics import observe, server_timing
+from src.main.prompts.batch_render_prompts import TEMPLATES, missing_fields, render
+from src.main.structured.jsonl_to_fields import line_to_fields
+from src.main.postprocess.renditions import Rendition, RenditionStore, make_rendition, parse_renditions
+from .encoding import (
+    GenResult,
+    ResponseFormatT,
+    binary_response,
+    multipart_response,
+    negotiate_format,
+    sniff_mime,
+)
 
 load_dotenv(find_dotenv(), override=True)
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env"), override=True)
 
+# Log theo mức: LOG_LEVEL=DEBUG để xem prompt/response chi tiết (mặc định INFO)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("vnhis2image")
+logger.setLevel(LOG_LEVEL)
 
 AspectRatioT = Literal["1:1", "3:4", "4:3", "9:16", "16:9"]
 PeopleT = Literal["dont_allow", "allow_adult", "allow_all"]
 
+# all | ner | generate
+SERVICE_MODE = os.getenv("SERVICE_MODE", "all").strip().lower()
+ENABLE_NER = SERVICE_MODE in ("all", "ner")
+ENABLE_GENERATE = SERVICE_MODE in ("all", "generate")
+
+# google: Gemini + Imagen; stub: offline, ảnh tất định (benchmark/CI)
+GEN_PROVIDER = os.getenv("GEN_PROVIDER", "google").strip().lower()
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "0"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "0"))
+STUB_FAILURE_RATE = float(os.getenv("STUB_FAILURE_RATE", "0"))
+STUB_SEED = os.getenv("STUB_SEED")
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 IMAGEN_MODEL = os.getenv("IMAGEN_MODEL", "imagen-3.0-generate-002")
 
@@ -47,24 +105,271 @@ ALLOWED_HEADERS = os.getenv("ALLOWED_HEADERS", "*")
 MODEL_PATH = os.getenv("MODEL_PATH", "models/spancat_v5/model-best")
 SPANS_KEY = os.getenv("SPANS_KEY", "sc")
 ACCEPTANCE_THRESHOLD = float(os.getenv("ACCEPTANCE_THRESHOLD", "0.5"))
+# Micro-batching cho /ner: gom tối đa NER_BATCH_SIZE câu hoặc chờ tối đa NER_MAX_WAIT_MS
+NER_BATCH_SIZE = int(os.getenv("NER_BATCH_SIZE", "32"))
+NER_MAX_WAIT_MS = float(os.getenv("NER_MAX_WAIT_MS", "5"))
+NER_BATCH_MAX_TEXTS = int(os.getenv("NER_BATCH_MAX_TEXTS", "1000"))
+# NER_WORKERS > 0: chạy NER trong pool tiến trình (mỗi worker giữ một bản model)
+NER_WORKERS = int(os.getenv("NER_WORKERS", "0"))
+NER_HEALTH_INTERVAL = float(os.getenv("NER_HEALTH_INTERVAL", "30"))
+NER_HEALTH_TIMEOUT = float(os.getenv("NER_HEALTH_TIMEOUT", "10"))
+
+# Gọi upstream (Gemini/Imagen) bất đồng bộ: giới hạn số call đồng thời + tái sử dụng kết nối
+TRANSLATE_CONCURRENCY = int(os.getenv("TRANSLATE_CONCURRENCY", "8"))
+IMAGEN_CONCURRENCY = int(os.getenv("IMAGEN_CONCURRENCY", "4"))
+UPSTREAM_TIMEOUT_S = float(os.getenv("UPSTREAM_TIMEOUT_S", "120"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "64"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "32"))
+UPSTREAM_KEEPALIVE_EXPIRY_S = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY_S", "60"))
+# Retry (429/5xx/timeout, backoff mũ + jitter), giới hạn tốc độ theo quota (0 = không giới hạn)
+# và circuit breaker: UPSTREAM_BREAKER_THRESHOLD lỗi liên tiếp -> fail-fast UPSTREAM_BREAKER_RESET_S giây
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "4"))
+UPSTREAM_BACKOFF_BASE_S = float(os.getenv("UPSTREAM_BACKOFF_BASE_S", "1"))
+UPSTREAM_BACKOFF_MAX_S = float(os.getenv("UPSTREAM_BACKOFF_MAX_S", "30"))
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5"))
+UPSTREAM_BREAKER_RESET_S = float(os.getenv("UPSTREAM_BREAKER_RESET_S", "30"))
+IMAGEN_RATE_PER_MIN = float(os.getenv("IMAGEN_RATE_PER_MIN", "0"))
+TRANSLATE_RATE_PER_MIN = float(os.getenv("TRANSLATE_RATE_PER_MIN", "0"))
+# Khi mạch Imagen đang mở: 1 = trả ảnh placeholder, 0 = trả 503 ngay
+IMAGEN_FALLBACK_ON_OPEN = os.getenv("IMAGEN_FALLBACK_ON_OPEN", "1") == "1"
+
+# Job queue cho /generate
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "64"))
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "600"))
+# SSE /events/{job_id}: gửi comment keep-alive sau mỗi SSE_HEARTBEAT_S giây không có sự kiện
+SSE_HEARTBEAT_S = float(os.getenv("SSE_HEARTBEAT_S", "15"))
+
+# Cache bản dịch (LRU trong RAM + SQLite trên đĩa). TRANSLATE_CACHE_DB="" để tắt tầng đĩa.
+TRANSLATE_CACHE_SIZE = int(os.getenv("TRANSLATE_CACHE_SIZE", "1024"))
+TRANSLATE_CACHE_DB = os.getenv("TRANSLATE_CACHE_DB", "runs/cache/translate.sqlite3")
+TRANSLATE_CACHE_TTL = float(os.getenv("TRANSLATE_CACHE_TTL", str(7 * 86400)))
+
+# Cache ảnh đã sinh (opt-in): đặt IMAGE_CACHE_DIR để bật
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+# Ảnh trả qua response_format=urls được giữ ít nhất chừng này (URL đã phát ra không 404 sớm)
+IMAGE_URL_TTL = float(os.getenv("IMAGE_URL_TTL", str(7 * 24 * 3600)))
+# Rendition (thumb/web/archive/avif) cho ảnh trong cache, tạo lười trong pool tiến trình
+IMAGE_RENDITIONS = os.getenv("IMAGE_RENDITIONS", "thumb,web")
+IMAGE_RENDITION_MAX_MB = int(os.getenv("IMAGE_RENDITION_MAX_MB", "512"))
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "2"))
 
 # ----- Guards & clients -----
-print(f"GOOGLE_API_KEY loaded: {'Yes' if GOOGLE_API_KEY else 'No'}")
-if not GOOGLE_API_KEY:
-    print("!!! CẢNH BÁO: GOOGLE_API_KEY chưa được thiết lập. Ứng dụng sẽ thất bại.")
-    raise RuntimeError("GOOGLE_API_KEY is missing. Put it in .env or export it before running.")
+logger.info(
+    "SERVICE_MODE=%s GEN_PROVIDER=%s GOOGLE_API_KEY loaded=%s",
+    SERVICE_MODE, GEN_PROVIDER, "yes" if GOOGLE_API_KEY else "no",
+)
+if ENABLE_GENERATE and GEN_PROVIDER == "google" and not GOOGLE_API_KEY:
+    logger.warning("GOOGLE_API_KEY chưa được thiết lập. /generate sẽ trả 503.")
 
-client = genai.Client(api_key=GOOGLE_API_KEY)
+# Trạng thái từng năng lực: disabled | loading | ready | failed
+capability_state = {
+    "ner": "loading" if ENABLE_NER else "disabled",
+    "generate": "loading" if ENABLE_GENERATE else "disabled",
+}
+capability_error: dict[str, str] = {}
 
+google_provider = GoogleProvider(
+    GOOGLE_API_KEY,
+    translate_model=TRANSLATE_MODEL,
+    image_model=IMAGEN_MODEL,
+    timeout_s=UPSTREAM_TIMEOUT_S,
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+    keepalive_expiry_s=UPSTREAM_KEEPALIVE_EXPIRY_S,
+)
+stub_provider = StubProvider(
+    latency_ms=STUB_LATENCY_MS,
+    jitter_ms=STUB_JITTER_MS,
+    failure_rate=STUB_FAILURE_RATE,
+    seed=int(STUB_SEED) if STUB_SEED else None,
+)
+providers: dict[str, GenerationProvider] = {"google": google_provider, "stub": stub_provider}
+if GEN_PROVIDER not in providers:
+    raise RuntimeError(f"GEN_PROVIDER không hợp lệ: {GEN_PROVIDER} (google|stub)")
+default_provider = providers[GEN_PROVIDER]
+# Trạng thái từng provider: request chọn provider nào thì chỉ cần provider đó sẵn sàng
+provider_state = {name: capability_state["generate"] for name in providers}
+provider_error: dict[str, str] = {}
+
+def _provider_for(hint: str) -> GenerationProvider:
+    """auto -> GEN_PROVIDER; local -> stub; cloud -> google (503 nếu chưa cấu hình)."""
+    if hint == "local":
+        return stub_provider
+    if hint == "cloud":
+        if not GOOGLE_API_KEY:
+            raise HTTPException(status_code=503, detail="cloud_provider_not_configured")
+        return google_provider
+    return default_provider
+
+translate_sem = asyncio.Semaphore(max(1, TRANSLATE_CONCURRENCY))
+imagen_sem = asyncio.Semaphore(max(1, IMAGEN_CONCURRENCY))
+
+def _upstream_policy(name: str, rate_per_min: float) -> UpstreamPolicy:
+    return UpstreamPolicy(
+        name,
+        retry=RetryPolicy(
+            max_attempts=UPSTREAM_MAX_ATTEMPTS,
+            base_delay=UPSTREAM_BACKOFF_BASE_S,
+            max_delay=UPSTREAM_BACKOFF_MAX_S,
+        ),
+        breaker=CircuitBreaker(
+            name,
+            failure_threshold=UPSTREAM_BREAKER_THRESHOLD,
+            reset_timeout=UPSTREAM_BREAKER_RESET_S,
+        ),
+        bucket=TokenBucket(rate_per_min / 60.0) if rate_per_min > 0 else None,
+    )
+
+# Mỗi provider có breaker/rate limit riêng: stub lỗi không làm mở mạch của google
+translate_policies = {name: _upstream_policy(f"{name}:translate", TRANSLATE_RATE_PER_MIN) for name in providers}
+imagen_policies = {name: _upstream_policy(f"{name}:imagen", IMAGEN_RATE_PER_MIN) for name in providers}
+
+translate_cache = TranslationCache(
+    max_items=TRANSLATE_CACHE_SIZE,
+    db_path=TRANSLATE_CACHE_DB or None,
+    ttl_seconds=TRANSLATE_CACHE_TTL,
+)
+
+# Kiểm tra IMAGE_RENDITIONS lúc khởi động (vd. avif khi Pillow không hỗ trợ) thay vì 500 lúc request
 try:
-    nlp = spacy.load(MODEL_PATH)
-    print(f"[OK] Đã tải mô hình spaCy tại: {MODEL_PATH}")
-except Exception as e:
-    nlp = None
-    print(f"[LỖI] Không thể tải mô hình spaCy tại {MODEL_PATH}: {e}")
+    RENDITIONS: dict[str, Rendition] = {r.name: r for r in parse_renditions(IMAGE_RENDITIONS)}
+except ValueError as e:
+    raise RuntimeError(f"IMAGE_RENDITIONS không hợp lệ: {e}") from e
+
+rendition_store = (
+    RenditionStore(Path(IMAGE_CACHE_DIR) / "renditions", max_bytes=IMAGE_RENDITION_MAX_MB * 1024 * 1024)
+    if IMAGE_CACHE_DIR else None
+)
+# Ảnh gốc bị xoá khỏi cache -> xoá luôn các rendition của nó
+image_cache = ImageCache(
+    IMAGE_CACHE_DIR,
+    max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024,
+    on_evict=rendition_store.remove,
+) if IMAGE_CACHE_DIR else None
+postprocess_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_postprocess_pool() -> ProcessPoolExecutor:
+    # spawn: không fork tiến trình đang giữ model spaCy + thread của asyncio
+    global postprocess_pool
+    if postprocess_pool is None:
+        postprocess_pool = ProcessPoolExecutor(
+            max_workers=max(1, POSTPROCESS_WORKERS), mp_context=mp.get_context("spawn")
+        )
+    return postprocess_pool
+
+# Gộp các lời gọi giống hệt đang chạy đồng thời (dịch / sinh ảnh / rendition) thành một lần chạy
+translate_flight = SingleFlight()
+imagen_flight = SingleFlight()
+rendition_flight = SingleFlight()
+
+nlp = None
+
+def _load_ner_model():
+    """Nạp spaCy + chạy warm-up một lượt để lần gọi đầu không chậm."""
+    import spacy
+
+    model = spacy.load(MODEL_PATH)
+    list(model.pipe(["Trận Bạch Đằng năm 938 do Ngô Quyền chỉ huy."]))
+    return model
+
+def _start_ner_pool():
+    """
+    NER_WORKERS > 0: nạp model + fork pool ngay trên main thread, trước khi có thread nào khác
+    (fork tiến trình nhiều thread có thể làm worker kẹt ở lock kế thừa). Chặn startup tới khi xong.
+    """
+    global nlp
+    try:
+        nlp = _load_ner_model()
+        logger.info("Đã tải mô hình spaCy model_path=%s", MODEL_PATH)
+        ner_pool.start(nlp)
+        capability_state["ner"] = "ready"
+    except Exception as e:
+        capability_state["ner"] = "failed"
+        capability_error["ner"] = str(e)
+        logger.error("Không thể tải mô hình spaCy model_path=%s: %s", MODEL_PATH, e)
+
+async def _start_ner():
+    global nlp
+    if ner_pool is not None:
+        # pool đã dựng trong lifespan (_start_ner_pool)
+        if capability_state["ner"] == "ready":
+            await ner_pool.start_health_checks()
+        return
+    try:
+        nlp = await asyncio.to_thread(_load_ner_model)
+        logger.info("Đã tải mô hình spaCy model_path=%s", MODEL_PATH)
+        capability_state["ner"] = "ready"
+    except Exception as e:
+        capability_state["ner"] = "failed"
+        capability_error["ner"] = str(e)
+        logger.error("Không thể tải mô hình spaCy model_path=%s: %s", MODEL_PATH, e)
+
+async def _warm_up_provider(provider: GenerationProvider):
+    try:
+        await asyncio.to_thread(provider.warm_up)
+        provider_state[provider.name] = "ready"
+    except Exception as e:
+        provider_state[provider.name] = "failed"
+        provider_error[provider.name] = str(e)
+        log = logger.error if provider is default_provider else logger.info
+        log("Không thể khởi tạo provider %s: %s", provider.name, e)
+
+async def _start_generate():
+    await asyncio.gather(*(_warm_up_provider(p) for p in providers.values()))
+    # /ready theo provider mặc định (request provider=auto)
+    capability_state["generate"] = provider_state[default_provider.name]
+    if default_provider.name in provider_error:
+        capability_error["generate"] = provider_error[default_provider.name]
+
+async def _warm_up():
+    steps = []
+    if ENABLE_NER:
+        steps.append(_start_ner())
+    if ENABLE_GENERATE:
+        steps.append(_start_generate())
+    await asyncio.gather(*steps)
+
+def _check_state(capability: str, state: str, error: str) -> None:
+    if state == "ready":
+        return
+    if state == "disabled":
+        raise HTTPException(status_code=404, detail=f"{capability}_disabled (SERVICE_MODE={SERVICE_MODE})")
+    if state == "loading":
+        raise HTTPException(status_code=503, detail=f"{capability}_loading")
+    raise HTTPException(status_code=503, detail=f"{capability}_unavailable: {error}")
+
+def _require(capability: str) -> None:
+    if capability == "generate":
+        # generate chỉ cần được bật; provider cụ thể được kiểm tra theo request (_require_provider)
+        if capability_state["generate"] == "disabled":
+            _check_state("generate", "disabled", "")
+        return
+    _check_state(capability, capability_state[capability], capability_error.get(capability, ""))
+
+def _require_provider(provider: GenerationProvider) -> None:
+    _check_state("generate", provider_state[provider.name], f"{provider.name}: {provider_error.get(provider.name, '')}")
 
 # ----- FastAPI app -----
-app = FastAPI(title="VNHis2Image API", version="0.2.0")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if ner_pool is not None:
+        _start_ner_pool()  # trước mọi thread (to_thread, warm-up provider)
+    await job_queue.start()
+    await ner_batcher.start()
+    warm_up = asyncio.create_task(_warm_up())
+    yield
+    warm_up.cancel()
+    await asyncio.gather(warm_up, return_exceptions=True)
+    await ner_batcher.stop()
+    await job_queue.stop()
+    if ner_pool is not None:
+        await ner_pool.stop()
+    if postprocess_pool is not None:
+        postprocess_pool.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(title="VNHis2Image API", version="0.2.0", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[o.strip() for o in ALLOWED_ORIGINS.split(",")] if ALLOWED_ORIGINS else ["*"],
@@ -78,18 +383,69 @@ AspectRatioT = Literal["1:1", "3:4", "4:3", "9:16", "16:9"]
 SampleSizeT = Literal["1K", "2K"]
 PeopleT = Literal["dont_allow", "allow_adult", "allow_all"]
 
-class GenReq(BaseModel):
-    prompt: str = Field(..., description="Prompt tiếng Việt hoặc prompt từ form.")
+class GenOptions(BaseModel):
+    """Tham số sinh ảnh dùng chung cho /generate và /pipeline."""
     aspect_ratio: Optional[AspectRatioT] = None # pyright: ignore[reportInvalidTypeForm]
     number_of_images: int = Field(DEFAULT_NUM_IMAGES, ge=1, le=4)
     mime_type: Literal["image/png", "image/jpeg"] = Field(DEFAULT_MIME)
     allow_people: PeopleT = Field(ALLOW_PEOPLE) # pyright: ignore[reportInvalidTypeForm]
     width: Optional[int] = None
     height: Optional[int] = None
+    background: bool = Field(False, description="True: trả job_id ngay, theo dõi qua /progress/{job_id}.")
+    image_cache: Literal["reuse", "refresh", "off"] = Field(
+        "reuse", description="reuse: dùng ảnh đã cache nếu có; refresh: luôn sinh mới rồi ghi đè cache; off: bỏ qua cache."
+    )
+    response_format: Optional[ResponseFormatT] = Field(
+        None, description="json | binary | multipart | urls. Bỏ trống: suy ra từ header Accept."
+    )
+    image_index: int = Field(0, ge=0, le=3, description="Ảnh trả về khi response_format=binary.")
+    provider: Literal["auto", "local", "cloud"] = Field(
+        "auto", description="auto: GEN_PROVIDER của server; local: stub offline; cloud: Gemini/Imagen."
+    )
+
+class GenReq(GenOptions):
+    prompt: str = Field(..., description="Prompt tiếng Việt hoặc prompt từ form.")
 
 class GenOut(BaseModel):
     image_base64: str
     model: str
+    image_count: int = 1
+
+class ImageRef(BaseModel):
+    url: str
+    sha256: str
+    mime: str
+    size: int
+    renditions: dict[str, str] = Field(default_factory=dict, description="Tên rendition -> URL (tạo khi được gọi lần đầu).")
+
+class GenUrlsOut(BaseModel):
+    model: str
+    images: List[ImageRef]
+
+class JobOut(BaseModel):
+    job_id: str
+    status: str
+    stage: str
+    percent: float
+    error: Optional[str] = None
+    result: Optional[GenOut | GenUrlsOut] = None
+    result_url: Optional[str] = None
+
+class PipelineReq(GenOptions):
+    text: str = Field(..., description="Văn bản lịch sử thô (tiếng Việt).")
+    style: str = Field(..., description="Khoá template trong prompt_templates.json (portrait, battle, ...).")
+    extra: str = Field("", description="Ghi chú thêm vào cuối prompt.")
+    fields: dict[str, str] = Field(default_factory=dict, description="Ghi đè/bổ sung field trích xuất từ NER.")
+    include_intermediate: bool = Field(False, description="True: trả kèm labels NER và fields.")
+    render_only: bool = Field(False, description="True: dừng sau khi dựng prompt, không sinh ảnh.")
+
+class PipelineOut(BaseModel):
+    prompt: str
+    style: str
+    labels: Optional[List[list]] = None
+    fields: Optional[dict[str, str]] = None
+    result: Optional[GenOut | GenUrlsOut] = None
+    job: Optional[JobOut] = None
 
 class NERReq(BaseModel):
     text: str
@@ -108,6 +464,12 @@ class NerCompatOut(BaseModel):
     fields: dict[str, str]
     scores: dict[str, float | None]
 
+class NERBatchReq(BaseModel):
+    texts: List[str] = Field(..., max_length=NER_BATCH_MAX_TEXTS)
+
+class NERBatchOut(BaseModel):
+    results: List[NerCompatOut]
+
 # ----- Helpers -----
 def _guess_aspect_ratio(width: Optional[int], height: Optional[int]) -> AspectRatioT: # pyright: ignore[reportInvalidTypeForm]
     if not width or not height or width <= 0 or height <= 0:
@@ -120,15 +482,39 @@ def _to_data_uri(image_bytes: bytes, mime: str) -> str:
     return f"data:{mime};base64,{base64.b64encode(image_bytes).decode('ascii')}"
 
 
-def _translate_vi_to_en(vietnamese_prompt: str) -> str:
+async def _translate_vi_to_en(vietnamese_prompt: str, provider: GenerationProvider) -> str:
     """
-    Dịch prompt từ tiếng Việt sang tiếng Anh, tối ưu cho image generation
+    Dịch prompt từ tiếng Việt sang tiếng Anh, có cache theo prompt chuẩn hoá + model dịch của provider
     """
     if not vietnamese_prompt or not vietnamese_prompt.strip():
         raise ValueError("empty_prompt")
-    
-    print(f"[DEBUG] Bắt đầu dịch prompt: '{vietnamese_prompt}'")
-    
+
+    model = provider.translate_model
+    cached = await asyncio.to_thread(translate_cache.get, vietnamese_prompt, model)
+    if cached is not None:
+        metrics.CACHE_EVENTS.labels(cache="translate", result="hit").inc()
+        logger.debug("Dùng bản dịch đã lưu: %r", cached)
+        return cached
+    metrics.CACHE_EVENTS.labels(cache="translate", result="miss").inc()
+
+    async def _translate_and_store() -> str:
+        translated = await _translate_uncached(vietnamese_prompt, provider)
+        # Khi lỗi, hàm dịch trả lại prompt gốc -> không lưu vào cache
+        if translated != vietnamese_prompt:
+            await asyncio.to_thread(translate_cache.put, vietnamese_prompt, model, translated)
+        return translated
+
+    # Cùng khoá với cache: prompt chuẩn hoá + model dịch
+    return await translate_flight.do(
+        translation_key(vietnamese_prompt, model), _translate_and_store
+    )
+
+async def _translate_uncached(vietnamese_prompt: str, provider: GenerationProvider) -> str:
+    """
+    Dịch prompt từ tiếng Việt sang tiếng Anh, tối ưu cho image generation
+    """
+    logger.debug("Bắt đầu dịch prompt: %r", vietnamese_prompt)
+
     try:
         translation_prompt = f"""Translate the following Vietnamese text to English for AI image generation. 
             Keep the translation concise, clear, and suitable for image generation (under 200 words).
@@ -139,32 +525,12 @@ def _translate_vi_to_en(vietnamese_prompt: str) -> str:
 
             English translation:"""
         
-        response = client.models.generate_content(
-            model=TRANSLATE_MODEL,
-            contents=translation_prompt
-        )
-        
-        print(f"[DEBUG] Response nhận được:")
-        print(f"  - Candidates: {len(response.candidates) if response.candidates else 0}")
-        
-        if not response.candidates:
-            print("[LỖI DỊCH] Không có candidates")
-            raise RuntimeError("translation_failed_no_candidates")
-        
-        candidate = response.candidates[0]
-        text = ""
-        
-        if hasattr(candidate, 'content') and candidate.content:
-            if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                part = candidate.content.parts[0]
-                if hasattr(part, 'text'):
-                    text = part.text
-                else:
-                    text = str(part)
-            else:
-                text = str(candidate.content)
-        else:
-            text = str(candidate)
+        async def _call():
+            async with translate_sem:
+                return await provider.translate(translation_prompt)
+
+        with observe(metrics.TRANSLATE_SECONDS, provider=provider.name):
+            text = await translate_policies[provider.name].call(_call)
         
         text = text.strip()
         
@@ -197,10 +563,10 @@ def _translate_vi_to_en(vietnamese_prompt: str) -> str:
         
         clean_text = ' '.join(cleaned_lines)
         
-        print(f"[DEBUG] Text sau xử lý: '{clean_text}'")
+        logger.debug("Text sau xử lý: %r", clean_text)
         
         if not clean_text or len(clean_text.strip()) < 10:
-            print("[LỖI DỊCH] Text quá ngắn hoặc không hợp lệ, sử dụng prompt gốc")
+            logger.warning("Bản dịch quá ngắn hoặc không hợp lệ, dùng prompt gốc")
             return vietnamese_prompt
         
         if len(clean_text) > 500:
@@ -209,92 +575,47 @@ def _translate_vi_to_en(vietnamese_prompt: str) -> str:
             if not clean_text.endswith('.'):
                 clean_text += '.'
             
-        print(f"[SUCCESS] Dịch thành công: '{clean_text}'")
+        logger.debug("Dịch thành công: %r", clean_text)
         return clean_text
         
     except Exception as e:
-        print(f"[LỖI DỊCH] Exception: {type(e).__name__}: {e}")
-        print(f"[FALLBACK] Sử dụng prompt gốc: '{vietnamese_prompt}'")
+        kind = classify_error(e)
+        metrics.ERRORS.labels(stage="translate", kind=kind).inc()
+        logger.warning("Lỗi dịch kind=%s %s: %s; dùng prompt gốc", kind, type(e).__name__, e)
         return vietnamese_prompt
 
-def _generate_with_imagen(
+async def _generate_with_imagen(
     prompt_en: str,
     *,
+    provider: GenerationProvider,
     aspect_ratio: AspectRatioT, # pyright: ignore[reportInvalidTypeForm]
     number_of_images: int,
     mime_type: str,
     allow_people: PeopleT, # pyright: ignore[reportInvalidTypeForm]
-) -> bytes:
+) -> List[bytes]:
     """
-    Tạo ảnh với Imagen - đã loại bỏ sample_image_size không hỗ trợ
+    Tạo ảnh qua provider, trả về bytes của toàn bộ ảnh sinh được
     """
-    print(f"[DEBUG] Tạo ảnh với config:")
-    print(f"  - prompt: {prompt_en}")
-    print(f"  - aspect_ratio: {aspect_ratio}")
-    print(f"  - number_of_images: {number_of_images}")
-    print(f"  - mime_type: {mime_type}")
-    print(f"  - allow_people: {allow_people}")
-    
-    try:
-        cfg = types.GenerateImagesConfig(
-            number_of_images=number_of_images,
-            aspect_ratio=aspect_ratio,
-            person_generation=allow_people,
-            include_rai_reason=True,
-            output_mime_type=mime_type,
-        )
-        
-        print(f"[DEBUG] Gọi Imagen API...")
-        resp = client.models.generate_images(
-            model=IMAGEN_MODEL,
-            prompt=prompt_en,
-            config=cfg,
-        )
-        
-    except Exception as e:
-        print(f"[DEBUG] Lỗi với config đầy đủ: {e}")
-        print("[DEBUG] Thử với config tối thiểu...")
-        
-        try:
-            resp = client.models.generate_images(
-                model=IMAGEN_MODEL,
-                prompt=prompt_en,
-                config=types.GenerateImagesConfig(
-                    number_of_images=1,
-                    aspect_ratio="1:1",
-                    person_generation="allow_adult",
-                    output_mime_type="image/png",
-                )
+    logger.debug(
+        "Tạo ảnh provider=%s prompt=%r aspect_ratio=%s number_of_images=%d mime_type=%s allow_people=%s",
+        provider.name, prompt_en, aspect_ratio, number_of_images, mime_type, allow_people,
+    )
+
+    async def _call():
+        async with imagen_sem:
+            return await provider.generate_images(
+                prompt_en,
+                aspect_ratio=aspect_ratio,
+                number_of_images=number_of_images,
+                mime_type=mime_type,
+                allow_people=allow_people,
             )
-        except Exception as e2:
-            print(f"[LỖI] Cả config tối thiểu cũng thất bại: {e2}")
-            raise e2
-    
-    print(f"[DEBUG] Response received: {len(resp.generated_images) if resp.generated_images else 0} images")
-    
-    if not resp.generated_images:
-        if hasattr(resp, 'rai_reason') and resp.rai_reason:
-            print(f"[LỖI TẠO ẢNH] Bị chặn. Lý do: {resp.rai_reason}")
-            raise RuntimeError(f"image_blocked: {resp.rai_reason}")
-        raise RuntimeError("no_image_generated")
-        
-    img_obj = resp.generated_images[0].image
-    
-    image_bytes = None
-    for attr_name in ['image_bytes', 'bytes', 'data', '_image_bytes']:
-        if hasattr(img_obj, attr_name):
-            image_bytes = getattr(img_obj, attr_name)
-            if image_bytes:
-                print(f"[DEBUG] Found image data in attribute: {attr_name}")
-                break
-    
-    if not image_bytes or not isinstance(image_bytes, (bytes, bytearray)):
-        print(f"[DEBUG] Image object attributes: {dir(img_obj)}")
-        print(f"[DEBUG] Image object type: {type(img_obj)}")
-        raise RuntimeError("image_bytes_missing")
-    
-    print(f"[SUCCESS] Generated image: {len(image_bytes)} bytes")
-    return bytes(image_bytes)
+
+    with observe(metrics.IMAGEN_SECONDS, provider=provider.name):
+        images = await imagen_policies[provider.name].call(_call)
+
+    logger.info("%s sinh %d ảnh sizes=%s", provider.name, len(images), [len(b) for b in images])
+    return images
 
 # ----- Routes -----
 @app.get("/")
@@ -305,9 +626,21 @@ def root():
 def health():
     return {
         "ok": True,
-        "imagen_model": IMAGEN_MODEL,
-        "translate_model": TRANSLATE_MODEL,
+        "mode": SERVICE_MODE,
+        "capabilities": capability_state,
+        "provider": GEN_PROVIDER,
+        "imagen_model": default_provider.image_model,
+        "translate_model": default_provider.translate_model,
         "ner_loaded": bool(nlp is not None),
+        "ner_batcher": ner_batcher.stats(),
+        "ner_pool": ner_pool.stats() if ner_pool else None,
+        "translate_cache": translate_cache.stats(),
+        "image_cache": image_cache.stats() if image_cache else None,
+        "coalescing": {"translate": translate_flight.stats(), "imagen": imagen_flight.stats()},
+        "upstream": {
+            name: {"translate": translate_policies[name].stats(), "imagen": imagen_policies[name].stats()}
+            for name in providers
+        },
         "supports": {
             "aspect_ratio": ["1:1", "3:4", "4:3", "9:16", "16:9"],
             "mime": ["image/png", "image/jpeg"],
@@ -315,46 +648,135 @@ def health():
         "notes": "Prompts are auto-translated VI→EN before Imagen generation.",
     }
 
+@app.get("/metrics")
+def metrics_endpoint():
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=501, detail="prometheus_client_not_installed")
+    return Response(content=metrics.generate_latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+@app.get("/ready")
+def ready(response: Response):
+    """Readiness: 200 khi mọi năng lực được bật đã sẵn sàng, ngược lại 503."""
+    ok = all(st in ("ready", "disabled") for st in capability_state.values())
+    if not ok:
+        response.status_code = 503
+    return {"ready": ok, "mode": SERVICE_MODE, "capabilities": capability_state, "errors": capability_error,
+            "providers": provider_state}
+
+def _ner_pipe(texts: List[str]) -> List[dict]:
+    return [
+        doc_to_result(doc, SPANS_KEY, ACCEPTANCE_THRESHOLD)
+        for doc in nlp.pipe(texts, batch_size=NER_BATCH_SIZE)
+    ]
+
+ner_pool = NERProcessPool(
+    MODEL_PATH,
+    workers=NER_WORKERS,
+    spans_key=SPANS_KEY,
+    threshold=ACCEPTANCE_THRESHOLD,
+    batch_size=NER_BATCH_SIZE,
+    health_interval=NER_HEALTH_INTERVAL,
+    health_timeout=NER_HEALTH_TIMEOUT,
+) if NER_WORKERS > 0 and ENABLE_NER else None
+
+async def _ner_process(texts: List[str]) -> List[dict]:
+    metrics.NER_BATCH_SIZE.observe(len(texts))
+    if ner_pool is not None:
+        with observe(metrics.NER_SECONDS, mode="pool"):
+            return await ner_pool.pipe(texts)
+    with observe(metrics.NER_SECONDS, mode="thread"):
+        return await asyncio.to_thread(_ner_pipe, texts)
+
+ner_batcher = MicroBatcher(
+    _ner_process,
+    max_batch=NER_BATCH_SIZE,
+    max_wait_ms=NER_MAX_WAIT_MS,
+    max_concurrency=max(1, NER_WORKERS),
+)
+metrics.bind_gauge(metrics.NER_PENDING, lambda: ner_batcher.stats()["pending"])
+
 @app.post("/ner", response_model=NerCompatOut)
-def ner(req: NERReq):
-    if nlp is None:
-        raise HTTPException(status_code=500, detail="spaCy_model_not_loaded")
+async def ner(req: NERReq):
+    _require("ner")
     if not req.text.strip():
         return NerCompatOut(fields={}, scores={})
 
-    doc = nlp(req.text)
-    spans = list(doc.spans.get(SPANS_KEY, []))
+    res = await ner_batcher.submit(req.text)
+    return NerCompatOut(fields=res["fields"], scores=res["scores"])
 
-    best_text: dict[str, str] = {}
-    best_score: dict[str, float | None] = {}
+@app.post("/ner/batch", response_model=NERBatchOut)
+async def ner_batch(req: NERBatchReq):
+    _require("ner")
 
-    buckets: dict[str, list] = defaultdict(list)
-    for sp in spans:
-        label = (sp.label_ or "").strip().lower()
-        if not label:
-            continue
-        sc = getattr(sp, "score", None)
-        if sc is not None and sc < ACCEPTANCE_THRESHOLD:
-            continue
-        buckets[label].append(sp)
-
-    for label, arr in buckets.items():
-        arr.sort(key=lambda s: (s.end_char - s.start_char, getattr(s, "score", 0.0)), reverse=True)
-        sp = arr[0]
-        best_text[label] = sp.text
-        best_score[label] = float(getattr(sp, "score", 0.0)) if getattr(sp, "score", None) is not None else None
-
-    return NerCompatOut(fields=best_text, scores=best_score)
+    idx = [i for i, t in enumerate(req.texts) if t.strip()]
+    results = [NerCompatOut(fields={}, scores={}) for _ in req.texts]
+    if idx:
+        outs = await _ner_process([req.texts[i] for i in idx])
+        for i, res in zip(idx, outs):
+            results[i] = NerCompatOut(fields=res["fields"], scores=res["scores"])
+    return NERBatchOut(results=results)
 
 @app.get("/progress")
 def progress():
-    return {"status": "idle", "ready": True}
+    stats = job_queue.stats()
+    busy = stats["queued"] > 0 or stats["running"] > 0
+    return {"status": "busy" if busy else "idle", "ready": True, **stats}
+
+@app.get("/progress/{job_id}", response_model=JobOut)
+def progress_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job_not_found")
+    return _job_out(job)
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/events/{job_id}")
+async def job_events(job_id: str):
+    """
+    SSE tiến độ một job: event progress (mỗi lần đổi stage), rồi result hoặc failed khi xong
+    (không dùng tên "error" vì trùng sự kiện lỗi kết nối của EventSource).
+    Kết quả json/urls nằm ngay trong event result; binary/multipart lấy qua result_url.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job_not_found")
+
+    async def stream():
+        q = job.subscribe()
+        try:
+            yield "retry: 2000\n\n"
+            yield _sse("progress", job.snapshot())
+            while not job.finished:
+                try:
+                    snap = await asyncio.wait_for(q.get(), SSE_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if snap["status"] not in ("done", "failed", "cancelled"):
+                    yield _sse("progress", snap)
+            out = _job_out(job)
+            if job.status == "done":
+                yield _sse("result", out.model_dump(exclude_none=True))
+            else:
+                yield _sse("failed", {"job_id": job.id, "status": job.status, "error": job.error})
+        finally:
+            job.unsubscribe(q)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/test-translate")
-def test_translate(req: NERReq):
+async def test_translate(req: NERReq):
     """Test endpoint để kiểm tra translation mà không gọi Imagen API"""
+    _require("generate")
+    _require_provider(default_provider)
     try:
-        translated = _translate_vi_to_en(req.text)
+        translated = await _translate_vi_to_en(req.text, default_provider)
         return {
             "original": req.text,
             "translated": translated,
@@ -368,79 +790,357 @@ def test_translate(req: NERReq):
             "status": "failed"
         }
 
-@app.post("/generate", response_model=GenOut)
-def generate(req: GenReq):
-    print("\n--- Bắt đầu yêu cầu /generate ---")
-    print(f"Prompt gốc (tiếng Việt): {req.prompt}")
-    
+@functools.lru_cache(maxsize=1)
+def _render_placeholder() -> bytes:
+    """Ảnh thay thế khi Imagen không khả dụng (billing/mạch mở); vẽ một lần rồi dùng lại."""
+    import io
+    from PIL import Image, ImageDraw, ImageFont
+
+    img = Image.new('RGB', (512, 512), color='lightgray')
+    draw = ImageDraw.Draw(img)
+
+    text_lines = [
+        "IMAGEN API NOT AVAILABLE",
+        "Billing required or upstream unavailable",
+    ]
+
+    y = 50
+    for line in text_lines:
+        draw.text((10, y), line, fill='black')
+        y += 30
+
+    img_io = io.BytesIO()
+    img.save(img_io, format='PNG')
+    return img_io.getvalue()
+
+async def _run_generation(req: GenReq, job: Optional[Job] = None) -> GenResult:
+    """
+    Dịch + sinh ảnh, chạy trong job worker (coroutine);
+    job (nếu có) được cập nhật stage, huỷ job sẽ huỷ luôn call upstream đang chờ.
+    """
+    logger.debug("/generate prompt=%r", req.prompt)
+    timings = job.timings if job else {}
+    provider = _provider_for(req.provider)
+
     # 1) Translate VI->EN
+    if job:
+        job.set_stage("translating")
     try:
-        print("Bắt đầu dịch prompt...")
-        prompt_en = _translate_vi_to_en(req.prompt)
-        print(f"Dịch thành công. Prompt tiếng Anh: {prompt_en}")
+        with observe(None, timings, "translate"):
+            prompt_en = await _translate_vi_to_en(req.prompt, provider)
     except Exception as e:
-        print(f"!!! LỖI TRONG QUÁ TRÌNH DỊCH: {e}")
+        logger.error("Lỗi dịch prompt: %s", e)
         raise HTTPException(status_code=502, detail=f"translation_error: {e}")
 
     # 2) Build Imagen config
     aspect = req.aspect_ratio or _guess_aspect_ratio(req.width, req.height)
     
+    number_of_images = max(1, min(4, req.number_of_images))
+    
     # Track if we used fallback
     is_fallback = False
     
-    try:
-        print("Bắt đầu tạo ảnh với Imagen...")
-        img_bytes = _generate_with_imagen(
+    if job:
+        job.set_stage("generating")
+
+    # Các trường quyết định ảnh đầu ra: dùng chung cho cache và single-flight
+    cache_key = request_key(
+        prompt=prompt_en,
+        aspect_ratio=aspect,
+        number_of_images=number_of_images,
+        mime_type=req.mime_type,
+        allow_people=req.allow_people,
+        model=provider.image_model,
+    )
+    use_cache = image_cache is not None and req.image_cache != "off"
+
+    async def _images_for_request() -> List[bytes]:
+        cached = (
+            await asyncio.to_thread(image_cache.get, cache_key)
+            if use_cache and req.image_cache == "reuse" else None
+        )
+        if use_cache and req.image_cache == "reuse":
+            metrics.CACHE_EVENTS.labels(cache="image", result="hit" if cached else "miss").inc()
+        if cached:
+            logger.debug("Dùng ảnh đã cache key=%s", cache_key[:12])
+            return cached
+        generated = await _generate_with_imagen(
             prompt_en,
+            provider=provider,
             aspect_ratio=aspect,
-            number_of_images=max(1, min(4, req.number_of_images)),
+            number_of_images=number_of_images,
             mime_type=req.mime_type,
             allow_people=req.allow_people,
         )
-        print("Tạo ảnh thành công.")
+        if use_cache:
+            await asyncio.to_thread(image_cache.put, cache_key, generated, req.mime_type)
+        return generated
+
+    try:
+        # refresh không được nhận ảnh cache từ một flight "reuse" -> chế độ cache nằm trong khoá
+        with observe(None, timings, "imagen"):
+            images = await imagen_flight.do(f"{req.image_cache}:{cache_key}", _images_for_request)
     except Exception as e:
-        error_msg = str(e)
-        print(f"!!! LỖI TRONG QUÁ TRÌNH TẠO ẢNH: {e}")
+        kind = classify_error(e)
+        metrics.ERRORS.labels(stage="imagen", kind=kind).inc()
+        logger.error("Lỗi tạo ảnh kind=%s: %s", kind, e)
         
-        if "billed users" in error_msg or "INVALID_ARGUMENT" in error_msg:
-            import io
-            from PIL import Image, ImageDraw, ImageFont
-            
-            img = Image.new('RGB', (512, 512), color='lightgray')
-            draw = ImageDraw.Draw(img)
-            
-            text_lines = [
-                "IMAGEN API NOT AVAILABLE",
-                "Billing required",
-                "",
-                "Translated prompt:",
-                prompt_en[:100] + "..." if len(prompt_en) > 100 else prompt_en
-            ]
-            
-            y = 50
-            for line in text_lines:
-                draw.text((10, y), line, fill='black')
-                y += 30
-            
-            img_io = io.BytesIO()
-            img.save(img_io, format='PNG')
-            img_bytes = img_io.getvalue()
+        if kind in ("billing", "client") or (kind == "circuit_open" and IMAGEN_FALLBACK_ON_OPEN):
+            with observe(metrics.FALLBACK_SECONDS, timings, "fallback"):
+                images = [await asyncio.to_thread(_render_placeholder)]
             
             is_fallback = True
-            print("Đã tạo ảnh placeholder thay thế.")
+            metrics.FALLBACKS.labels(reason=kind).inc()
+        elif kind == "circuit_open":
+            raise HTTPException(
+                status_code=503,
+                detail=f"imagen_unavailable: {e}",
+                headers={"Retry-After": str(max(1, int(e.retry_in)))},
+            )
         else:
-            raise HTTPException(status_code=502, detail=f"imagen_error: {e}")
+            raise HTTPException(status_code=502, detail=f"imagen_error ({kind}): {e}")
     
     # Determine model name based on whether we used fallback
-    model_name = f"{IMAGEN_MODEL} (fallback)" if is_fallback else IMAGEN_MODEL
+    model_name = f"{provider.image_model} (fallback)" if is_fallback else provider.image_model
     
-    print("--- Hoàn thành yêu cầu /generate ---")
-    return GenOut(
-        image_base64=_to_data_uri(img_bytes, req.mime_type), 
-        model=model_name
+    result = GenResult(
+        images=images,
+        mime="image/png" if is_fallback else sniff_mime(images[0], req.mime_type),
+        model=model_name,
+        prompt_en=prompt_en,
+        fallback=is_fallback,
+    )
+
+    if job:
+        job.set_stage("encoding")
+    if req.response_format == "urls" and image_cache is not None:
+        with observe(None, timings, "store"):
+            result.digests = [await asyncio.to_thread(image_cache.put_blob, img, IMAGE_URL_TTL) for img in images]
+    return result
+
+def _urls_out(result: GenResult) -> GenUrlsOut:
+    return GenUrlsOut(
+        model=result.model,
+        images=[
+            ImageRef(
+                url=f"/images/{d}",
+                sha256=d,
+                mime=result.mime,
+                size=len(img),
+                renditions={name: f"/images/{d}/{name}" for name in RENDITIONS},
+            )
+            for d, img in zip(result.digests, result.images)
+        ],
+    )
+
+def _encode_result(result: GenResult, req: GenReq, timings: Optional[dict] = None):
+    """Đóng gói GenResult theo response_format đã chọn."""
+    fmt = req.response_format or "json"
+    with observe(metrics.ENCODE_SECONDS, timings, "encode", format=fmt):
+        if fmt == "binary":
+            return binary_response(result, req.image_index)
+        if fmt == "multipart":
+            return multipart_response(result)
+        if fmt == "urls":
+            return _urls_out(result)
+        return GenOut(
+            image_base64=_to_data_uri(result.images[0], result.mime),
+            model=result.model,
+            image_count=len(result.images),
+        )
+
+def _with_server_timing(out, response: Response, timings: dict):
+    """Gắn header Server-Timing vào Response trả thẳng hoặc vào response của route (JSON)."""
+    target = out if isinstance(out, Response) else response
+    target.headers["Server-Timing"] = server_timing(timings)
+    return out
+
+async def _run_generation_job(job: Job) -> GenResult:
+    return await _run_generation(job.payload, job)
+
+job_queue = JobQueue(
+    _run_generation_job,
+    workers=JOB_WORKERS,
+    maxsize=JOB_QUEUE_SIZE,
+    ttl_seconds=JOB_TTL_SECONDS,
+)
+metrics.bind_gauge(metrics.JOB_QUEUE_DEPTH, lambda: job_queue.stats()["queued"])
+metrics.bind_gauge(metrics.JOB_RUNNING, lambda: job_queue.stats()["running"])
+
+def _submit_job(payload) -> Job:
+    try:
+        return job_queue.submit(payload)
+    except QueueFull:
+        raise HTTPException(status_code=503, detail="job_queue_full")
+
+def _job_out(job: Job) -> JobOut:
+    snap = job.snapshot()
+    result = None
+    if job.status == "done" and job.payload.response_format in (None, "json", "urls"):
+        result = _encode_result(job.result, job.payload)
+    return JobOut(
+        job_id=snap["job_id"],
+        status=snap["status"],
+        stage=snap["stage"],
+        percent=snap["percent"],
+        error=snap["error"],
+        result=result,
+        result_url=f"/result/{job.id}" if job.status == "done" else None,
+    )
+
+async def _wait_job(job: Job):
+    """Chờ job xong; nếu client ngắt kết nối thì huỷ job."""
+    try:
+        await job.wait()
+    except asyncio.CancelledError:
+        job_queue.cancel(job.id)
+        raise
+    if job.status == "done":
+        return job.result
+    if job.status == "cancelled":
+        raise HTTPException(status_code=409, detail="cancelled")
+    if isinstance(job.exception, HTTPException):
+        raise job.exception
+    raise HTTPException(status_code=500, detail=job.error or "job_failed")
+
+def _prepare_gen(req: GenReq, request: Request) -> GenReq:
+    """Chốt response_format (Accept) và kiểm tra provider trước khi vào hàng đợi."""
+    fmt = req.response_format or negotiate_format(request.headers.get("accept"))
+    if fmt == "urls" and image_cache is None:
+        raise HTTPException(status_code=400, detail="image_cache_disabled: set IMAGE_CACHE_DIR to use response_format=urls")
+    _require_provider(_provider_for(req.provider))  # cloud chưa cấu hình / provider chưa sẵn sàng -> 503
+    return req.model_copy(update={"response_format": fmt})
+
+@app.post("/generate", response_model=GenOut | GenUrlsOut | JobOut)
+async def generate(req: GenReq, request: Request, response: Response):
+    _require("generate")
+    req = _prepare_gen(req, request)
+
+    job = _submit_job(req)
+    if req.background:
+        response.status_code = 202
+        return _job_out(job)
+    result = await _wait_job(job)
+    timings = dict(job.timings)
+    return _with_server_timing(_encode_result(result, req, timings), response, timings)
+
+@app.post("/pipeline", response_model=PipelineOut)
+async def pipeline(req: PipelineReq, request: Request, response: Response):
+    """
+    text -> NER (spans) -> fields (line_to_fields) -> prompt (render theo style) -> /generate.
+    Thiếu field bắt buộc -> 422 kèm danh sách thiếu và fields đã trích được.
+    response_format binary/multipart trả thẳng ảnh (không kèm bước trung gian).
+    """
+    _require("ner")
+    if not req.render_only:
+        _require("generate")
+        _require_provider(_provider_for(req.provider))
+    if req.style not in TEMPLATES:
+        raise HTTPException(status_code=400, detail=f"unknown_style: {req.style} ({', '.join(TEMPLATES)})")
+    if not req.text.strip():
+        raise HTTPException(status_code=400, detail="empty_text")
+
+    timings: dict = {}
+    with observe(None, timings, "ner"):
+        res = await ner_batcher.submit(req.text)
+    labels = res["labels"]
+    fields = line_to_fields(req.text, labels)
+    fields.update({k: v for k, v in req.fields.items() if v and v.strip()})
+
+    missing = missing_fields(req.style, fields)
+    if missing:
+        raise HTTPException(
+            status_code=422,
+            detail={"error": "missing_fields", "missing": missing, "fields": fields},
+        )
+    with observe(None, timings, "render"):
+        prompt = render(req.style, fields, req.extra)
+
+    out = PipelineOut(prompt=prompt, style=req.style)
+    if req.include_intermediate:
+        out.labels, out.fields = labels, fields
+    if req.render_only:
+        response.headers["Server-Timing"] = server_timing(timings)
+        return out
+
+    gen = _prepare_gen(GenReq(prompt=prompt, **req.model_dump(include=set(GenOptions.model_fields))), request)
+    job = _submit_job(gen)
+    if gen.background:
+        response.status_code = 202
+        out.job = _job_out(job)
+        return out
+    result = await _wait_job(job)
+    timings.update(job.timings)
+    encoded = _encode_result(result, gen, timings)
+    if isinstance(encoded, Response):
+        return _with_server_timing(encoded, response, timings)
+    out.result = encoded
+    return _with_server_timing(out, response, timings)
+
+@app.get("/result/{job_id}")
+def job_result(job_id: str, response: Response):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job_not_found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"job_{job.status}")
+    timings = dict(job.timings)
+    return _with_server_timing(_encode_result(job.result, job.payload, timings), response, timings)
+
+@app.get("/images/{digest}")
+def get_image(digest: str):
+    data = image_cache.get_blob(digest) if image_cache is not None else None
+    if data is None:
+        raise HTTPException(status_code=404, detail="image_not_found")
+    return Response(
+        content=data,
+        media_type=sniff_mime(data),
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{digest}"'},
+    )
+
+@app.get("/images/{digest}/{rendition}")
+async def get_image_rendition(digest: str, rendition: str):
+    spec = RENDITIONS.get(rendition)
+    if spec is None:
+        raise HTTPException(status_code=404, detail=f"unknown_rendition: {rendition} ({', '.join(RENDITIONS)})")
+    valid = len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+    if image_cache is None or rendition_store is None or not valid:
+        raise HTTPException(status_code=404, detail="image_not_found")
+
+    async def _build() -> Optional[bytes]:
+        cached = await asyncio.to_thread(rendition_store.get, digest, spec)
+        metrics.CACHE_EVENTS.labels(cache="rendition", result="hit" if cached else "miss").inc()
+        if cached is not None:
+            return cached
+        original = await asyncio.to_thread(image_cache.get_blob, digest)
+        if original is None:
+            return None
+        loop = asyncio.get_running_loop()
+        with observe(metrics.ENCODE_SECONDS, format=f"rendition:{rendition}"):
+            data = await loop.run_in_executor(_get_postprocess_pool(), make_rendition, original, spec)
+        await asyncio.to_thread(rendition_store.put, digest, spec, data)
+        return data
+
+    data = await rendition_flight.do(f"{digest}:{spec.key}", _build)
+    if data is None:
+        raise HTTPException(status_code=404, detail="image_not_found")
+    return Response(
+        content=data,
+        media_type=spec.mime,
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{digest}.{spec.key}"'},
     )
 
 @app.post("/interrupt")
-def interrupt():
-    # ....
-    return {"ok": True}
+def interrupt(job_id: Optional[str] = None):
+    if not job_id:
+        return {"ok": True, "cancelled": False}
+    return interrupt_job(job_id)
+
+@app.post("/interrupt/{job_id}")
+def interrupt_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job_not_found")
+    cancelled = job_queue.cancel(job_id)
+    return {"ok": True, "cancelled": cancelled, "job_id": job_id, "status": job.status}
+
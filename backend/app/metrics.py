@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics Prometheus cho backend (prometheus_client là tuỳ chọn).
+
+Chưa cài prometheus_client thì mọi metric là no-op và /metrics trả 501,
+code gọi metric không cần kiểm tra gì thêm.
+"""
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        Counter,
+        Gauge,
+        Histogram,
+        generate_latest,
+    )
+    ENABLED = True
+except ImportError:  # pragma: no cover - phụ thuộc môi trường
+    ENABLED = False
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+    class _NoopMetric:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def labels(self, *args, **kwargs) -> "_NoopMetric":
+            return self
+
+        def observe(self, *args, **kwargs) -> None:
+            pass
+
+        def inc(self, *args, **kwargs) -> None:
+            pass
+
+        def set(self, *args, **kwargs) -> None:
+            pass
+
+        def set_function(self, *args, **kwargs) -> None:
+            pass
+
+    Counter = Gauge = Histogram = _NoopMetric  # type: ignore[misc,assignment]
+
+    def generate_latest(*args, **kwargs) -> bytes:
+        return b""
+
+# Bucket (giây): NER/encode vài ms, dịch ~1s, Imagen 5-30s
+_FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+_UPSTREAM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+NER_SECONDS = Histogram(
+    "vnhis_ner_seconds", "Thời gian suy luận NER cho một batch", ["mode"], buckets=_FAST_BUCKETS
+)
+NER_BATCH_SIZE = Histogram(
+    "vnhis_ner_batch_size", "Số câu mỗi lần nlp.pipe", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+)
+TRANSLATE_SECONDS = Histogram(
+    "vnhis_translate_seconds", "Thời gian gọi dịch VI->EN (gồm retry)", ["provider"], buckets=_UPSTREAM_BUCKETS
+)
+IMAGEN_SECONDS = Histogram(
+    "vnhis_imagen_seconds", "Thời gian gọi sinh ảnh (gồm retry)", ["provider"], buckets=_UPSTREAM_BUCKETS
+)
+FALLBACK_SECONDS = Histogram(
+    "vnhis_fallback_seconds", "Thời gian lấy ảnh placeholder", buckets=_FAST_BUCKETS
+)
+ENCODE_SECONDS = Histogram(
+    "vnhis_encode_seconds", "Thời gian đóng gói response /generate", ["format"], buckets=_FAST_BUCKETS
+)
+
+CACHE_EVENTS = Counter("vnhis_cache_events_total", "Cache hit/miss", ["cache", "result"])
+ERRORS = Counter("vnhis_errors_total", "Lỗi theo stage và loại", ["stage", "kind"])
+FALLBACKS = Counter("vnhis_fallbacks_total", "Số lần trả ảnh placeholder", ["reason"])
+
+JOB_QUEUE_DEPTH = Gauge("vnhis_job_queue_depth", "Job đang chờ trong hàng đợi /generate")
+JOB_RUNNING = Gauge("vnhis_jobs_running", "Job /generate đang chạy")
+NER_PENDING = Gauge("vnhis_ner_pending", "Câu /ner đang chờ gom batch")
+
+
+def bind_gauge(gauge, fn: Callable[[], float]) -> None:
+    """Gauge đọc giá trị lúc scrape (không phải cập nhật trên hot path)."""
+    gauge.set_function(fn)
+
+
+@contextmanager
+def observe(
+    histogram,
+    timings: Optional[Dict[str, float]] = None,
+    name: Optional[str] = None,
+    **labels: str,
+) -> Iterator[None]:
+    """
+    Đo thời gian khối lệnh; ghi vào histogram (bỏ qua nếu None)
+    và cộng dồn vào timings[name] để trả header Server-Timing.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        if histogram is not None:
+            (histogram.labels(**labels) if labels else histogram).observe(dt)
+        if timings is not None and name:
+            timings[name] = timings.get(name, 0.0) + dt
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """{"translate": 0.41} -> 'translate;dur=410.0'"""
+    return ", ".join(f"{k};dur={v * 1000.0:.1f}" for k, v in timings.items())
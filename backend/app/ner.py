@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Tiện ích NER cho backend:
+- doc_to_result : chuyển spaCy Doc -> dict thuần (fields/scores/labels), pickle được
+- MicroBatcher  : gom các request /ner đồng thời thành một lần nlp.pipe
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, List, Optional
+
+
+def doc_to_result(doc, spans_key: str, threshold: float) -> dict:
+    """
+    fields/scores: span dài nhất cho mỗi nhãn (như /ner trước đây).
+    labels: [[start_char, end_char, LABEL], ...] có điểm >= threshold (định dạng Doccano).
+    """
+    spans = doc.spans.get(spans_key, [])
+    spans_list = list(spans)
+
+    best_text: dict[str, str] = {}
+    best_score: dict[str, Optional[float]] = {}
+
+    buckets: dict[str, list] = defaultdict(list)
+    for sp in spans_list:
+        label = (sp.label_ or "").strip().lower()
+        if not label:
+            continue
+        sc = getattr(sp, "score", None)
+        if sc is not None and sc < threshold:
+            continue
+        buckets[label].append(sp)
+
+    for label, arr in buckets.items():
+        arr.sort(key=lambda s: (s.end_char - s.start_char, getattr(s, "score", 0.0)), reverse=True)
+        sp = arr[0]
+        best_text[label] = sp.text
+        best_score[label] = float(getattr(sp, "score", 0.0)) if getattr(sp, "score", None) is not None else None
+
+    scores = getattr(spans, "attrs", {}).get("scores", [1.0] * len(spans_list))
+    labels = [
+        [sp.start_char, sp.end_char, sp.label_]
+        for sp, score in zip(spans_list, scores)
+        if float(score) >= threshold
+    ]
+    return {"fields": best_text, "scores": best_score, "labels": labels}
+
+
+class MicroBatcher:
+    """
+    Gom request trong tối đa max_wait_ms hoặc tới max_batch văn bản,
+    rồi gọi process(texts) một lần. process phải trả về list kết quả cùng thứ tự.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[str]], Awaitable[List[Any]]],
+        *,
+        max_batch: int = 32,
+        max_wait_ms: float = 5.0,
+        max_concurrency: int = 1,
+    ):
+        self._process = process
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._sem = asyncio.Semaphore(max(1, max_concurrency))
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._inflight: set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def start(self) -> None:
+        if self._loop_task is None:
+            self._queue = asyncio.Queue()
+            self._loop_task = asyncio.create_task(self._collect())
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, *self._inflight, return_exceptions=True)
+            self._loop_task = None
+
+    async def submit(self, text: str) -> Any:
+        if self._queue is None:
+            raise RuntimeError("batcher_not_started")
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, fut))
+        return await fut
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+    async def _collect(self) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._sem.acquire()
+            task = asyncio.create_task(self._run(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run(self, batch: list) -> None:
+        try:
+            live = [(t, f) for t, f in batch if not f.done()]
+            if not live:
+                return
+            self.batches += 1
+            self.items += len(live)
+            try:
+                results = await self._process([t for t, _ in live])
+            except Exception as e:
+                for _, f in live:
+                    if not f.done():
+                        f.set_exception(e)
+                return
+            for (_, f), res in zip(live, results):
+                if not f.done():
+                    f.set_result(res)
+        finally:
+            self._sem.release()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Pool tiến trình spaCy cho /ner (NER_WORKERS > 0).
+
+- Lần dựng đầu: model được nạp ở tiến trình cha rồi fork (preload-before-fork),
+  các worker dùng chung trang bộ nhớ copy-on-write. start() phải được gọi trên
+  main thread trước khi có thread nào khác (fork tiến trình nhiều thread có thể
+  làm worker kẹt ở lock kế thừa: logging, sqlite, httpx, allocator).
+- Dựng lại khi đang chạy (đã có thread): forkserver/spawn, mỗi worker tự
+  spacy.load trong initializer; nền tảng không có fork cũng vậy.
+- Kiểm tra sức khoẻ định kỳ: từng worker phải còn sống (is_alive), không
+  xếp ping vào hàng đợi khi đang có batch chạy (ping sẽ chờ sau batch dài
+  và bị coi nhầm là treo). Lúc rảnh gửi `workers` ping cùng chờ một Barrier:
+  chỉ qua được khi mọi worker đều nhận một ping, nên một worker treo làm cả
+  lượt hết health_timeout. Pool hỏng sẽ được dựng lại và batch đang chạy được
+  gửi lại một lần.
+- Batch lớn được chia đều cho các worker thay vì dồn vào một tiến trình.
+"""
+from __future__ import annotations
+
+import asyncio
+import gc
+import logging
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import List, Optional
+
+from .ner import doc_to_result
+
+logger = logging.getLogger("vnhis2image.ner_pool")
+
+# Model trong từng tiến trình worker (kế thừa từ cha khi fork)
+_NLP = None
+# Barrier chung của lượt ping sức khoẻ (truyền qua initializer)
+_BARRIER = None
+
+
+def _init_worker(model_path: str, barrier) -> None:
+    global _NLP, _BARRIER
+    _BARRIER = barrier
+    if _NLP is None:
+        import spacy
+        _NLP = spacy.load(model_path)
+
+
+def _worker_pipe(texts: List[str], spans_key: str, threshold: float, batch_size: int) -> List[dict]:
+    return [doc_to_result(doc, spans_key, threshold) for doc in _NLP.pipe(texts, batch_size=batch_size)]
+
+
+def _worker_pid() -> int:
+    return os.getpid()
+
+
+def _worker_ping(timeout: float) -> int:
+    # Worker đã tới barrier không nhận ping khác -> `workers` ping rơi vào `workers` worker khác nhau
+    _BARRIER.wait(timeout)
+    return os.getpid()
+
+
+class NERProcessPool:
+    def __init__(
+        self,
+        model_path: str,
+        *,
+        workers: int,
+        spans_key: str,
+        threshold: float,
+        batch_size: int = 32,
+        health_interval: float = 30.0,
+        health_timeout: float = 10.0,
+    ):
+        self.model_path = model_path
+        self.workers = max(1, workers)
+        self.spans_key = spans_key
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._barrier = None
+        self._generation = 0
+        self._restart_lock = asyncio.Lock()
+        self._health_task: Optional[asyncio.Task] = None
+        self._inflight = 0
+        self.restarts = 0
+        self.last_health_ok: Optional[float] = None
+
+    def start(self, nlp=None) -> None:
+        """
+        Dựng pool. nlp đã nạp -> fork (chỉ gọi trên main thread, trước khi có thread khác);
+        nlp=None -> forkserver/spawn, worker tự nạp model (an toàn khi gọi từ thread bất kỳ).
+        """
+        global _NLP
+        methods = mp.get_all_start_methods()
+        if nlp is not None and "fork" in methods:
+            _NLP = nlp
+            gc.freeze()  # tránh GC chạm vào object cũ -> giữ trang copy-on-write
+            ctx = mp.get_context("fork")
+        else:
+            ctx = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self._barrier = ctx.Barrier(self.workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(self.model_path, self._barrier),
+        )
+        # ép tạo đủ worker + nạp model ngay, trước khi nhận request
+        for f in [self._executor.submit(_worker_pid) for _ in range(self.workers)]:
+            f.result()
+        self._generation += 1
+        self.last_health_ok = time.time()
+
+    async def start_health_checks(self) -> None:
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _split(self, texts: List[str]) -> List[List[str]]:
+        # Mỗi phần ít nhất batch_size câu, tối đa `workers` phần
+        n = min(self.workers, max(1, len(texts) // max(1, self.batch_size)))
+        step = -(-len(texts) // n)
+        return [texts[i:i + step] for i in range(0, len(texts), step)]
+
+    async def _run(self, parts: List[List[str]]) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        futs = [
+            loop.run_in_executor(
+                self._executor, partial(_worker_pipe, part, self.spans_key, self.threshold, self.batch_size)
+            )
+            for part in parts
+        ]
+        return [res for out in await asyncio.gather(*futs) for res in out]
+
+    async def pipe(self, texts: List[str]) -> List[dict]:
+        if not texts:
+            return []
+        parts = self._split(texts)
+        generation = self._generation
+        self._inflight += 1
+        try:
+            try:
+                return await self._run(parts)
+            except BrokenProcessPool:
+                await self._restart(generation, reason="broken_pool")
+                return await self._run(parts)
+        finally:
+            self._inflight -= 1
+
+    def _dead_workers(self) -> int:
+        ex = self._executor
+        if ex is None or getattr(ex, "_broken", False):
+            return self.workers
+        procs = getattr(ex, "_processes", None) or {}
+        return sum(1 for p in procs.values() if not p.is_alive()) + max(0, self.workers - len(procs))
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "restarts": self.restarts,
+            "inflight": self._inflight,
+            "last_health_ok": self.last_health_ok,
+        }
+
+    async def _health_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.health_interval)
+            generation = self._generation
+            dead = self._dead_workers()
+            if dead:
+                await self._restart(generation, reason=f"dead_workers={dead}")
+                continue
+            if self._inflight:
+                # đang có batch: worker sống là đủ, ping sẽ phải chờ sau batch
+                self.last_health_ok = time.time()
+                continue
+            try:
+                pings = [
+                    loop.run_in_executor(self._executor, _worker_ping, self.health_timeout)
+                    for _ in range(self.workers)
+                ]
+                pids = await asyncio.wait_for(asyncio.gather(*pings), self.health_timeout * 2)
+                if len(set(pids)) != self.workers:
+                    raise RuntimeError(f"ping_pids={len(set(pids))}")
+                self.last_health_ok = time.time()
+            except BrokenProcessPool as e:
+                await self._restart(generation, reason=type(e).__name__)
+            except Exception as e:  # hết giờ ở barrier / wait_for
+                if self._inflight:
+                    # batch chen vào chiếm worker -> barrier hỏng hợp lệ, không phải treo
+                    self._barrier.reset()
+                    continue
+                await self._restart(generation, reason=type(e).__name__)
+
+    async def _restart(self, generation: int, *, reason: str) -> None:
+        async with self._restart_lock:
+            if generation != self._generation:
+                return  # request khác đã dựng lại pool
+            logger.warning("Dựng lại pool NER reason=%s", reason)
+            old = self._executor
+            if old is not None:
+                for p in list(getattr(old, "_processes", {}).values()):
+                    p.terminate()
+                old.shutdown(wait=False, cancel_futures=True)
+            self.restarts += 1
+            # Đang có thread khác (asyncio, httpx, ...) -> không fork, worker mới tự nạp model
+            await asyncio.to_thread(self.start)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Provider cho dịch VI->EN và sinh ảnh:
+- GoogleProvider : Gemini (generate_content) + Imagen (generate_images) qua google-genai async
+- StubProvider   : chạy offline, ảnh PNG tất định theo prompt, độ trễ/tỉ lệ lỗi cấu hình được
+                   (benchmark, CI không có mạng)
+
+main.py lo cache, single-flight, retry/circuit breaker; provider chỉ thực hiện một lần gọi.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import random
+import struct
+import zlib
+from typing import List, Optional
+
+
+class ProviderUnavailable(RuntimeError):
+    """Provider chưa được cấu hình (vd. thiếu GOOGLE_API_KEY)."""
+
+
+class GenerationProvider:
+    name = "base"
+    translate_model = ""
+    image_model = ""
+
+    def warm_up(self) -> None:
+        """Khởi tạo client (đồng bộ, chạy trong thread lúc startup)."""
+
+    async def translate(self, prompt: str) -> str:
+        """Trả về văn bản thô của model; main.py tự làm sạch."""
+        raise NotImplementedError
+
+    async def generate_images(
+        self,
+        prompt_en: str,
+        *,
+        aspect_ratio: str,
+        number_of_images: int,
+        mime_type: str,
+        allow_people: str,
+    ) -> List[bytes]:
+        raise NotImplementedError
+
+
+class GoogleProvider(GenerationProvider):
+    name = "google"
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        *,
+        translate_model: str,
+        image_model: str,
+        timeout_s: float = 120.0,
+        max_connections: int = 64,
+        max_keepalive: int = 32,
+        keepalive_expiry_s: float = 60.0,
+    ):
+        self.api_key = api_key
+        self.translate_model = translate_model
+        self.image_model = image_model
+        self.timeout_s = timeout_s
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry_s = keepalive_expiry_s
+        self.client = None
+
+    def warm_up(self) -> None:
+        self._get_client()
+
+    def _get_client(self):
+        """Tạo genai client khi cần (import google-genai lười)."""
+        if self.client is None:
+            if not self.api_key:
+                raise ProviderUnavailable("GOOGLE_API_KEY is missing")
+            import httpx
+            from google import genai
+            from google.genai import types
+
+            # Truyền transport httpx riêng để SDK dùng một AsyncClient dùng chung (giữ kết nối keep-alive)
+            # thay vì mở session mới cho mỗi request.
+            self.client = genai.Client(
+                api_key=self.api_key,
+                http_options=types.HttpOptions(
+                    timeout=int(self.timeout_s * 1000),
+                    async_client_args={
+                        "transport": httpx.AsyncHTTPTransport(
+                            limits=httpx.Limits(
+                                max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_keepalive,
+                                keepalive_expiry=self.keepalive_expiry_s,
+                            ),
+                        ),
+                    },
+                ),
+            )
+        return self.client
+
+    async def translate(self, prompt: str) -> str:
+        response = await self._get_client().aio.models.generate_content(
+            model=self.translate_model,
+            contents=prompt,
+        )
+        if not response.candidates:
+            raise RuntimeError("translation_failed_no_candidates")
+
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'content') and candidate.content:
+            if hasattr(candidate.content, 'parts') and candidate.content.parts:
+                part = candidate.content.parts[0]
+                return part.text if hasattr(part, 'text') else str(part)
+            return str(candidate.content)
+        return str(candidate)
+
+    async def generate_images(
+        self,
+        prompt_en: str,
+        *,
+        aspect_ratio: str,
+        number_of_images: int,
+        mime_type: str,
+        allow_people: str,
+    ) -> List[bytes]:
+        from google.genai import types
+
+        cfg = types.GenerateImagesConfig(
+            number_of_images=number_of_images,
+            aspect_ratio=aspect_ratio,
+            person_generation=allow_people,
+            include_rai_reason=True,
+            output_mime_type=mime_type,
+        )
+        resp = await self._get_client().aio.models.generate_images(
+            model=self.image_model,
+            prompt=prompt_en,
+            config=cfg,
+        )
+
+        if not resp.generated_images:
+            if hasattr(resp, 'rai_reason') and resp.rai_reason:
+                raise RuntimeError(f"image_blocked: {resp.rai_reason}")
+            raise RuntimeError("no_image_generated")
+
+        images: List[bytes] = []
+        for generated in resp.generated_images:
+            img_obj = generated.image
+            image_bytes = None
+            for attr_name in ['image_bytes', 'bytes', 'data', '_image_bytes']:
+                if hasattr(img_obj, attr_name):
+                    image_bytes = getattr(img_obj, attr_name)
+                    if image_bytes:
+                        break
+            if image_bytes and isinstance(image_bytes, (bytes, bytearray)):
+                images.append(bytes(image_bytes))
+
+        if not images:
+            raise RuntimeError("image_bytes_missing")
+        return images
+
+
+class StubUpstreamError(RuntimeError):
+    """Lỗi giả lập kiểu 503 để thử retry/circuit breaker."""
+
+    code = 503
+
+    def __init__(self, what: str):
+        super().__init__(f"503 UNAVAILABLE: stub {what} failure")
+
+
+# Kích thước ảnh stub theo aspect ratio (nhỏ để encode nhanh)
+_STUB_SIZES = {"1:1": (64, 64), "3:4": (48, 64), "4:3": (64, 48), "9:16": (36, 64), "16:9": (64, 36)}
+
+
+def _png(width: int, height: int, rgb: bytes) -> bytes:
+    """PNG RGB 8-bit một màu, dựng bằng zlib/struct (không cần PIL)."""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    raw = (b"\x00" + rgb * width) * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+class StubProvider(GenerationProvider):
+    """
+    Cùng prompt + tham số -> cùng bytes ảnh. Độ trễ = latency_ms ± jitter_ms,
+    mỗi call lỗi (503) với xác suất failure_rate.
+    """
+
+    name = "stub"
+    translate_model = "stub-translate"
+    image_model = "stub-image"
+
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+
+    async def _simulate(self, what: str) -> None:
+        delay = self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+        if self.failure_rate > 0 and self._rng.random() < self.failure_rate:
+            raise StubUpstreamError(what)
+
+    async def translate(self, prompt: str) -> str:
+        await self._simulate("translate")
+        return f"Stub translation: {prompt}"
+
+    async def generate_images(
+        self,
+        prompt_en: str,
+        *,
+        aspect_ratio: str,
+        number_of_images: int,
+        mime_type: str,
+        allow_people: str,
+    ) -> List[bytes]:
+        await self._simulate("imagen")
+        width, height = _STUB_SIZES.get(aspect_ratio, (64, 64))
+        images = []
+        for i in range(number_of_images):
+            seed = hashlib.sha256(f"{prompt_en}\x1f{aspect_ratio}\x1f{i}".encode("utf-8")).digest()
+            images.append(_png(width, height, seed[:3]))
+        return images
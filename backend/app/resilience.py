@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Chính sách gọi upstream (Gemini/Imagen):
+- classify_error : phân loại lỗi (rate_limited, server, timeout, network, billing, client, ...)
+- RetryPolicy    : exponential backoff + full jitter cho lỗi tạm thời (429/5xx/timeout)
+- TokenBucket    : giới hạn tốc độ gọi theo quota (req/phút)
+- CircuitBreaker : quá nhiều lỗi liên tiếp -> mở mạch, fail-fast trong reset_timeout giây
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+RETRYABLE = frozenset({"rate_limited", "server", "timeout", "network"})
+# Lỗi làm tăng bộ đếm của circuit breaker (lỗi do request sai như "client" thì không)
+BREAKER_KINDS = frozenset({"rate_limited", "server", "timeout", "network", "billing"})
+
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"circuit_open: {name} (retry in {retry_in:.0f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def classify_error(exc: BaseException) -> str:
+    if isinstance(exc, CircuitOpenError):
+        return "circuit_open"
+    msg = str(exc)
+    cls = type(exc).__name__
+    code = getattr(exc, "code", None)
+    if not isinstance(code, int):
+        code = getattr(exc, "status_code", None)
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in cls:
+        return "timeout"
+    if "billed users" in msg:
+        return "billing"
+    if code == 429 or "RESOURCE_EXHAUSTED" in msg:
+        return "rate_limited"
+    if isinstance(code, int) and 500 <= code < 600:
+        return "server"
+    if "UNAVAILABLE" in msg or "INTERNAL" in msg or "DEADLINE_EXCEEDED" in msg:
+        return "server"
+    if any(k in cls for k in ("Connect", "Network", "RemoteProtocol", "ReadError", "WriteError")):
+        return "network"
+    if (isinstance(code, int) and 400 <= code < 500) or "INVALID_ARGUMENT" in msg:
+        return "client"
+    return "unknown"
+
+
+class RetryPolicy:
+    def __init__(self, *, max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """Full jitter: ngẫu nhiên trong [0, min(max_delay, base * 2^attempt)]."""
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: Optional[float] = None):
+        self.rate = rate_per_sec
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_sec)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, *, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"  # closed | open | half_open
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            elapsed = time.monotonic() - self._opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise CircuitOpenError(self.name, 0.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self._failures += 1
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def record_neutral(self) -> None:
+        """Lỗi không tính vào breaker (vd. prompt bị từ chối) vẫn phải nhả lượt probe."""
+        self._probe_in_flight = False
+
+
+class UpstreamPolicy:
+    """Gộp breaker + rate limit + retry cho một loại call upstream."""
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        retry: RetryPolicy,
+        breaker: CircuitBreaker,
+        bucket: Optional[TokenBucket] = None,
+    ):
+        self.name = name
+        self.retry = retry
+        self.breaker = breaker
+        self.bucket = bucket
+        self.calls = 0
+        self.retries = 0
+        self.failures: dict[str, int] = {}
+
+    async def call(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.breaker.before_call()
+        self.calls += 1
+        attempt = 0
+        # Mọi lối ra (kể cả bị huỷ khi chờ bucket / ngủ backoff) phải báo cho breaker,
+        # nếu không probe half_open bị kẹt ở trạng thái "đang bay" mãi mãi
+        recorded = False
+        try:
+            while True:
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                try:
+                    result = await fn()
+                except Exception as e:
+                    kind = classify_error(e)
+                    if kind in RETRYABLE and attempt + 1 < self.retry.max_attempts:
+                        self.retries += 1
+                        await asyncio.sleep(self.retry.delay(attempt))
+                        attempt += 1
+                        continue
+                    self.failures[kind] = self.failures.get(kind, 0) + 1
+                    if kind in BREAKER_KINDS:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_neutral()
+                    recorded = True
+                    raise
+                self.breaker.record_success()
+                recorded = True
+                return result
+        finally:
+            if not recorded:
+                self.breaker.record_neutral()
+
+    def stats(self) -> dict:
+        return {
+            "circuit": self.breaker.state,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rate_per_sec": self.bucket.rate if self.bucket else None,
+        }
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight: các lời gọi cùng khoá đang chạy đồng thời dùng chung một kết quả.
+
+Lời gọi đầu tiên tạo task; các lời gọi sau chỉ chờ task đó. Một waiter bị huỷ
+không làm hỏng những waiter khác; chỉ khi không còn ai chờ thì task mới bị huỷ.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[str, _Call] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _t, k=key, c=call: self._forget(k, c))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"started": self.started, "coalesced": self.coalesced, "in_flight": len(self._calls)}
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Cache 2 tầng cho bản dịch VI->EN:
+1) LRU trong bộ nhớ (giới hạn số phần tử)
+2) SQLite trên đĩa
+Cả hai tầng hết hạn theo cùng TTL, tính từ lúc bản dịch được tạo.
+
+Khoá = sha256(model + prompt đã chuẩn hoá).
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+_PURGE_EVERY = 256  # dọn bản ghi hết hạn sau mỗi N lần ghi
+
+
+def normalize_prompt(text: str) -> str:
+    """NFC + gộp khoảng trắng + casefold để prompt gần giống nhau trùng khoá."""
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.split()).casefold()
+
+
+def cache_key(text: str, model: str) -> str:
+    raw = f"{model}\x1f{normalize_prompt(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    def __init__(self, *, max_items: int = 1024, db_path: Optional[str] = None, ttl_seconds: float = 7 * 86400):
+        self._max_items = max(0, max_items)
+        self._ttl = ttl_seconds
+        self._lru: OrderedDict[str, tuple[str, float]] = OrderedDict()  # key -> (bản dịch, thời điểm tạo)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            d = os.path.dirname(db_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, text: str, model: str) -> Optional[str]:
+        key = cache_key(text, model)
+        with self._lock:
+            hit = self._lru.get(key)
+            if hit is not None:
+                if time.time() - hit[1] <= self._ttl:
+                    self._lru.move_to_end(key)
+                    self.memory_hits += 1
+                    return hit[0]
+                del self._lru[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM translations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and time.time() - row[1] <= self._ttl:
+                    self.disk_hits += 1
+                    self._remember(key, row[0], row[1])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, model: str, value: str) -> None:
+        key = cache_key(text, model)
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO translations (key, value, created) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            self._writes += 1
+            if self._writes % _PURGE_EVERY == 0:
+                self._db.execute("DELETE FROM translations WHERE created < ?", (time.time() - self._ttl,))
+            self._db.commit()
+
+    def _remember(self, key: str, value: str, created: float) -> None:
+        if self._max_items <= 0:
+            return
+        self._lru[key] = (value, created)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self._max_items:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "memory_items": len(self._lru),
+            "disk_enabled": self._db is not None,
+        }
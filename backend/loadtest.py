@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Load test cho backend: bắn /ner và/hoặc /generate với tốc độ cố định (open-loop),
+báo throughput, tỉ lệ lỗi và p50/p95/p99 độ trễ.
+
+Chạy offline với provider stub:
+  GEN_PROVIDER=stub STUB_LATENCY_MS=300 uvicorn backend.app.main:app --port 8001
+  python -m backend.loadtest --target generate --rate 20 --duration 30 --provider local
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+DEFAULT_TEXTS = [
+    "Trận Bạch Đằng năm 938 do Ngô Quyền chỉ huy.",
+    "Vua Lý Thái Tổ dời đô từ Hoa Lư về Thăng Long năm 1010.",
+    "Hai Bà Trưng khởi nghĩa chống quân Đông Hán năm 40.",
+    "Quang Trung đại phá quân Thanh tại Ngọc Hồi - Đống Đa.",
+    "Chiến thắng Điện Biên Phủ năm 1954 chấn động địa cầu.",
+]
+
+
+def _load_texts(path: Optional[str]) -> List[str]:
+    if not path:
+        return DEFAULT_TEXTS
+    texts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                obj = json.loads(line)
+                line = (obj.get("prompt") or obj.get("text") or "").strip()
+            if line:
+                texts.append(line)
+    return texts or DEFAULT_TEXTS
+
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = (len(sorted_vals) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+def _summary(name: str, latencies: List[float], statuses: Dict[str, int], wall: float) -> dict:
+    lat = sorted(latencies)
+    ok = sum(n for s, n in statuses.items() if s.startswith("2"))
+    total = sum(statuses.values())
+    return {
+        "endpoint": name,
+        "requests": total,
+        "ok": ok,
+        "error_rate": round(1 - ok / total, 4) if total else 0.0,
+        "throughput_rps": round(ok / wall, 2) if wall else 0.0,
+        "p50_ms": round(_percentile(lat, 0.50) * 1000, 1),
+        "p95_ms": round(_percentile(lat, 0.95) * 1000, 1),
+        "p99_ms": round(_percentile(lat, 0.99) * 1000, 1),
+        "max_ms": round(lat[-1] * 1000, 1) if lat else 0.0,
+        "statuses": dict(sorted(statuses.items())),
+    }
+
+
+async def _run(args) -> List[dict]:
+    texts = _load_texts(args.texts)
+    targets = ["ner", "generate"] if args.target == "both" else [args.target]
+    results = {t: {"lat": [], "status": {}} for t in targets}
+    text_iter = itertools.cycle(texts)
+    sem = asyncio.Semaphore(args.max_in_flight)
+
+    def _request(target: str, text: str):
+        if target == "ner":
+            return "/ner", {"text": text}
+        payload = {
+            "prompt": text,
+            "provider": args.provider,
+            "image_cache": args.image_cache,
+            "response_format": args.response_format,
+        }
+        return "/generate", payload
+
+    async def _one(client: httpx.AsyncClient, target: str, text: str) -> None:
+        path, payload = _request(target, text)
+        t0 = time.perf_counter()
+        try:
+            r = await client.post(path, json=payload)
+            await r.aread()
+            status = str(r.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        finally:
+            sem.release()
+        bucket = results[target]
+        bucket["lat"].append(time.perf_counter() - t0)
+        bucket["status"][status] = bucket["status"].get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(base_url=args.api_base.rstrip("/"), timeout=args.timeout, limits=limits) as client:
+        if args.warmup:
+            for t in targets:
+                path, payload = _request(t, texts[0])
+                await client.post(path, json=payload)
+
+        tasks = []
+        interval = 1.0 / args.rate
+        start = time.perf_counter()
+        n = int(args.rate * args.duration)
+        for i in range(n):
+            # lịch cố định: không chờ response trước (open-loop), chỉ chặn khi vượt max_in_flight
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await sem.acquire()
+            target = targets[i % len(targets)]
+            tasks.append(asyncio.create_task(_one(client, target, next(text_iter))))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - start
+
+    return [_summary(t, results[t]["lat"], results[t]["status"], wall) for t in targets]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--api_base", default="http://127.0.0.1:8001")
+    ap.add_argument("--target", choices=["ner", "generate", "both"], default="ner")
+    ap.add_argument("--rate", type=float, default=10.0, help="Số request/giây (tổng, chia đều khi --target both)")
+    ap.add_argument("--duration", type=float, default=30.0, help="Số giây bắn request")
+    ap.add_argument("--max_in_flight", type=int, default=256, help="Giới hạn request đang chờ cùng lúc")
+    ap.add_argument("--timeout", type=float, default=180.0)
+    ap.add_argument("--texts", default=None, help="File .txt (mỗi dòng một câu) hoặc .jsonl có 'prompt'/'text'")
+    ap.add_argument("--provider", choices=["auto", "local", "cloud"], default="local",
+                    help="provider cho /generate; mặc định local (stub offline)")
+    ap.add_argument("--response_format", choices=["json", "binary", "multipart", "urls"], default="binary")
+    ap.add_argument("--image_cache", choices=["reuse", "refresh", "off"], default="off")
+    ap.add_argument("--warmup", action="store_true", help="Gửi một request mỗi endpoint trước khi đo")
+    ap.add_argument("--out", default=None, help="Ghi kết quả JSON ra file")
+    args = ap.parse_args()
+
+    summaries = asyncio.run(_run(args))
+    for s in summaries:
+        print(
+            f"[{s['endpoint']}] n={s['requests']} ok={s['ok']} err={s['error_rate']:.2%} "
+            f"rps={s['throughput_rps']} p50={s['p50_ms']}ms p95={s['p95_ms']}ms "
+            f"p99={s['p99_ms']}ms max={s['max_ms']}ms statuses={s['statuses']}"
+        )
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(summaries, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
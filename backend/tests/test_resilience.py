@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from backend.app.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, UpstreamPolicy
+
+
+class _Unavailable(Exception):
+    code = 503
+
+
+def _half_open_policy() -> UpstreamPolicy:
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()  # open; reset_timeout=0 -> lần gọi kế tiếp là probe half_open
+    return UpstreamPolicy("test", retry=RetryPolicy(max_attempts=3, base_delay=10.0, max_delay=10.0),
+                          breaker=breaker)
+
+
+def test_cancel_during_backoff_releases_probe():
+    policy = _half_open_policy()
+
+    async def failing():
+        raise _Unavailable("UNAVAILABLE")
+
+    async def ok():
+        return "ok"
+
+    async def run():
+        task = asyncio.create_task(policy.call(failing))
+        while policy.retries == 0:  # đang ngủ backoff sau lần thử đầu
+            await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert policy.breaker.state == "half_open"
+        assert not policy.breaker._probe_in_flight
+        # probe mới được phép chạy và đóng mạch
+        assert await policy.call(ok) == "ok"
+        assert policy.breaker.state == "closed"
+
+    asyncio.run(run())
+
+
+def test_second_probe_rejected_while_first_in_flight():
+    policy = _half_open_policy()
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def slow():
+            await gate.wait()
+            return "ok"
+
+        task = asyncio.create_task(policy.call(slow))
+        await asyncio.sleep(0)
+        with pytest.raises(CircuitOpenError):
+            await policy.call(slow)
+        gate.set()
+        assert await task == "ok"
+
+    asyncio.run(run())
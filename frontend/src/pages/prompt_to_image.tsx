@@ -2,7 +2,7 @@
 /* eslint-disable no-empty */
  
 /* eslint-disable @typescript-eslint/no-explicit-any */
-import React, { useMemo, useState, useEffect, useRef } from "react";
+import React, { useMemo, useState, useRef } from "react";
 import { motion } from "framer-motion";
 import { Button } from "@/components/ui/button";
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card";
@@ -54,15 +54,28 @@ const PLACEHOLDER_HINTS: Record<string, string> = {
   action: "vd: xung phong, bày trận mai phục",
 };
 
-type ProgressResp = {
-  progress?: number;      // 0..1
+type JobResp = {
+  job_id: string;
+  status: "queued" | "running" | "done" | "failed" | "cancelled";
+  stage?: string;
   percent?: number;       // 0..100
-  eta_seconds?: number;   // remaining seconds
-  has_preview?: boolean;
-  preview_b64?: string;   // optional base64
+  error?: string | null;
+  result?: any;
+  result_url?: string | null;
 };
 
 const API_BASE = (import.meta as any).env?.VITE_API_BASE || "http://localhost:8001";
+// "sse": nhận tiến độ qua /events/{job_id}; "poll": hỏi /progress/{job_id} theo chu kỳ
+const PROGRESS_MODE: "sse" | "poll" = (import.meta as any).env?.VITE_PROGRESS_MODE === "poll" ? "poll" : "sse";
+const POLL_INTERVAL_MS = 700;
+
+const STAGE_LABELS: Record<string, string> = {
+  queued: "Đang chờ",
+  translating: "Đang dịch prompt",
+  generating: "Đang sinh ảnh",
+  encoding: "Đang đóng gói",
+  done: "Hoàn tất",
+};
 
 async function callNERAPI(text: string, style: string) {
   const r = await fetch(`${API_BASE}/ner`, {
@@ -94,26 +107,78 @@ async function callNERAPI(text: string, style: string) {
   return { fields: {}, scores: {} };
 }
 
-async function callImageAPI(prompt: string, signal?: AbortSignal): Promise<string> {
+function imageFromResult(data: any): string {
+  const b64 = data?.image_base64 || (Array.isArray(data?.images) ? data.images[0] : null);
+  const url = data?.image_url || data?.url || (Array.isArray(data?.images) ? data.images[0]?.url : null);
+  if (b64 && typeof b64 === "string") return b64.startsWith("data:image") ? b64 : `data:image/png;base64,${b64}`;
+  if (url) return url.startsWith("/") ? `${API_BASE}${url}` : url;
+  throw new Error("Phản hồi /generate không có ảnh.");
+}
+
+async function submitImageJob(prompt: string): Promise<JobResp> {
   const r = await fetch(`${API_BASE}/generate`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ prompt }),
-    signal,
+    body: JSON.stringify({ prompt, background: true, response_format: "json" }),
   });
   if (!r.ok) throw new Error(`Generate API lỗi (${r.status})`);
-  const data = await r.json();
-  const b64 = data.image_base64 || (Array.isArray(data.images) ? data.images[0] : null);
-  const url = data.image_url || data.url;
-  if (b64 && typeof b64 === "string") return b64.startsWith("data:image") ? b64 : `data:image/png;base64,${b64}`;
-  if (url) return url;
-  throw new Error("Phản hồi /generate không có ảnh.");
+  return (await r.json()) as JobResp;
+}
+
+function jobImage(job: JobResp): string {
+  if (job.status === "done") return imageFromResult(job.result);
+  if (job.status === "cancelled") {
+    const err = new Error("Đã hủy");
+    err.name = "AbortError";
+    throw err;
+  }
+  throw new Error(job.error || `Job ${job.status}`);
+}
+
+function waitJobSSE(jobId: string, onProgress: (job: JobResp) => void, signal: AbortSignal): Promise<string> {
+  return new Promise((resolve, reject) => {
+    const es = new EventSource(`${API_BASE}/events/${jobId}`);
+    const finish = (fn: () => void) => {
+      es.close();
+      signal.removeEventListener("abort", onAbort);
+      fn();
+    };
+    const onAbort = () => finish(() => reject(Object.assign(new Error("Đã hủy"), { name: "AbortError" })));
+    signal.addEventListener("abort", onAbort);
+
+    es.addEventListener("progress", (ev) => onProgress(JSON.parse((ev as MessageEvent).data)));
+    es.addEventListener("result", (ev) => {
+      const job = JSON.parse((ev as MessageEvent).data) as JobResp;
+      onProgress(job);
+      finish(() => {
+        try { resolve(jobImage(job)); } catch (e) { reject(e); }
+      });
+    });
+    es.addEventListener("failed", (ev) => {
+      const job = JSON.parse((ev as MessageEvent).data) as JobResp;
+      finish(() => {
+        try { resolve(jobImage(job)); } catch (e) { reject(e); }
+      });
+    });
+    // Mất kết nối SSE hẳn (proxy chặn...) -> chuyển sang poll
+    es.onerror = () => {
+      if (es.readyState === EventSource.CLOSED) {
+        finish(() => waitJobPoll(jobId, onProgress, signal).then(resolve, reject));
+      }
+    };
+  });
 }
 
-async function callProgress(): Promise<ProgressResp> {
-  const r = await fetch(`${API_BASE}/progress`);
-  if (!r.ok) throw new Error(`Progress API lỗi (${r.status})`);
-  return (await r.json()) as ProgressResp;
+async function waitJobPoll(jobId: string, onProgress: (job: JobResp) => void, signal: AbortSignal): Promise<string> {
+  for (;;) {
+    if (signal.aborted) throw Object.assign(new Error("Đã hủy"), { name: "AbortError" });
+    const r = await fetch(`${API_BASE}/progress/${jobId}`, { signal });
+    if (!r.ok) throw new Error(`Progress API lỗi (${r.status})`);
+    const job = (await r.json()) as JobResp;
+    onProgress(job);
+    if (job.status === "done" || job.status === "failed" || job.status === "cancelled") return jobImage(job);
+    await new Promise((res) => window.setTimeout(res, POLL_INTERVAL_MS));
+  }
 }
 
 /** ------------ Component ------------ **/
@@ -122,6 +187,7 @@ export default function PromptToImage() {
   const [composeVietnamese, setComposeVietnamese] = useState(true);
 
   const controllerRef = useRef<AbortController | null>(null);
+  const jobIdRef = useRef<string | null>(null);
 
   const template = PROMPT_TEMPLATES[style];
   const placeholders = useMemo(() => extractPlaceholders(template), [template]);
@@ -140,8 +206,7 @@ export default function PromptToImage() {
 
   // progress states
   const [progressPct, setProgressPct] = useState(0);
-  const [eta, setEta] = useState<number | null>(null);
-  const [preview, setPreview] = useState<string | null>(null);
+  const [stage, setStage] = useState<string | null>(null);
 
   const handleChange = (name: string, val: string) => setValues((prev) => ({ ...prev, [name]: val }));
 
@@ -184,8 +249,7 @@ export default function PromptToImage() {
     setLoading(true);
     setImgUrl("");
     setProgressPct(0);
-    setEta(null);
-    setPreview(null);
+    setStage(null);
 
     try {
       let finalPrompt = "";
@@ -206,8 +270,15 @@ export default function PromptToImage() {
       }
 
       controllerRef.current = new AbortController();
+      const onProgress = (job: JobResp) => {
+        if (typeof job.percent === "number" && isFinite(job.percent)) setProgressPct(job.percent);
+        if (job.stage) setStage(job.stage);
+      };
       try {
-        const url = await callImageAPI(finalPrompt, controllerRef.current.signal);
+        const job = await submitImageJob(finalPrompt);
+        jobIdRef.current = job.job_id;
+        const wait = PROGRESS_MODE === "sse" && typeof EventSource !== "undefined" ? waitJobSSE : waitJobPoll;
+        const url = await wait(job.job_id, onProgress, controllerRef.current.signal);
         setImgUrl(url);
       } catch (e: any) {
         if (e?.name !== "AbortError") {
@@ -218,10 +289,10 @@ export default function PromptToImage() {
     } catch (e: any) {
       setError(e.message || String(e));
     } finally {
+      jobIdRef.current = null;
       setLoading(false);
       setProgressPct(0);
-      setEta(null);
-      setPreview(null);
+      setStage(null);
     }
   };
 
@@ -230,36 +301,6 @@ export default function PromptToImage() {
     if (p) await navigator.clipboard.writeText(p);
   };
 
-  // Poll progress khi loading
-  useEffect(() => {
-    if (!loading) return;
-
-    let timer: number | null = null;
-    const tick = async () => {
-      try {
-        const p = await callProgress();
-        const pct = typeof p.percent === "number" ? p.percent : (typeof p.progress === "number" ? p.progress * 100 : 0);
-        setProgressPct(isFinite(pct) ? pct : 0);
-        setEta(Number.isFinite(p.eta_seconds as number) ? (p.eta_seconds as number) : null);
-
-        if (p.has_preview && p.preview_b64) {
-          const prefixed = p.preview_b64.startsWith("data:image")
-            ? p.preview_b64
-            : `data:image/png;base64,${p.preview_b64}`;
-          setPreview(prefixed);
-        }
-      } catch {
-        // bỏ qua lỗi poll
-      }
-    };
-
-    tick();
-    timer = window.setInterval(tick, 700);
-    return () => {
-      if (timer) window.clearInterval(timer);
-    };
-  }, [loading]);
-
   const guidanceList = (
     <ul className="list-disc pl-5 space-y-1 text-sm text-stone-400">
       {REQUIRED_FIELDS[style].map((f) => (
@@ -427,7 +468,10 @@ export default function PromptToImage() {
                     variant="secondary"
                     onClick={async () => {
                       setError(null);
-                      try { await fetch(`${API_BASE}/interrupt`, { method: "POST" }); } catch {}
+                      const jobId = jobIdRef.current;
+                      if (jobId) {
+                        try { await fetch(`${API_BASE}/interrupt/${jobId}`, { method: "POST" }); } catch {}
+                      }
                       try { controllerRef.current?.abort(); } catch {}
                       setLoading(false);
                     }}
@@ -476,15 +520,8 @@ export default function PromptToImage() {
                   </div>
                   <div className="text-xs text-stone-400">
                     Tiến độ: <span className="text-amber-400 font-semibold">{progressPct.toFixed(1)}%</span>
-                    {eta !== null && <> • Ước còn <span className="text-amber-400 font-semibold">{eta}s</span></>}
+                    {stage && <> • <span className="text-amber-400 font-semibold">{STAGE_LABELS[stage] || stage}</span></>}
                   </div>
-                  {preview && (
-                    <img
-                      src={preview}
-                      alt="Xem trước"
-                      className="w-full rounded-xl border border-amber-700"
-                    />
-                  )}
                 </div>
               )}
 
@@ -1,7 +1,103 @@
 import os
 import re
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from src.main.parallel import ordered_map
+
+# Chữ cái tiếng Việt (dùng trong các pattern nối từ)
+_VI_UPPER = 'A-ZÁÀẢÃẠĂẰẮẲẴẶÂẦẤẨẪẬÈÉẸẺẼÊỀẾỆỂỄÌÍỊỈĨÒÓỌỎÕÔỒỐỘỔỖƠỜỚỢỞỠÙÚỤỦŨƯỪỨỰỬỮỲÝỴỶỸĐ'
+_VI_LOWER = 'a-záàảãạăằắẳẵặâầấẩẫậèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ'
+
+# Pattern biên dịch một lần ở mức module; với văn bản tiếng Việt (không phải ASCII) re.sub của một lớp
+# ký tự nhanh hơn str.translate với bảng dict nên các bước xoá ký tự vẫn dùng regex.
+RE_CTRL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# Ký tự bị loại ở bước lọc ký tự; mọi ký tự bullet (•◆►★...) cũng nằm trong lớp này
+# nên bước xoá bullet riêng của bản gốc được gộp vào đây.
+RE_DROP_CHAR = re.compile(r'[^\w\s.,!?;:\-\(\)\'\"–—\nàáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễ'
+                          r'ìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ'
+                          r'ÀÁẠẢÃÂẦẤẬẨẪĂẰẮẶẲẴÈÉẸẺẼÊỀẾỆỂỄ'
+                          r'ÌÍỊỈĨÒÓỌỎÕÔỒỐỘỔỖƠỜỚỢỞỠÙÚỤỦŨƯỪỨỰỬỮ'
+                          r'ỲÝỴỶỸĐ\[\]/]')
+RE_HYPHEN_BREAK = re.compile(r'(\S)-\s*\n\s*(\S)')
+RE_PAGE_MARK = re.compile(r'---\s*Trang\s*\d+\s*---', re.IGNORECASE)
+RE_PAGE_MARK_BROKEN = re.compile(r'---\s*trang\s*\d+\s*--\d*', re.IGNORECASE)
+RE_NAME_BREAK = re.compile(rf'([{_VI_UPPER}][{_VI_LOWER}]+)\s*\n\s*([{_VI_UPPER}][{_VI_LOWER}]+)')
+RE_YEAR_RANGE = re.compile(r'(\d{4})\s*-\s*(\d{4})')
+RE_PAGE_NUMBER_LINE = re.compile(r'^\s*\d{1,3}\s*$', re.MULTILINE)
+RE_ROMAN_LINE = re.compile(r'^\s*[IVXLCDM]{1,4}\s*$', re.MULTILINE)
+# [ \t]+ -> ' ' ; chỉ khớp run cần đổi, run đúng một dấu cách giữ nguyên
+RE_HSPACE = re.compile(r' [ \t]+|\t[ \t]*')
+RE_MULTI_NEWLINE = re.compile(r'\n{3,}')
+RE_SOFT_NEWLINE = re.compile(r'(?<![.?!:])\n(?!\n)')
+RE_PUNCT_GLUED = re.compile(r'([.,!?;:])(\w)')
+RE_SPACE_BEFORE_PUNCT_W = re.compile(r'(\w)\s+([.,!?;:])')
+RE_SPLIT_LETTERS = re.compile(rf'\b([{_VI_LOWER}])\s+([{_VI_LOWER}])\b')
+RE_SPACE_BEFORE_PUNCT = re.compile(r'\s+([.,!?;:])')
+# ([.,!?;:])\s+ -> '\1 ' ; bỏ qua trường hợp đã đúng một dấu cách
+RE_SPACE_AFTER_PUNCT = re.compile(r'([.,!?;:])(?: \s+|[^\S ]\s*)')
+RE_SPACES = re.compile(r' {2,}')
+
+# Điểm cắt chunk: [.?!] + khoảng trắng có dòng trống + chữ cái đầu đoạn (không phải dòng số La Mã).
+# Bước '([.,!?;:])\s+' -> '\1 ' luôn gộp khoảng trắng này thành một dấu cách và không pattern nào
+# khớp vắt qua nó, nên clean(A + W + B) == clean(A) + ' ' + clean(B).
+RE_CHUNK_BOUNDARY = re.compile(r'(?<=[.?!])[^\S\n]*\n[^\S\n]*\n\s*(?=[^\W\d_])(?![IVXLCDM]{1,4}(?![^\W\d_]))')
 
 def clean_text(text):
+    text = RE_CTRL.sub('', text)
+
+    text = RE_HYPHEN_BREAK.sub(r'\1\2', text)
+
+    text = RE_PAGE_MARK.sub('', text)
+    text = RE_PAGE_MARK_BROKEN.sub('', text)
+
+    text = RE_NAME_BREAK.sub(r'\1 \2', text)
+
+    text = RE_YEAR_RANGE.sub(r'\1-\2', text)
+
+    text = RE_PAGE_NUMBER_LINE.sub('', text)
+    text = RE_ROMAN_LINE.sub('', text)
+
+    text = RE_HSPACE.sub(' ', text)
+    text = RE_MULTI_NEWLINE.sub('\n\n', text)
+
+    text = RE_DROP_CHAR.sub('', text)
+
+    text = RE_SOFT_NEWLINE.sub(' ', text)
+
+    text = RE_PUNCT_GLUED.sub(r'\1 \2', text)
+    text = RE_SPACE_BEFORE_PUNCT_W.sub(r'\1\2', text)
+
+    text = RE_SPLIT_LETTERS.sub(r'\1\2', text)
+
+    text = RE_SPACE_BEFORE_PUNCT.sub(r'\1', text)
+    text = RE_SPACE_AFTER_PUNCT.sub(r'\1 ', text)
+
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    text = '\n'.join(lines)
+
+    text = text.lower()
+
+    text = RE_SPACES.sub(' ', text)
+
+    return text.strip()
+
+def split_chunks(text, chunk_chars):
+    """Cắt text (đã xoá ký tự điều khiển) tại RE_CHUNK_BOUNDARY, mỗi chunk khoảng >= chunk_chars ký tự."""
+    chunks, start = [], 0
+    if chunk_chars <= 0 or len(text) <= chunk_chars:
+        return [text]
+    for m in RE_CHUNK_BOUNDARY.finditer(text, chunk_chars):
+        if m.start() - start >= chunk_chars:
+            chunks.append(text[start:m.start()])
+            start = m.end()
+    chunks.append(text[start:])
+    return chunks
+
+def _clean_text_reference(text):
+    """Bản gốc (~20 lượt re.sub trên cả chuỗi), giữ nguyên để --verify so byte-by-byte."""
     text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', text)
     
     text = re.sub(r'(\S)-\s*\n\s*(\S)', r'\1\2', text)
@@ -46,22 +142,77 @@ def clean_text(text):
     
     return text.strip()
 
-def process_all_texts(input_folder, output_folder):
-    os.makedirs(output_folder, exist_ok=True)
-    for filename in os.listdir(input_folder):
-        if filename.endswith('.txt'):
-            input_path = os.path.join(input_folder, filename)
-            output_path = os.path.join(output_folder, f'cleaned_{filename}')
-            
-            with open(input_path, 'r', encoding='utf-8', errors='replace') as f:
-                raw_text = f.read()
-            
-            cleaned_text = clean_text(raw_text)
-            
+def _read(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+def _iter_chunks(files, chunk_chars):
+    for idx, (_, input_path, _) in enumerate(files):
+        chunks = split_chunks(RE_CTRL.sub('', _read(input_path)), chunk_chars)
+        for i, chunk in enumerate(chunks):
+            yield idx, i == len(chunks) - 1, chunk
+
+def _clean_task(idx, last, chunk):
+    return idx, last, clean_text(chunk)
+
+def process_all_texts(input_folder, output_folder, workers=None, chunk_chars=1_000_000, verify=False):
+    if not verify:
+        os.makedirs(output_folder, exist_ok=True)
+    files = [
+        (filename, os.path.join(input_folder, filename), os.path.join(output_folder, f'cleaned_{filename}'))
+        for filename in os.listdir(input_folder) if filename.endswith('.txt')
+    ]
+    workers = max(1, workers or os.cpu_count() or 1)
+    t0 = time.time()
+    parts, n_chars, mismatches = [], 0, 0
+
+    # Chunk của mọi file đi qua cùng một pool; kết quả về đúng thứ tự nên ghép lại theo file
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for idx, last, cleaned in ordered_map(ex, _clean_task, _iter_chunks(files, chunk_chars), workers * 4):
+            parts.append(cleaned)
+            if not last:
+                continue
+            filename, input_path, output_path = files[idx]
+            cleaned_text = ' '.join(parts)
+            parts = []
+            if verify:
+                raw_text = _read(input_path)
+                n_chars += len(raw_text)
+                expected = _clean_text_reference(raw_text)
+                if cleaned_text == expected:
+                    print(f'OK: {filename}')
+                else:
+                    mismatches += 1
+                    pos = next((i for i, (a, b) in enumerate(zip(cleaned_text, expected)) if a != b),
+                               min(len(cleaned_text), len(expected)))
+                    print(f'MISMATCH: {filename} at char {pos}: '
+                          f'{cleaned_text[pos:pos + 40]!r} != {expected[pos:pos + 40]!r}')
+                continue
+
+            n_chars += len(cleaned_text)
             with open(output_path, 'w', encoding='utf-8') as f:
                 f.write(cleaned_text)
-            
+
             print(f'Done: {filename}')
 
+    print(f'{len(files)} file(s), {n_chars} chars, {time.time() - t0:.1f}s')
+    return mismatches
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--input_folder', default='book_data/not_clean')
+    ap.add_argument('--output_folder', default='book_data/cleaned')
+    ap.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--chunk_chars', type=int, default=1_000_000,
+                    help='Kích thước chunk xấp xỉ (cắt tại cuối đoạn); 0 = không chia file')
+    ap.add_argument('--verify', action='store_true',
+                    help='Không ghi file; so kết quả với bản gốc _clean_text_reference, exit 1 nếu khác')
+    args = ap.parse_args()
+
+    mismatches = process_all_texts(args.input_folder, args.output_folder, args.workers, args.chunk_chars, args.verify)
+    if args.verify:
+        print('Golden check passed' if not mismatches else f'Golden check FAILED: {mismatches} file(s)')
+        sys.exit(1 if mismatches else 0)
+
 if __name__ == '__main__':
-    process_all_texts('book_data/not_clean', 'book_data/cleaned')
\ No newline at end of file
+    main()
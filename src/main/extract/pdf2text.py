@@ -1,16 +1,30 @@
 import os
+import argparse
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
 import fitz
-import easyocr
 import numpy as np
-from pdf2image import convert_from_path
-from pathlib import Path
+
+from src.main.parallel import ordered_map
 
 PDF_DIR = Path("book_data/pdf_files")
 OUTPUT_DIR = Path("book_data/not_clean")
+OCR_CACHE_DIR = Path("book_data/ocr_cache")
 
 PDF_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# Trang có ít hơn ngưỡng ký tự chữ/số trong text layer -> coi như trang scan, đưa qua OCR
+MIN_TEXT_CHARS = 20
+OCR_DPI = 300
+OCR_LANGS = ["vi"]
+# Như bản gốc (extract_text_easyocr(max_pages=150)): chỉ OCR 150 trang đầu mỗi file; 0 = không giới hạn
+MAX_OCR_PAGES = 150
+
 # Check
 def check_file_access(pdf_path: Path):
     if not pdf_path.exists():
@@ -21,64 +35,299 @@ def check_file_access(pdf_path: Path):
         return False
     return True
 
-# PyMuPDF (fitz)
-def extract_text_pymupdf(pdf_path: Path, output_path: Path):
+# Text layer (PyMuPDF)
+def text_layer_usable(text: str, min_chars: int = MIN_TEXT_CHARS) -> bool:
+    """Text layer dùng được: đủ ký tự chữ/số và không phải rác do font lỗi (chủ yếu ký tự lạ)."""
+    alnum = sum(ch.isalnum() for ch in text)
+    visible = sum(not ch.isspace() for ch in text)
+    return alnum >= min_chars and alnum >= 0.5 * visible
+
+# EasyOCR (một Reader cho mỗi worker process, tạo khi gặp trang scan đầu tiên, dùng lại cho mọi file)
+_READER = None
+
+def _get_reader(langs, torch_threads: int = 0):
+    global _READER
+    if _READER is None:
+        import easyocr  # import lười: file toàn text layer không phải nạp torch
+        if torch_threads:
+            # Mỗi worker mặc định dùng hết core -> N worker tranh nhau N*core thread
+            import torch
+            torch.set_num_threads(torch_threads)
+        _READER = easyocr.Reader(langs, gpu=False)
+    return _READER
+
+def ocr_engine_key(langs) -> str:
+    """Đổi engine/phiên bản/ngôn ngữ -> đổi khoá cache (không dùng nhầm kết quả cũ)."""
     try:
-        doc = fitz.open(pdf_path)
-        full_text = ""
+        from importlib.metadata import version
+        ver = version("easyocr")
+    except Exception:
+        ver = "unknown"
+    return f"easyocr{ver}-{'+'.join(langs)}"
 
-        for i, page in enumerate(doc, start=1):
-            text = page.get_text().strip()
-            if text:
-                full_text += f"\n--- Trang {i} ---\n{text}\n"
+def render_page(page, dpi: int):
+    pix = page.get_pixmap(dpi=dpi)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
 
-        if full_text:
-            output_path.write_text(full_text, encoding="utf-8")
-            print(f"PyMuPDF done: {pdf_path.name}")
-            return True
-        return False
-    except Exception as e:
-        print(f"PyMuPDF error {pdf_path.name}: {e}")
-        return False
+def ocr_images(imgs, langs, torch_threads: int = 0) -> list:
+    """Nhiều ảnh cùng kích thước -> readtext_batched (một lượt detector), một ảnh -> readtext."""
+    reader = _get_reader(langs, torch_threads)
+    if len(imgs) == 1:
+        return ["\n".join(reader.readtext(imgs[0], detail=0, paragraph=True))]
+    return ["\n".join(r) for r in reader.readtext_batched(imgs, detail=0, paragraph=True)]
+
+def file_sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class OcrPageCache:
+    """root/ab/<pdf sha256>/p<page>-<dpi>dpi-<engine>.txt ; ghi atomically (tmp + replace)."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, pdf_hash: str, page_no: int, dpi: int, engine: str) -> Path:
+        return self.root / pdf_hash[:2] / pdf_hash / f"p{page_no:05d}-{dpi}dpi-{engine}.txt"
+
+    def get(self, pdf_hash: str, page_no: int, dpi: int, engine: str):
+        p = self.path(pdf_hash, page_no, dpi, engine)
+        return p.read_text(encoding="utf-8") if p.exists() else None
+
+    def put(self, pdf_hash: str, page_no: int, dpi: int, engine: str, text: str) -> None:
+        p = self.path(pdf_hash, page_no, dpi, engine)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(p.suffix + f".tmp{os.getpid()}")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, p)
 
-# EasyOCR
-def extract_text_easyocr(pdf_path: Path, output_path: Path, max_pages: int = 3):
+def _err(e: BaseException) -> str:
+    return f"{type(e).__name__}: {e}"
+
+def _ocr_batches(doc, page_idx, dpi: int, batch_size: int, page_errors: dict):
+    """Render từng trang một; gom tối đa batch_size trang liên tiếp cùng kích thước thành một batch."""
+    batch, nos = [], []
+    for i in page_idx:
+        try:
+            img = render_page(doc[i], dpi)
+        except Exception as e:
+            page_errors[i + 1] = _err(e)
+            continue
+        if batch and (len(batch) >= batch_size or img.shape != batch[0].shape):
+            yield nos, batch
+            batch, nos = [], []
+        batch.append(img)
+        nos.append(i + 1)
+    if batch:
+        yield nos, batch
+
+# Worker: xử lý một dải trang [start, end) của một file
+def extract_shard(pdf_path: str, pdf_hash: str, start: int, end: int, opts: dict) -> dict:
+    """
+    Lỗi ở một trang (text layer / render / OCR) chỉ bỏ trang đó (page_errors);
+    error chỉ dành cho lỗi cả shard (vd. không mở được file).
+    """
+    texts, todo, page_errors, error = {}, [], {}, None
+    n_text = n_ocr = n_cached = n_capped = 0
+    dpi, langs, engine, threads = opts["dpi"], opts["langs"], opts["engine"], opts["torch_threads"]
+    max_ocr = opts["max_ocr_pages"]
+    cache = OcrPageCache(opts["cache_dir"]) if opts.get("cache_dir") else None
     try:
-        pages = convert_from_path(str(pdf_path), dpi=300, first_page=1, last_page=max_pages)
-        reader = easyocr.Reader(['vi'], gpu=False)
-
-        all_text = ""
-        for i, page in enumerate(pages, start=1):
-            img_array = np.array(page)
-            result = reader.readtext(img_array, detail=0, paragraph=True)
-            page_text = "\n".join(result)
-            all_text += f"\n--- Trang {i} ---\n{page_text}\n"
-
-        output_path.write_text(all_text, encoding="utf-8")
-        print(f"EasyOCR done: {pdf_path.name}")
-        return True
+        with fitz.open(pdf_path) as doc:
+            for i in range(start, end):
+                try:
+                    text = doc[i].get_text().strip()
+                except Exception as e:
+                    page_errors[i + 1] = _err(e)
+                    continue
+                if text_layer_usable(text, opts["min_chars"]):
+                    texts[i + 1] = text
+                    n_text += 1
+                    continue
+                if max_ocr and i >= max_ocr:
+                    n_capped += 1
+                    continue
+                n_ocr += 1
+                cached = cache.get(pdf_hash, i + 1, dpi, engine) if cache else None
+                if cached is not None:
+                    texts[i + 1] = cached
+                    n_cached += 1
+                else:
+                    todo.append(i)
+
+            # Trang cần OCR: kết quả ghi cache ngay sau mỗi batch -> crash giữa chừng vẫn giữ tiến độ
+            for nos, imgs in _ocr_batches(doc, todo, dpi, max(1, opts["ocr_batch"]), page_errors):
+                try:
+                    results = ocr_images(imgs, langs, threads)
+                except Exception as e:
+                    if len(imgs) == 1:
+                        page_errors[nos[0]] = _err(e)
+                        continue
+                    # Batch lỗi -> OCR lại từng trang để chỉ bỏ đúng trang hỏng
+                    results = []
+                    for page_no, img in zip(nos, imgs):
+                        try:
+                            results.append(ocr_images([img], langs, threads)[0])
+                        except Exception as e1:
+                            page_errors[page_no] = _err(e1)
+                            results.append(None)
+                for page_no, text in zip(nos, results):
+                    if text is None:
+                        continue
+                    text = text.strip()
+                    texts[page_no] = text
+                    if cache:
+                        cache.put(pdf_hash, page_no, dpi, engine, text)
     except Exception as e:
-        print(f"EasyOCR error {pdf_path.name}: {e}")
-        return False
+        error = _err(e)
+    pages = sorted(texts.items())
+    return {"pdf": pdf_path, "start": start, "end": end, "pages": pages, "text": n_text,
+            "ocr": n_ocr, "cached": n_cached, "capped": n_capped,
+            "page_errors": sorted(page_errors.items()), "error": error}
+
+def page_ranges(n_pages: int, pages_per_shard: int):
+    for start in range(0, n_pages, pages_per_shard):
+        yield start, min(start + pages_per_shard, n_pages)
 
 def main():
-    pdf_files = list(PDF_DIR.glob("*.pdf"))
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pdf_dir", default=str(PDF_DIR))
+    ap.add_argument("--out_dir", default=str(OUTPUT_DIR))
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--pages_per_shard", type=int, default=16, help="Số trang mỗi task gửi cho worker")
+    ap.add_argument("--min_text_chars", type=int, default=MIN_TEXT_CHARS,
+                    help="Text layer ít ký tự chữ/số hơn ngưỡng này thì OCR trang đó")
+    ap.add_argument("--dpi", type=int, default=OCR_DPI, help="DPI render trang khi OCR")
+    ap.add_argument("--langs", default=",".join(OCR_LANGS), help="Ngôn ngữ EasyOCR, vd 'vi,en'")
+    ap.add_argument("--ocr_batch", type=int, default=4, help="Số trang cùng kích thước mỗi lần readtext_batched")
+    ap.add_argument("--max_ocr_pages", type=int, default=MAX_OCR_PAGES,
+                    help="Chỉ OCR các trang scan trong N trang đầu mỗi file (0 = không giới hạn)")
+    ap.add_argument("--torch_threads", type=int, default=None,
+                    help="Số thread torch mỗi worker (mặc định: số core / số worker)")
+    ap.add_argument("--ocr_cache", default=str(OCR_CACHE_DIR), help="Thư mục cache kết quả OCR theo trang")
+    ap.add_argument("--no_ocr_cache", action="store_true", help="Không đọc/ghi cache OCR")
+    ap.add_argument("--skip_done", action="store_true", help="Bỏ qua file đã có <out_dir>/<tên>.txt")
+    args = ap.parse_args()
+
+    pdf_dir, out_dir = Path(args.pdf_dir), Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    langs = [s.strip() for s in args.langs.split(",") if s.strip()]
+    pdf_files = sorted(pdf_dir.glob("*.pdf"))
 
     if not pdf_files:
-        print(f"Cannot find pdf: {PDF_DIR}")
+        print(f"Cannot find pdf: {pdf_dir}")
         return
 
+    # Đếm trang trước (rẻ) để chia shard; task sinh lần lượt theo file -> kết quả về theo file, theo trang
+    jobs = []
     for pdf_path in pdf_files:
-        output_path = OUTPUT_DIR / f"{pdf_path.stem}.txt"
-
         if not check_file_access(pdf_path):
             continue
+        if args.skip_done and (out_dir / f"{pdf_path.stem}.txt").exists():
+            print(f"Skip (done): {pdf_path.name}")
+            continue
+        try:
+            with fitz.open(pdf_path) as doc:
+                n_pages = doc.page_count
+        except Exception as e:
+            print(f"PyMuPDF error {pdf_path.name}: {e}")
+            continue
+        if n_pages:
+            jobs.append((pdf_path, n_pages))
+
+    workers = max(1, args.workers)
+    opts = {
+        "min_chars": args.min_text_chars,
+        "dpi": args.dpi,
+        "langs": langs,
+        "engine": ocr_engine_key(langs),
+        "ocr_batch": args.ocr_batch,
+        "max_ocr_pages": max(0, args.max_ocr_pages),
+        "torch_threads": args.torch_threads if args.torch_threads is not None
+                         else max(1, (os.cpu_count() or 1) // workers),
+        "cache_dir": None if args.no_ocr_cache else args.ocr_cache,
+    }
+
+    shards = [(pdf_path, start, end) for pdf_path, n_pages in jobs
+              for start, end in page_ranges(n_pages, max(1, args.pages_per_shard))]
+    hashes = {}
+
+    def task(k):
+        pdf_path, start, end = shards[k]
+        # Hash từng file khi tới lượt (không đọc cả kho trước khi bắt đầu)
+        if pdf_path not in hashes:
+            hashes[pdf_path] = file_sha256(pdf_path) if opts["cache_dir"] else ""
+        return str(pdf_path), hashes[pdf_path], start, end, opts
+
+    t0 = time.time()
+    cur = out = tmp = None
+    n_text = n_ocr = n_cached = n_capped = n_bad = 0
+    failed = False
+
+    def finish():
+        out.close()
+        if failed:
+            tmp.unlink(missing_ok=True)
+            print(f"Cannot extract text: {cur.name}")
+        else:
+            os.replace(tmp, out_dir / f"{cur.stem}.txt")
+            print(f"Done: {cur.name} (text layer={n_text}, OCR={n_ocr}, OCR from cache={n_cached}"
+                  + (f", over max_ocr_pages={n_capped}" if n_capped else "")
+                  + (f", page errors={n_bad}" if n_bad else "") + ")")
+
+    def handle(res):
+        nonlocal cur, out, tmp, n_text, n_ocr, n_cached, n_capped, n_bad, failed
+        pdf_path = Path(res["pdf"])
+        if pdf_path != cur:
+            if cur is not None:
+                finish()
+            cur, failed = pdf_path, False
+            n_text = n_ocr = n_cached = n_capped = n_bad = 0
+            tmp = out_dir / f"{pdf_path.stem}.txt.part"
+            out = open(tmp, "w", encoding="utf-8")
+            print(f"In process: {pdf_path.name}")
+        if failed:
+            return
+        if res["error"]:
+            print(f"Extract error {pdf_path.name} (pages {res['start'] + 1}-{res['end']}): {res['error']}")
+            failed = True
+            return
+        for page_no, err in res["page_errors"]:
+            print(f"Page error {pdf_path.name} p{page_no}: {err} (skipped)")
+        n_text += res["text"]
+        n_ocr += res["ocr"]
+        n_cached += res["cached"]
+        n_capped += res["capped"]
+        n_bad += len(res["page_errors"])
+        for page_no, text in res["pages"]:
+            if text:
+                out.write(f"\n--- Trang {page_no} ---\n{text}\n")
+
+    # Worker chết hẳn (segfault/OOM trong OCR) làm hỏng cả pool: dựng pool mới, chạy riêng shard
+    # đứng đầu hàng đợi để biết có phải nó gây lỗi không, rồi tiếp tục từ shard sau
+    done = 0
+    while done < len(shards):
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                for res in ordered_map(ex, extract_shard, (task(k) for k in range(done, len(shards))),
+                                       window=workers * 4):
+                    done += 1
+                    handle(res)
+        except BrokenProcessPool:
+            pdf_path, start, end = shards[done]
+            try:
+                with ProcessPoolExecutor(max_workers=1) as ex:
+                    res = ex.submit(extract_shard, *task(done)).result()
+            except BrokenProcessPool as e:
+                res = {"pdf": str(pdf_path), "start": start, "end": end, "error": f"worker crashed ({e})"}
+            done += 1
+            handle(res)
+    if cur is not None:
+        finish()
 
-        print(f"In process: {pdf_path.name}")
-        if not extract_text_pymupdf(pdf_path, output_path):
-            print(f"Use OCR: {pdf_path.name}")
-            if not extract_text_easyocr(pdf_path, output_path, max_pages= 150):
-                print(f"Cannot extract text: {pdf_path.name}")
+    print(f"Finished {len(jobs)} file(s) in {time.time() - t0:.1f}s")
 
 if __name__ == "__main__":
     main()
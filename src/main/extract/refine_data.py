@@ -1,50 +1,189 @@
 import os
 import re
+import time
+import sqlite3
+import hashlib
+import argparse
 from pathlib import Path
 from underthesea import sent_tokenize, word_tokenize
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.main.parallel import ordered_map
 
 RE_METADATA = re.compile(r'\[.*?\]')
 RE_SINGLE_CHAR = re.compile(r'\b([a-zA-ZÀ-ỹ])\s(?=[a-zA-ZÀ-ỹ]\b)')
 
-def process_single_file(input_file: Path, output_folder: Path):
+# Chỉ cắt chunk sau dòng kết thúc bằng dấu câu cuối câu: không câu nào bị chia đôi,
+# RE_SINGLE_CHAR (cần chữ cái trước khoảng trắng) và RE_METADATA (trong một dòng) không khớp vắt qua điểm cắt.
+# Không có '…': sent_tokenize không kết thúc câu ở dấu ba chấm.
+SENTENCE_END = ('.', '?', '!', '."', '?"', '!"')
+
+def tokenizer_version() -> str:
     try:
-        content = input_file.read_text(encoding='utf-8')
-
-        content = RE_METADATA.sub('', content)
-        
-        content = RE_SINGLE_CHAR.sub(r'\1', content)
-
-        sentences = sent_tokenize(content)
-        
-        final_processed_lines = []
-        
-        for sentence in sentences:
-            cleaned_sentence = sentence.strip()
-            if not cleaned_sentence:
-                continue
-            
-            tokens = word_tokenize(cleaned_sentence)
-            
-            processed_tokens = [token.replace('_', ' ') for token in tokens]
-            
-            final_line = ' '.join(processed_tokens)
-            final_processed_lines.append(final_line)
-
-        # output_filename = f"final_{input_file.name.replace('cleaned_', '')}"
-        output_filename = f"{input_file.name}"
-        output_path = output_folder / output_filename
-        
-        output_path.write_text('\n'.join(final_processed_lines), encoding='utf-8')
-        
-        return input_file.name
-
-    except Exception as e:
-        print(f"Error '{input_file.name}': {e}")
-        return None
-
-def main_parallel_processing(input_folder: str, output_folder: str, max_workers: int = None):
+        from importlib.metadata import version
+        return f"underthesea-{version('underthesea')}"
+    except Exception:
+        return "underthesea-unknown"
+
+class TokenCache:
+    """
+    Memo word_tokenize trong SQLite (WAL, mỗi worker process một connection):
+    khoá (blake2b câu, phiên bản tokenizer) -> dòng đã tách từ + thời gian tokenize lúc tạo (để tính thời gian tiết kiệm).
+    """
+
+    _BATCH = 500  # số tham số mỗi câu SELECT ... IN (...)
+
+    def __init__(self, db_path: str, version: str):
+        self.version = version
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._db = sqlite3.connect(db_path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            " hash BLOB NOT NULL, version TEXT NOT NULL, line TEXT NOT NULL, cost REAL NOT NULL,"
+            " PRIMARY KEY (hash, version)) WITHOUT ROWID"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(sentence: str) -> bytes:
+        return hashlib.blake2b(sentence.encode('utf-8'), digest_size=16).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Tuple[str, float]]:
+        found = {}
+        uniq = list(dict.fromkeys(keys))
+        for i in range(0, len(uniq), self._BATCH):
+            part = uniq[i:i + self._BATCH]
+            rows = self._db.execute(
+                f"SELECT hash, line, cost FROM tokens WHERE version = ? AND hash IN ({','.join('?' * len(part))})",
+                (self.version, *part),
+            )
+            for h, line, cost in rows:
+                found[h] = (line, cost)
+        return found
+
+    def put_many(self, rows: List[Tuple[bytes, str, float]]) -> None:
+        if not rows:
+            return
+        # Một transaction cho cả chunk; worker khác ghi cùng câu thì giữ bản đã có
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO tokens (hash, version, line, cost) VALUES (?, ?, ?, ?)",
+                [(h, self.version, line, cost) for h, line, cost in rows],
+            )
+
+_TOKEN_CACHE: Optional[TokenCache] = None
+
+def _init_worker(cache_path: Optional[str], version: str):
+    global _TOKEN_CACHE
+    _TOKEN_CACHE = TokenCache(cache_path, version) if cache_path else None
+
+def _tokenize_line(sentence: str) -> str:
+    tokens = word_tokenize(sentence)
+
+    processed_tokens = [token.replace('_', ' ') for token in tokens]
+
+    return ' '.join(processed_tokens)
+
+def _prepare(content: str) -> str:
+    content = RE_METADATA.sub('', content)
+
+    return RE_SINGLE_CHAR.sub(r'\1', content)
+
+def _cut_ok(prev_line: str, next_line: str) -> bool:
+    """sent_tokenize thật sự kết thúc câu giữa hai dòng: tách chung == tách riêng từng dòng."""
+    a, b = _prepare(prev_line), _prepare(next_line)
+    joined = [s.strip() for s in sent_tokenize(a + b)]
+    apart = [s.strip() for s in sent_tokenize(a) + sent_tokenize(b)]
+    return [s for s in joined if s] == [s for s in apart if s]
+
+def refine_text(content: str, cache: Optional[TokenCache] = None) -> Tuple[List[str], int, Dict[str, float]]:
+    """Làm sạch + tách câu + tách từ một đoạn văn bản; trả về (các dòng output, số câu, thống kê cache)."""
+    content = _prepare(content)
+
+    sentences = sent_tokenize(content)
+
+    cleaned = [s.strip() for s in sentences]
+    cleaned = [s for s in cleaned if s]
+    stats = {"hits": 0, "misses": 0, "saved_s": 0.0, "tokenize_s": 0.0}
+
+    if cache is None:
+        t0 = time.perf_counter()
+        final_processed_lines = [_tokenize_line(s) for s in cleaned]
+        stats["misses"] = len(cleaned)
+        stats["tokenize_s"] = time.perf_counter() - t0
+        return final_processed_lines, len(sentences), stats
+
+    keys = [cache.key(s) for s in cleaned]
+    known = cache.get_many(keys)
+    final_processed_lines, new_rows = [], []
+    for sentence, k in zip(cleaned, keys):
+        hit = known.get(k)
+        if hit is not None:
+            final_processed_lines.append(hit[0])
+            stats["hits"] += 1
+            stats["saved_s"] += hit[1]
+            continue
+        t0 = time.perf_counter()
+        final_line = _tokenize_line(sentence)
+        cost = time.perf_counter() - t0
+        stats["misses"] += 1
+        stats["tokenize_s"] += cost
+        # câu lặp lại trong cùng chunk cũng chỉ tokenize một lần
+        known[k] = (final_line, cost)
+        new_rows.append((k, final_line, cost))
+        final_processed_lines.append(final_line)
+    cache.put_many(new_rows)
+
+    return final_processed_lines, len(sentences), stats
+
+def process_chunk(file_idx: int, last: bool, content: Optional[str], error: Optional[str]):
+    if error is None:
+        try:
+            lines, n_sentences, stats = refine_text(content, _TOKEN_CACHE)
+            return file_idx, last, lines, n_sentences, stats, None
+        except Exception as e:
+            error = str(e)
+    return file_idx, last, [], 0, None, error
+
+def iter_file_chunks(input_file: Path, chunk_chars: int) -> Iterator[str]:
+    """
+    Đọc file theo dòng, gom thành chunk >= chunk_chars ký tự, chỉ cắt ở cuối câu (không nạp cả file).
+    Dòng kết thúc bằng SENTENCE_END chỉ là ứng viên; cắt khi _cut_ok với dòng kế tiếp.
+    """
+    buf, size, emitted, candidate = [], 0, False, False
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if candidate and _cut_ok(buf[-1], line):
+                yield ''.join(buf)
+                buf, size, emitted = [], 0, True
+            buf.append(line)
+            size += len(line)
+            candidate = size >= chunk_chars and line.rstrip().endswith(SENTENCE_END)
+    if buf or not emitted:
+        yield ''.join(buf)
+
+def _iter_tasks(files: List[Path], chunk_chars: int):
+    """(file_idx, chunk cuối?, nội dung, lỗi) theo thứ tự file; lỗi đọc file -> một task lỗi kết thúc file đó."""
+    for idx, input_file in enumerate(files):
+        chunk = None
+        try:
+            for nxt in iter_file_chunks(input_file, chunk_chars):
+                if chunk is not None:
+                    yield idx, False, chunk, None
+                chunk = nxt
+        except Exception as e:
+            yield idx, True, None, str(e)
+            continue
+        yield idx, True, chunk, None
+
+def main_parallel_processing(input_folder: str, output_folder: str, max_workers: int = None,
+                             chunk_chars: int = 200_000, progress_every: float = 10.0,
+                             token_cache: Optional[str] = None):
     input_path = Path(input_folder)
     output_path = Path(output_folder)
 
@@ -54,26 +193,85 @@ def main_parallel_processing(input_folder: str, output_folder: str, max_workers:
         print(f"Could not find '{input_folder}'")
         return
 
-    files_to_process = list(input_path.glob('*.txt'))
-    
+    # File lớn nhất chạy trước: chunk của nó chia đều cho các worker, file nhỏ lấp chỗ trống ở cuối
+    files_to_process = sorted(input_path.glob('*.txt'), key=lambda p: p.stat().st_size, reverse=True)
+
     if not files_to_process:
         print(f"Could not find any .txt files in '{input_folder}'")
         return
 
     print(f"Found {len(files_to_process)} files to process.")
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(process_single_file, file_path, output_path) for file_path in files_to_process]
-        
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                print(f"Done: {result}")
+    workers = max_workers or os.cpu_count() or 1
+    t0 = last_report = time.time()
+    total_sentences = file_sentences = done = 0
+    out = tmp = None
+    failed = set()
+    cache_stats = {"hits": 0, "misses": 0, "saved_s": 0.0, "tokenize_s": 0.0}
+    version = tokenizer_version()
+    if token_cache:
+        TokenCache(token_cache, version)  # tạo bảng + bật WAL một lần trước khi các worker mở DB
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(token_cache, version)) as executor:
+        tasks = _iter_tasks(files_to_process, chunk_chars)
+        for file_idx, last, lines, n_sentences, stats, error in ordered_map(executor, process_chunk, tasks, workers * 4):
+            input_file = files_to_process[file_idx]
+            if error is not None and file_idx not in failed:
+                # Bỏ cả file (output cũ giữ nguyên), các file sau vẫn chạy
+                print(f"Error '{input_file.name}': {error}")
+                failed.add(file_idx)
+                if out is not None:
+                    out.close()
+                    tmp.unlink(missing_ok=True)
+                    out = None
+            if file_idx in failed:
+                continue
+            if out is None:
+                # Ghi ra file tạm rồi replace: input và output có thể là cùng thư mục
+                tmp = output_path / f"{input_file.name}.part"
+                out = open(tmp, 'w', encoding='utf-8')
+                file_sentences, first = 0, True
+            if lines:
+                out.write(('' if first else '\n') + '\n'.join(lines))
+                first = False
+            file_sentences += n_sentences
+            total_sentences += n_sentences
+            for k, v in stats.items():
+                cache_stats[k] += v
+
+            now = time.time()
+            if now - last_report >= progress_every:
+                print(f"  {total_sentences} sentences, {total_sentences / (now - t0):.0f} sent/s")
+                last_report = now
 
-    print(f"\nDone {len(files_to_process)} files.")
+            if last:
+                out.close()
+                out = None
+                os.replace(tmp, output_path / input_file.name)
+                done += 1
+                print(f"Done: {input_file.name} ({file_sentences} sentences)")
+
+    elapsed = time.time() - t0
+    print(f"\nDone {done}/{len(files_to_process)} files, {total_sentences} sentences "
+          f"in {elapsed:.1f}s ({total_sentences / elapsed if elapsed else 0:.0f} sent/s).")
+    looked_up = cache_stats["hits"] + cache_stats["misses"]
+    if token_cache and looked_up:
+        print(f"Token cache ({version}): hit rate {cache_stats['hits'] / looked_up:.1%} "
+              f"({cache_stats['hits']}/{looked_up}), word_tokenize {cache_stats['tokenize_s']:.1f}s, "
+              f"saved ~{cache_stats['saved_s']:.1f}s")
 
 if __name__ == '__main__':
-    input_directory = 'book_data/final_txt/Done'
-    output_directory = 'book_data/final_txt/Done'
-    
-    main_parallel_processing(input_directory, output_directory)
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--input_dir', default='book_data/final_txt/Done')
+    ap.add_argument('--output_dir', default='book_data/final_txt/Done')
+    ap.add_argument('--workers', type=int, default=None)
+    ap.add_argument('--chunk_chars', type=int, default=200_000,
+                    help='Kích thước chunk xấp xỉ gửi cho mỗi worker (cắt ở cuối câu)')
+    ap.add_argument('--progress_every', type=float, default=10.0, help='Số giây giữa hai lần in tiến độ')
+    ap.add_argument('--token_cache', default='book_data/cache/tokenize.sqlite3',
+                    help='SQLite memo word_tokenize (dùng lại giữa các lần chạy)')
+    ap.add_argument('--no_token_cache', action='store_true')
+    args = ap.parse_args()
+
+    main_parallel_processing(args.input_dir, args.output_dir, args.workers, args.chunk_chars, args.progress_every,
+                             None if args.no_token_cache else args.token_cache)
@@ -1,8 +1,241 @@
+import os
 import json
-from collections import defaultdict, Counter
-import re
+import time
+import hashlib
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
-def analyze_label_consistency(jsonl_file_path, show_examples=True, max_examples=5, output_file=None):
+from src.main.parallel import ordered_map
+
+# analyze_label_consistency chạy theo kiểu map-reduce trên file .jsonl lớn:
+#   - file được chia thành các dải byte (cắt ở đầu dòng), mỗi process quét một dải ra một LabelStats
+#   - LabelStats gộp được theo thứ tự file; chỉ giữ số đếm + tối đa max_examples vị trí (byte offset) mỗi
+#     (thực thể, nhãn), câu ví dụ được đọc lại bằng seek khi in báo cáo
+#   - --state: lưu LabelStats đã quét, lần sau chỉ quét phần mới nối thêm vào cuối file
+#   - báo cáo ghi thẳng ra file (tmp rồi replace), nội dung giống bản cũ
+#
+# Usage:
+# python -m src.main.nlp.check_label --input runs/preds_all.jsonl --output report.txt --state runs/preds_all.labelstats.json
+
+SHARD_BYTES = 64 << 20
+_HASH_BLOCK = 1 << 16
+STATE_VERSION = 1
+
+class LabelStats:
+    """Thống kê nhãn của một đoạn liên tiếp các dòng; merge() nối đoạn phía sau vào."""
+
+    def __init__(self, keep: int):
+        self.keep = keep                # số ví dụ giữ lại cho mỗi (thực thể, nhãn)
+        self.total_lines = 0
+        self.total_entities = 0
+        self.label_counts = {}          # nhãn -> số lần (thứ tự xuất hiện đầu tiên)
+        self.entities = {}              # thực thể (lower) -> {nhãn: [số lần, [(offset, dòng, start, end), ...]]}
+        self.error = None               # (số dòng đã đọc, thông báo lỗi JSON)
+
+    def add_line(self, offset: int, line: str) -> None:
+        self.total_lines += 1
+        data = json.loads(line)
+        text = data['text']
+        labels = data.get('label', [])
+
+        for start, end, label_name in labels:
+            entity_text = text[start:end].strip().lower()
+            self.label_counts[label_name] = self.label_counts.get(label_name, 0) + 1
+            self.total_entities += 1
+            occ = self.entities.setdefault(entity_text, {}).setdefault(label_name, [0, []])
+            occ[0] += 1
+            if len(occ[1]) < self.keep:
+                occ[1].append((offset, self.total_lines, start, end))
+
+    def merge(self, other: "LabelStats") -> None:
+        """other là đoạn ngay sau self trong file: số dòng của other được dời thêm self.total_lines."""
+        if self.error is not None:
+            return
+        shift = self.total_lines
+        if other.error is not None:
+            self.error = (other.error[0] + shift, other.error[1])
+        self.total_lines += other.total_lines
+        self.total_entities += other.total_entities
+        for label, n in other.label_counts.items():
+            self.label_counts[label] = self.label_counts.get(label, 0) + n
+        for entity, labels in other.entities.items():
+            mine = self.entities.setdefault(entity, {})
+            for label, (n, examples) in labels.items():
+                occ = mine.setdefault(label, [0, []])
+                occ[0] += n
+                room = self.keep - len(occ[1])
+                if room > 0:
+                    occ[1].extend((o, ln + shift, s, e) for o, ln, s, e in examples[:room])
+
+    def to_dict(self) -> dict:
+        return {"keep": self.keep, "total_lines": self.total_lines, "total_entities": self.total_entities,
+                "label_counts": self.label_counts, "entities": self.entities}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "LabelStats":
+        stats = cls(d["keep"])
+        stats.total_lines = d["total_lines"]
+        stats.total_entities = d["total_entities"]
+        stats.label_counts = d["label_counts"]
+        stats.entities = d["entities"]
+        return stats
+
+def scan_range(path: str, start: int, end: int, keep: int) -> LabelStats:
+    """Worker: quét các dòng bắt đầu trong [start, end) byte; dừng ở dòng JSON lỗi đầu tiên."""
+    stats = LabelStats(keep)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            raw = f.readline()
+            if not raw:
+                break
+            try:
+                stats.add_line(offset, raw.decode('utf-8'))
+            except json.JSONDecodeError as e:
+                stats.error = (stats.total_lines, str(e))
+                break
+            offset += len(raw)
+    return stats
+
+def line_ranges(path: str, start: int, end: int, shard_bytes: int):
+    """Chia [start, end) thành các dải ~shard_bytes, mỗi dải bắt đầu ở đầu một dòng."""
+    cuts = [start]
+    with open(path, 'rb') as f:
+        pos = start + shard_bytes
+        while pos < end:
+            f.seek(pos - 1)
+            f.readline()
+            cut = f.tell()
+            if cut >= end:
+                break
+            if cut > cuts[-1]:
+                cuts.append(cut)
+            pos = cut + shard_bytes
+    cuts.append(end)
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+def _complete_end(path: str, size: int) -> int:
+    """Byte ngay sau '\\n' cuối cùng: dòng cuối chưa có '\\n' có thể còn đang được ghi tiếp, không lưu vào state."""
+    with open(path, 'rb') as f:
+        pos = size
+        while pos > 0:
+            step = min(_HASH_BLOCK, pos)
+            f.seek(pos - step)
+            i = f.read(step).rfind(b'\n')
+            if i >= 0:
+                return pos - step + i + 1
+            pos -= step
+    return 0
+
+def _prefix_digest(path: str, end: int) -> str:
+    """Khối đầu + khối cuối của [0, end): đủ để nhận ra file bị sửa/ghi đè thay vì chỉ nối thêm."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        h.update(f.read(min(end, _HASH_BLOCK)))
+        f.seek(max(0, end - _HASH_BLOCK))
+        h.update(f.read(min(end, _HASH_BLOCK)))
+    return h.hexdigest()
+
+def load_state(state_file: str, path: str, keep: int, size: int):
+    if not state_file or not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if (state.get("version") != STATE_VERSION or state.get("input") != os.path.abspath(path)
+            or state["stats"]["keep"] < keep or state["end"] > size
+            or state["digest"] != _prefix_digest(path, state["end"])):
+        print(f"State '{state_file}' không khớp với file hiện tại, quét lại từ đầu.")
+        return None
+    return state
+
+def save_state(state_file: str, path: str, end: int, stats: LabelStats) -> None:
+    state = {"version": STATE_VERSION, "input": os.path.abspath(path), "end": end,
+             "digest": _prefix_digest(path, end), "stats": stats.to_dict()}
+    d = os.path.dirname(state_file)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp = state_file + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, state_file)
+
+def collect_label_stats(path: str, keep: int, workers: Optional[int] = None, shard_bytes: int = SHARD_BYTES,
+                        state_file: Optional[str] = None) -> LabelStats:
+    """Quét song song phần chưa có trong state; state được cập nhật tới dòng hoàn chỉnh cuối cùng."""
+    size = os.path.getsize(path)
+    complete = _complete_end(path, size)
+    state = load_state(state_file, path, keep, size)
+    stats = LabelStats.from_dict(state["stats"]) if state else LabelStats(keep)
+    start = state["end"] if state else 0
+    if state:
+        print(f"Dùng lại state: {stats.total_lines} dòng đã quét, quét thêm {complete - start} byte.")
+
+    ranges = line_ranges(path, start, complete, max(1, shard_bytes))
+    workers = max(1, workers or os.cpu_count() or 1)
+    if len(ranges) > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for part in ordered_map(ex, scan_range, [(path, a, b, keep) for a, b in ranges], workers * 2):
+                stats.merge(part)
+                if stats.error is not None:
+                    break
+    else:
+        for a, b in ranges:
+            stats.merge(scan_range(path, a, b, keep))
+            if stats.error is not None:
+                break
+
+    if stats.error is None and state_file and (state is None or complete > start):
+        save_state(state_file, path, complete, stats)
+    if stats.error is None and complete < size:
+        stats.merge(scan_range(path, complete, size, keep))
+    return stats
+
+class _Report:
+    """In ra console và ghi dần vào file tạm (nối bằng '\\n' như bản cũ); close() mới đưa về tên thật."""
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.tmp = output_file + ".part"
+        self.first = True
+        self.write_error = None
+        try:
+            self.f = open(self.tmp, 'w', encoding='utf-8')
+        except Exception as e:
+            self.f, self.write_error = None, e
+
+    def __call__(self, text: str, print_also: bool = True) -> None:
+        if self.f is not None:
+            try:
+                self.f.write(text if self.first else '\n' + text)
+            except Exception as e:
+                self.f.close()
+                self.f, self.write_error = None, e
+        self.first = False
+        if print_also:
+            print(text)
+
+    def discard(self) -> None:
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.tmp)
+
+    def close(self) -> bool:
+        if self.f is None:
+            return False
+        self.f.close()
+        self.f = None
+        os.replace(self.tmp, self.output_file)
+        return True
+
+def analyze_label_consistency(jsonl_file_path, show_examples=True, max_examples=5, output_file=None,
+                              workers=None, shard_bytes=SHARD_BYTES, state_file=None):
     """
     Phân tích file JSONL từ Doccano để kiểm tra sự nhất quán trong việc gán nhãn.
 
@@ -11,71 +244,39 @@ def analyze_label_consistency(jsonl_file_path, show_examples=True, max_examples=
         show_examples (bool): Có hiển thị ví dụ câu chứa thực thể không nhất quán không.
         max_examples (int): Số lượng ví dụ tối đa hiển thị cho mỗi thực thể.
         output_file (str): Đường dẫn file để ghi kết quả. Nếu None sẽ tự động tạo.
+        workers (int): Số process quét file (mặc định = số CPU).
+        shard_bytes (int): Kích thước mỗi dải byte giao cho một process.
+        state_file (str): File lưu thống kê đã quét để lần sau chỉ quét phần mới nối thêm.
     """
     if output_file is None:
-        import os
         base_name = os.path.splitext(os.path.basename(jsonl_file_path))[0]
         output_file = f"label_analysis_{base_name}.txt"
-    
-    output_lines = []
-    
-    def write_output(text, print_also=True):
-        """Helper function để vừa ghi file vừa in console"""
-        output_lines.append(text)
-        if print_also:
-            print(text)
 
-    label_counts = defaultdict(int)
-    entity_labels = defaultdict(lambda: defaultdict(list))
-    entity_positions = defaultdict(list)
-
-    total_lines = 0
-    total_entities = 0
-    sentences = []
+    if not os.path.exists(jsonl_file_path):
+        print(f"--- Bắt đầu phân tích file: {jsonl_file_path} ---")
+        print(f"Lỗi: Không tìm thấy file tại '{jsonl_file_path}'")
+        return
 
+    write_output = _Report(output_file)
     write_output(f"--- Bắt đầu phân tích file: {jsonl_file_path} ---")
 
-    try:
-        with open(jsonl_file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                total_lines += 1
-                data = json.loads(line)
-                text = data['text']
-                labels = data.get('label', [])
-                sentences.append(text)
-                
-                for start, end, label_name in labels:
-                    entity_text = text[start:end].strip().lower()
-                    original_entity = text[start:end]
-                    
-                    label_counts[label_name] += 1
-                    total_entities += 1
-                    
-                    entity_info = {
-                        'line_num': line_num,
-                        'original_text': original_entity,
-                        'sentence': text,
-                        'start': start,
-                        'end': end
-                    }
-                    entity_labels[entity_text][label_name].append(entity_info)
-                    entity_positions[entity_text].append((line_num, label_name, original_entity))
-
-    except FileNotFoundError:
-        error_msg = f"Lỗi: Không tìm thấy file tại '{jsonl_file_path}'"
-        write_output(error_msg)
-        return
-    except json.JSONDecodeError as e:
-        error_msg = f"Lỗi: File JSONL không hợp lệ ở dòng {total_lines + 1}. Lỗi: {e}"
-        write_output(error_msg)
+    t0 = time.time()
+    stats = collect_label_stats(jsonl_file_path, max_examples, workers, shard_bytes, state_file)
+    if stats.error is not None:
+        write_output(f"Lỗi: File JSONL không hợp lệ ở dòng {stats.error[0] + 1}. Lỗi: {stats.error[1]}")
+        write_output.discard()
         return
+    print(f"(Đã quét {stats.total_lines} dòng trong {time.time() - t0:.1f}s)")
+
+    total_entities = stats.total_entities
+    entity_labels = stats.entities
 
     write_output("\n1. TỔNG QUAN PHÂN PHỐI NHÃN")
-    write_output(f"Tổng số câu: {total_lines}")
+    write_output(f"Tổng số câu: {stats.total_lines}")
     write_output(f"Tổng số thực thể đã gán nhãn: {total_entities}\n")
-    
-    sorted_labels = sorted(label_counts.items(), key=lambda item: item[1], reverse=True)
-    
+
+    sorted_labels = sorted(stats.label_counts.items(), key=lambda item: item[1], reverse=True)
+
     write_output(f"{'NHÃN':<25} | {'SỐ LƯỢNG':<10} | {'TỶ LỆ %':<8}")
     for label, count in sorted_labels:
         percentage = (count / total_entities) * 100
@@ -83,97 +284,96 @@ def analyze_label_consistency(jsonl_file_path, show_examples=True, max_examples=
 
     write_output("\n2. PHÂN TÍCH CÁC THỰC THỂ KHÔNG NHẤT QUÁN")
     write_output("(Các thực thể được gán nhiều hơn 1 loại nhãn khác nhau)\n")
-    
+
     inconsistent_entities = []
     for entity, labels in entity_labels.items():
         if len(labels) > 1:
             inconsistent_entities.append((entity, labels))
-    
+
     if not inconsistent_entities:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(output_lines))
-        print(f"\nKết quả đã được ghi vào file: {output_file}")
+        if write_output.close():
+            print(f"\nKết quả đã được ghi vào file: {output_file}")
         return
-    
+
     inconsistent_entities.sort(key=lambda x: len(x[1]), reverse=True)
-    
+
     write_output(f"Tìm thấy {len(inconsistent_entities)} thực thể không nhất quán:\n")
-    
-    for i, (entity, labels) in enumerate(inconsistent_entities, 1):
-        write_output(f"{i}. Thực thể: '{entity}'")
-        write_output(f"Số nhãn khác nhau: {len(labels)}")
-        
-        for label, occurrences in labels.items():
-            write_output(f"   -> Nhãn '{label}': {len(occurrences)} lần")
-        
-        if show_examples:
-            label_counts_for_entity = {label: len(occurrences) for label, occurrences in labels.items()}
-            max_count = max(label_counts_for_entity.values())
-            
-            minority_labels = {label: occurrences for label, occurrences in labels.items() 
-                             if len(occurrences) < max_count}
-            
-            if minority_labels:
-                write_output(" Ví dụ vị trí xuất hiện bất thường (cần xem lại):")
-                example_count = 0
-                
-                for label, occurrences in minority_labels.items():
-                    if example_count >= max_examples:
-                        remaining = sum(len(occ) for occ in minority_labels.values()) - example_count
-                        if remaining > 0:
-                            write_output(f"      ... và {remaining} ví dụ khác cần xem lại")
-                        break
-                        
-                    for occurrence in occurrences:
+
+    with open(jsonl_file_path, 'rb') as src:
+        def sentence_at(offset):
+            # Chỉ đọc lại câu khi cần in ví dụ
+            src.seek(offset)
+            return json.loads(src.readline().decode('utf-8'))['text']
+
+        for i, (entity, labels) in enumerate(inconsistent_entities, 1):
+            write_output(f"{i}. Thực thể: '{entity}'")
+            write_output(f"Số nhãn khác nhau: {len(labels)}")
+
+            for label, (count, _) in labels.items():
+                write_output(f"   -> Nhãn '{label}': {count} lần")
+
+            if show_examples:
+                max_count = max(count for count, _ in labels.values())
+
+                minority_labels = {label: occ for label, occ in labels.items() if occ[0] < max_count}
+
+                if minority_labels:
+                    write_output(" Ví dụ vị trí xuất hiện bất thường (cần xem lại):")
+                    example_count = 0
+
+                    for label, (_, examples) in minority_labels.items():
                         if example_count >= max_examples:
+                            remaining = sum(occ[0] for occ in minority_labels.values()) - example_count
+                            if remaining > 0:
+                                write_output(f"      ... và {remaining} ví dụ khác cần xem lại")
                             break
-                        
-                        line_num = occurrence['line_num']
-                        sentence = occurrence['sentence']
-                        original_text = occurrence['original_text']
-                        
-                        highlighted_sentence = sentence.replace(
-                            original_text, 
-                            f"**{original_text}**"
-                        )
-                        
-                        write_output(f"      • Dòng {line_num}, nhãn '{label}' (bất thường): {highlighted_sentence}")
-                        example_count += 1
-                
-                main_labels = [label for label, occurrences in labels.items() 
-                             if len(occurrences) == max_count]
-                write_output(f"   Nhãn có vẻ đúng: {', '.join(main_labels)} ({max_count} lần)")
-            else:
-                write_output("   Tất cả nhãn đều xuất hiện với tần suất bằng nhau")
-        
-        write_output("-" * 80)
-    
+
+                        for offset, line_num, start, end in examples:
+                            if example_count >= max_examples:
+                                break
+
+                            sentence = sentence_at(offset)
+                            original_text = sentence[start:end]
+
+                            highlighted_sentence = sentence.replace(
+                                original_text,
+                                f"**{original_text}**"
+                            )
+
+                            write_output(f"      • Dòng {line_num}, nhãn '{label}' (bất thường): {highlighted_sentence}")
+                            example_count += 1
+
+                    main_labels = [label for label, (count, _) in labels.items() if count == max_count]
+                    write_output(f"   Nhãn có vẻ đúng: {', '.join(main_labels)} ({max_count} lần)")
+                else:
+                    write_output("   Tất cả nhãn đều xuất hiện với tần suất bằng nhau")
+
+            write_output("-" * 80)
+
     write_output(f"\nTHỐNG KÊ TỔNG KẾT:")
     write_output(f"Tổng thực thể không nhất quán: {len(inconsistent_entities)}")
     write_output(f"Tỷ lệ thực thể không nhất quán: {len(inconsistent_entities)/len(entity_labels)*100:.1f}%")
-    
+
     write_output(f"\n3. CÁC CẶP NHÃN THƯỜNG BỊ NHẦM LẪN")
     label_conflicts = defaultdict(int)
-    
+
     for entity, labels in inconsistent_entities:
         label_names = list(labels.keys())
         if len(label_names) == 2:
             pair = tuple(sorted(label_names))
             label_conflicts[pair] += 1
-    
+
     if label_conflicts:
         sorted_conflicts = sorted(label_conflicts.items(), key=lambda x: x[1], reverse=True)
         for (label1, label2), count in sorted_conflicts:
             write_output(f"   • '{label1}' ↔ '{label2}': {count} thực thể")
     else:
         write_output("Không có cặp nhãn nào bị nhầm lẫn đặc biệt.")
-    
-    try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(output_lines))
+
+    if write_output.close():
         print(f"\nKết quả chi tiết đã được ghi vào file: {output_file}")
-    except Exception as e:
-        print(f"\nLỗi khi ghi file: {e}")
+    else:
+        print(f"\nLỗi khi ghi file: {write_output.write_error}")
 
 def find_similar_entities(jsonl_file_path, similarity_threshold=0.8, output_file=None):
     """
@@ -183,7 +383,6 @@ def find_similar_entities(jsonl_file_path, similarity_threshold=0.8, output_file
     from difflib import SequenceMatcher
 
     if output_file is None:
-        import os
         base_name = os.path.splitext(os.path.basename(jsonl_file_path))[0]
         output_file = f"similar_entities_{base_name}.txt"
     
@@ -242,21 +441,28 @@ def find_similar_entities(jsonl_file_path, similarity_threshold=0.8, output_file
         print(f"\nLỗi khi ghi file: {e}")
 
 if __name__ == '__main__':
-    file_path = 'data/labeled/json_files/v4/v4.jsonl'
-
-    # analyze_label_consistency(
-    #     file_path, 
-    #     show_examples=True, 
-    #     max_examples=3,
-    #     output_file=None
-    # )
-    
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--input', default='data/labeled/json_files/v4/v4.jsonl')
+    ap.add_argument('--output', default='report.txt')
+    ap.add_argument('--max_examples', type=int, default=5)
+    ap.add_argument('--no_examples', action='store_true', help='Không in câu ví dụ')
+    ap.add_argument('--workers', type=int, default=None)
+    ap.add_argument('--shard_mb', type=int, default=SHARD_BYTES >> 20, help='MB mỗi dải byte giao cho một process')
+    ap.add_argument('--state', default=None, help='File state để lần sau chỉ quét các dòng mới nối thêm')
+    ap.add_argument('--similar', action='store_true', help='Chạy thêm find_similar_entities')
+    ap.add_argument('--similarity_threshold', type=float, default=0.8)
+    args = ap.parse_args()
+
     analyze_label_consistency(
-        file_path, 
-        show_examples=True, 
-        max_examples=5,
-        output_file="report.txt"
+        args.input,
+        show_examples=not args.no_examples,
+        max_examples=args.max_examples,
+        output_file=args.output,
+        workers=args.workers,
+        shard_bytes=args.shard_mb << 20,
+        state_file=args.state,
     )
-    
+
     # Phân tích thực thể tương tự (tùy chọn) - cũng sẽ ghi ra file riêng
-    # find_similar_entities(file_path, similarity_threshold=0.8)
\ No newline at end of file
+    if args.similar:
+        find_similar_entities(args.input, similarity_threshold=args.similarity_threshold)
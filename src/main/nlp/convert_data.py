@@ -1,103 +1,232 @@
+import io
 import os
 import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
 import spacy
 from spacy.tokens import DocBin
-from collections import Counter
+
+from src.main.parallel import ordered_map
 
 SPAN_KEY = "sc"
+DOCS_PER_SHARD = 5000
+
+# Doccano .jsonl -> thư mục DocBin: <output>/shard-00000.spacy, shard-00001.spacy, ... + manifest.json
+#   - mỗi shard = DOCS_PER_SHARD dòng input liên tiếp, các shard chuyển song song trên nhiều process
+#   - manifest ghi lại sau mỗi shard -> chạy lại (cùng input, cùng docs_per_shard) chỉ làm các shard còn thiếu
+#   - spacy.Corpus đọc thẳng thư mục shard: --paths.train data/labeled/corpus/v5/train
+#
+# Usage:
+# python -m src.main.nlp.convert_data --json_dir data/labeled/json_files/v5 --corpus_dir data/labeled/corpus/v5
+
+STAT_KEYS = ("docs", "entities", "empty_docs", "skipped_spans", "bad_json_lines")
+
+_NLP = None
+
+def _get_nlp():
+    # Mỗi worker process tạo tokenizer một lần
+    global _NLP
+    if _NLP is None:
+        _NLP = spacy.blank("vi")
+    return _NLP
+
+def shard_name(idx: int) -> str:
+    return f"shard-{idx:05d}.spacy"
+
+def shard_offsets(input_path: Path, docs_per_shard: int) -> List[Tuple[int, int, int]]:
+    """Một lượt đọc nhị phân: (byte bắt đầu, byte kết thúc, số dòng đầu tiên) của mỗi shard."""
+    ranges, start, line_no, n = [], 0, 1, 0
+    offset = 0
+    with open(input_path, "rb") as f:
+        for raw in f:
+            offset += len(raw)
+            n += 1
+            if n == docs_per_shard:
+                ranges.append((start, offset, line_no))
+                start, line_no, n = offset, line_no + n, 0
+    if n:
+        ranges.append((start, offset, line_no))
+    return ranges
+
+def convert_lines(lines, first_line: int, stats: Counter, label_counter: Counter, log: list) -> DocBin:
+    nlp = _get_nlp()
+    db = DocBin()
+    for line_num, line in enumerate(lines, first_line):
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            stats["bad_json_lines"] += 1
+            log.append(f"[WARN] Bad JSON at line {line_num}. Skipped.")
+            continue
+
+        text = data.get("text", "")
+        labels = data.get("label", [])
+
+        if not text.strip():
+            log.append(f"[INFO] Empty text at line {line_num}. Skipped.")
+            continue
+
+        doc = nlp.make_doc(text)
+        spans = []
+
+        for triplet in labels:
+            if not isinstance(triplet, (list, tuple)) or len(triplet) != 3:
+                stats["skipped_spans"] += 1
+                log.append(f"[WARN] Bad label format at line {line_num}: {triplet}")
+                continue
 
-def convert_doccano_to_spacy(input_path, output_path):
-    if not os.path.exists(input_path):
-        print(f"Can't find: {input_path}")
-        return
+            start, end, label = triplet
 
-    output_dir = os.path.dirname(output_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        print(f"Created folder: {output_dir}")
+            while start < end and start < len(text) and text[start].isspace():
+                start += 1
+            while end > start and end - 1 < len(text) and text[end - 1].isspace():
+                end -= 1
 
-    nlp = spacy.blank("vi")
-    db = DocBin()
-    total_docs = 0
-    total_entities = 0
-    skipped_spans = 0
-    bad_json_lines = 0
-    empty_docs = 0
-    label_counter = Counter()
-
-    with open(input_path, "r", encoding="utf-8") as f:
-        for line_num, line in enumerate(f, 1):
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError:
-                bad_json_lines += 1
-                print(f"[WARN] Bad JSON at line {line_num}. Skipped.")
+            start = max(0, min(int(start), len(text)))
+            end = max(0, min(int(end), len(text)))
+            if start >= end:
+                stats["skipped_spans"] += 1
                 continue
 
-            text = data.get("text", "")
-            labels = data.get("label", [])
-
-            if not text.strip():
-                print(f"[INFO] Empty text at line {line_num}. Skipped.")
+            span = doc.char_span(start, end, label=label, alignment_mode="contract")
+            if span is None:
+                stats["skipped_spans"] += 1
                 continue
 
-            doc = nlp.make_doc(text)
-            spans = []
-
-            for triplet in labels:
-                if not isinstance(triplet, (list, tuple)) or len(triplet) != 3:
-                    skipped_spans += 1
-                    print(f"[WARN] Bad label format at line {line_num}: {triplet}")
-                    continue
-
-                start, end, label = triplet
-
-                while start < end and start < len(text) and text[start].isspace():
-                    start += 1
-                while end > start and end - 1 < len(text) and text[end - 1].isspace():
-                    end -= 1
-
-                start = max(0, min(int(start), len(text)))
-                end = max(0, min(int(end), len(text)))
-                if start >= end:
-                    skipped_spans += 1
-                    continue
-
-                span = doc.char_span(start, end, label=label, alignment_mode="contract")
-                if span is None:
-                    skipped_spans += 1
-                    continue
-
-                spans.append(span)
-
-            if spans:
-                for s in spans:
-                    label_counter[s.label_] += 1
-                total_entities += len(spans)
-                doc.spans[SPAN_KEY] = spans
-            else:
-                empty_docs += 1
-                doc.spans[SPAN_KEY] = []
-
-            db.add(doc)
-            total_docs += 1
-
-    db.to_disk(output_path)
-    print(f"Docs total      : {total_docs}")
-    print(f"Entities total  : {total_entities}")
-    print(f"Empty docs      : {empty_docs}")
-    print(f"Skipped spans   : {skipped_spans}")
-    print(f"Bad JSON lines  : {bad_json_lines}")
+            spans.append(span)
+
+        if spans:
+            for s in spans:
+                label_counter[s.label_] += 1
+            stats["entities"] += len(spans)
+            doc.spans[SPAN_KEY] = spans
+        else:
+            stats["empty_docs"] += 1
+            doc.spans[SPAN_KEY] = []
+
+        db.add(doc)
+        stats["docs"] += 1
+    return db
+
+def convert_shard(input_path: str, start: int, end: int, first_line: int, out_path: str) -> dict:
+    """Worker: dòng trong [start, end) byte -> một file DocBin (ghi tmp rồi replace); trả thống kê của shard."""
+    stats, label_counter, log = Counter({k: 0 for k in STAT_KEYS}), Counter(), []
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # StringIO(newline=None) tách dòng như đọc file text (không tách ở U+2028 như str.splitlines)
+    lines = list(io.StringIO(data.decode("utf-8"), newline=None))
+    db = convert_lines(lines, first_line, stats, label_counter, log)
+    tmp = out_path + f".tmp{os.getpid()}"
+    db.to_disk(tmp)
+    os.replace(tmp, out_path)
+    return {"file": os.path.basename(out_path), "lines": [first_line, first_line + len(lines) - 1],
+            "stats": dict(stats), "labels": dict(label_counter), "log": log}
+
+def _fingerprint(path: Path) -> dict:
+    st = path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def _write_manifest(manifest_path: Path, manifest: dict) -> None:
+    tmp = manifest_path.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, manifest_path)
+
+def _load_manifest(manifest_path: Path, input_path: Path, docs_per_shard: int) -> dict:
+    """Shard đã xong từ lần chạy trước (chỉ dùng lại khi input và docs_per_shard không đổi)."""
+    if not manifest_path.exists():
+        return {}
+    try:
+        old = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if (old.get("input") != str(input_path) or old.get("fingerprint") != _fingerprint(input_path)
+            or old.get("docs_per_shard") != docs_per_shard):
+        return {}
+    out_dir = manifest_path.parent
+    return {s["file"]: s for s in old.get("shards", []) if (out_dir / s["file"]).exists()}
+
+def convert_doccano_to_spacy(input_path, output_path, workers: Optional[int] = None,
+                             docs_per_shard: int = DOCS_PER_SHARD, restart: bool = False):
+    """input .jsonl -> thư mục shard output_path (đuôi .spacy cũ được bỏ: train.spacy -> train/)."""
+    if not os.path.exists(input_path):
+        print(f"Can't find: {input_path}")
+        return
+
+    input_path = Path(input_path)
+    output_dir = Path(output_path)
+    if output_dir.suffix == ".spacy":
+        output_dir = output_dir.with_suffix("")
+    if not output_dir.exists():
+        output_dir.mkdir(parents=True)
+        print(f"Created folder: {output_dir}")
+    manifest_path = output_dir / "manifest.json"
+
+    t0 = time.time()
+    ranges = shard_offsets(input_path, docs_per_shard)
+    done = {} if restart else _load_manifest(manifest_path, input_path, docs_per_shard)
+    manifest = {"input": str(input_path), "fingerprint": _fingerprint(input_path),
+                "docs_per_shard": docs_per_shard, "span_key": SPAN_KEY, "shards": []}
+    names = [shard_name(i) for i in range(len(ranges))]
+
+    # Shard thừa của lần chạy cũ (input ngắn hơn) sẽ bị spacy.Corpus đọc nhầm -> xoá
+    for p in output_dir.glob("shard-*.spacy"):
+        if p.name not in names:
+            p.unlink()
+
+    tasks = [(str(input_path), s, e, ln, str(output_dir / name))
+             for (s, e, ln), name in zip(ranges, names) if name not in done]
+    if done:
+        print(f"Reusing {len(ranges) - len(tasks)}/{len(ranges)} shards from previous run.")
+
+    results = dict(done)
+    workers = max(1, workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for res in ordered_map(ex, convert_shard, tasks, workers * 2):
+            for msg in res.pop("log"):
+                print(msg)
+            results[res["file"]] = res
+            # manifest ghi lại sau mỗi shard: crash giữa chừng vẫn giữ các shard đã xong
+            manifest["shards"] = [results[n] for n in names if n in results]
+            _write_manifest(manifest_path, manifest)
+
+    total, label_counter = Counter({k: 0 for k in STAT_KEYS}), Counter()
+    for name in names:
+        total.update(results[name]["stats"])
+        label_counter.update(results[name]["labels"])
+    manifest["shards"] = [results[n] for n in names]
+    manifest["totals"] = dict(total)
+    manifest["labels"] = dict(label_counter)
+    _write_manifest(manifest_path, manifest)
+
+    print(f"Docs total      : {total['docs']}")
+    print(f"Entities total  : {total['entities']}")
+    print(f"Empty docs      : {total['empty_docs']}")
+    print(f"Skipped spans   : {total['skipped_spans']}")
+    print(f"Bad JSON lines  : {total['bad_json_lines']}")
     print(f"Label counts    : {dict(label_counter)}")
-    print(f"Done: {input_path} to {output_path}")
+    print(f"Done: {input_path} to {output_dir} ({len(names)} shards, {time.time() - t0:.1f}s)")
 
 if __name__ == "__main__":
-    convert_doccano_to_spacy(
-        "data/labeled/json_files/v5/train.jsonl",
-        "data/labeled/corpus/v5/train.spacy"
-    )
-    convert_doccano_to_spacy(
-        "data/labeled/json_files/v5/dev.jsonl",
-        "data/labeled/corpus/v5/dev.spacy"
-    )
-
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--json_dir", default="data/labeled/json_files/v5")
+    ap.add_argument("--corpus_dir", default="data/labeled/corpus/v5")
+    ap.add_argument("--splits", nargs="+", default=["train", "dev"], help="<json_dir>/<split>.jsonl -> <corpus_dir>/<split>/")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--docs_per_shard", type=int, default=DOCS_PER_SHARD, help="Số dòng input mỗi shard DocBin")
+    ap.add_argument("--restart", action="store_true", help="Chuyển lại mọi shard, không dùng manifest cũ")
+    args = ap.parse_args()
+
+    for split in args.splits:
+        convert_doccano_to_spacy(
+            os.path.join(args.json_dir, f"{split}.jsonl"),
+            os.path.join(args.corpus_dir, split),
+            workers=args.workers,
+            docs_per_shard=max(1, args.docs_per_shard),
+            restart=args.restart,
+        )
@@ -0,0 +1,381 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Phát hiện câu/đoạn trùng hoặc gần trùng trong corpus (nhiều bản in của cùng một bộ sử,
+# lời tựa lặp lại...) trước khi prelabel / gán nhãn / chia train-dev.
+#   - MinHash trên shingle ký tự (k ký tự liên tiếp của văn bản đã chuẩn hoá)
+#   - LSH chia chữ ký thành `bands` dải, hai dòng chung ít nhất một dải -> ứng viên,
+#     ứng viên được xác nhận khi Jaccard ước lượng từ chữ ký >= threshold
+#   - Index lưu trong SQLite: chạy lại với file mới chỉ tính chữ ký cho file mới và so với index cũ
+#   - Cụm (cluster) = id dòng đầu tiên được index; giữ dòng đó, các dòng còn lại của cụm vào drop list
+#
+# Đơn vị: mỗi dòng không rỗng của .txt, mỗi record ("text") của .jsonl.
+#
+# Usage:
+# python -m src.main.nlp.dedup --inputs book_data/final_txt/Done --index runs/dedup/index.sqlite3 \
+#     --drop_list runs/dedup/drop.tsv --clusters runs/dedup/clusters.jsonl --out_dir runs/dedup/clean
+
+SEED = 2025
+RE_NON_WORD = re.compile(r'[^\w]+')
+_MIX = np.uint64(1099511628211)   # nhân tử rolling hash cho shingle
+_BATCH = 2000                     # số dòng mỗi lượt truy vấn/ghi index
+_SQL_PARAMS = 500                 # số tham số mỗi câu ... IN (...)
+
+
+def normalize(text: str) -> str:
+    """NFC + casefold + bỏ dấu câu/khoảng trắng thừa (giữ dấu tiếng Việt)."""
+    text = unicodedata.normalize('NFC', text).casefold()
+    return RE_NON_WORD.sub(' ', text).strip()
+
+
+def shingle_hashes(text: str, k: int) -> np.ndarray:
+    """Hash 64-bit của mọi shingle k ký tự (vector hoá bằng numpy, tràn số uint64 là chủ ý)."""
+    cp = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    n = len(cp) - k + 1
+    if n <= 0:
+        n, k = 1, len(cp)
+    h = np.zeros(n, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(k):
+            h = h * _MIX + cp[j:j + n]
+    return np.unique(h)
+
+
+class MinHasher:
+    """num_perm hàm băm dạng multiply-shift ((a*x + b) mod 2^64) >> 32, a lẻ; chữ ký = min theo từng hàm."""
+
+    def __init__(self, num_perm: int, shingle: int, seed: int = SEED):
+        rng = np.random.default_rng(seed)
+        self.shingle = shingle
+        self.a = (rng.integers(0, 2 ** 63, size=(num_perm, 1), dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        h = shingle_hashes(text, self.shingle)[None, :]
+        with np.errstate(over='ignore'):
+            return ((self.a * h + self.b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+def band_keys(sig: np.ndarray, bands: int) -> List[int]:
+    rows = sig.reshape(bands, -1)
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([i]) + rows[i].tobytes(), digest_size=8).digest(), 'little', signed=True)
+        for i in range(bands)
+    ]
+
+
+def iter_units(path: Path) -> Iterator[Tuple[int, str]]:
+    """(số dòng bắt đầu từ 1, văn bản) cho mỗi đơn vị trong file."""
+    is_jsonl = path.suffix.lower() == '.jsonl'
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if is_jsonl:
+                try:
+                    text = json.loads(line).get('text', '')
+                except (json.JSONDecodeError, AttributeError):
+                    continue
+            else:
+                text = line
+            if text.strip():
+                yield line_no, text
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _chunks(seq: List, size: int) -> Iterator[List]:
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+class DedupIndex:
+    """
+    SQLite (WAL):
+      meta(key, value)                       tham số MinHash/LSH; mở lại với tham số khác -> lỗi
+      files(source, sha256)                  file đã index (đổi nội dung -> xoá bản ghi cũ rồi index lại)
+      docs(id, source, line, sig, cluster)   cluster = id nhỏ nhất của cụm (gốc union-find, nén đường đi sẵn)
+      bands(key, doc_id)                     khoá dải LSH -> dòng
+    """
+
+    def __init__(self, db_path: str, *, num_perm: int = 128, bands: int = 16, shingle: int = 5,
+                 threshold: float = 0.8):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) phải chia hết cho bands ({bands})")
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, sha256 TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, source TEXT NOT NULL, line INTEGER NOT NULL,"
+            " sig BLOB NOT NULL, cluster INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS docs_source ON docs(source);"
+            "CREATE INDEX IF NOT EXISTS docs_cluster ON docs(cluster);"
+            "CREATE TABLE IF NOT EXISTS bands (key INTEGER NOT NULL, doc_id INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS bands_key ON bands(key);"
+            "CREATE INDEX IF NOT EXISTS bands_doc ON bands(doc_id);"
+        )
+        params = {"num_perm": num_perm, "bands": bands, "shingle": shingle, "seed": SEED}
+        stored = dict(self.db.execute("SELECT key, value FROM meta"))
+        if stored:
+            if {k: int(v) for k, v in stored.items()} != params:
+                raise ValueError(f"Index tạo với tham số {stored}, khác tham số hiện tại {params}")
+        else:
+            with self.db:
+                self.db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                    [(k, str(v)) for k, v in params.items()])
+        self.bands = bands
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle)
+
+    def file_state(self, source: str, sha: str) -> str:
+        """'new' | 'same' | 'changed'"""
+        row = self.db.execute("SELECT sha256 FROM files WHERE source = ?", (source,)).fetchone()
+        if row is None:
+            return 'new'
+        return 'same' if row[0] == sha else 'changed'
+
+    def remove_file(self, source: str) -> None:
+        with self.db:
+            lost_roots = [r[0] for r in self.db.execute(
+                "SELECT id FROM docs WHERE source = ? AND id = cluster", (source,))]
+            self.db.execute("DELETE FROM bands WHERE doc_id IN (SELECT id FROM docs WHERE source = ?)", (source,))
+            self.db.execute("DELETE FROM docs WHERE source = ?", (source,))
+            self.db.execute("DELETE FROM files WHERE source = ?", (source,))
+            # Cụm mất gốc: dòng có id nhỏ nhất còn lại làm gốc mới
+            for root in lost_roots:
+                new_root = self.db.execute("SELECT MIN(id) FROM docs WHERE cluster = ?", (root,)).fetchone()[0]
+                if new_root is not None:
+                    self.db.execute("UPDATE docs SET cluster = ? WHERE cluster = ?", (new_root, root))
+
+    def _candidates(self, keys: Set[int]) -> Dict[int, List[int]]:
+        found: Dict[int, List[int]] = {}
+        for part in _chunks(list(keys), _SQL_PARAMS):
+            q = f"SELECT key, doc_id FROM bands WHERE key IN ({','.join('?' * len(part))})"
+            for key, doc_id in self.db.execute(q, part):
+                found.setdefault(key, []).append(doc_id)
+        return found
+
+    def _load_docs(self, ids: Iterable[int]) -> Dict[int, Tuple[np.ndarray, int]]:
+        out = {}
+        for part in _chunks(list(ids), _SQL_PARAMS):
+            q = f"SELECT id, sig, cluster FROM docs WHERE id IN ({','.join('?' * len(part))})"
+            for doc_id, sig, cluster in self.db.execute(q, part):
+                out[doc_id] = (np.frombuffer(sig, dtype=np.uint32), cluster)
+        return out
+
+    def _next_id(self) -> int:
+        return (self.db.execute("SELECT MAX(id) FROM docs").fetchone()[0] or 0) + 1
+
+    def add_batch(self, source: str, units: List[Tuple[int, str]]) -> Tuple[int, int]:
+        """Index một lô dòng của `source`; trả về (số dòng đã index, số dòng trùng với dòng trước đó)."""
+        sigs = [self.hasher.signature(text) for _, text in units]
+        keys = [band_keys(sig, self.bands) for sig in sigs]
+        cand = self._candidates({k for ks in keys for k in ks})
+        known = self._load_docs({d for ids in cand.values() for d in ids})
+
+        start = self._next_id()
+        local: Dict[int, List[int]] = {}   # khoá dải -> id trong lô hiện tại
+        roots: Dict[int, int] = {}         # gốc cụm đã đổi trong lô (root cũ -> root mới)
+        rows, band_rows, n_dup = [], [], 0
+
+        def root_of(cluster: int) -> int:
+            while cluster in roots:
+                cluster = roots[cluster]
+            return cluster
+
+        for i, (sig, ks) in enumerate(zip(sigs, keys)):
+            doc_id = start + i
+            matches = set()
+            for k in ks:
+                matches.update(cand.get(k, ()))
+                matches.update(local.get(k, ()))
+            clusters = set()
+            for m in matches:
+                other_sig, other_cluster = known[m]
+                if float(np.mean(other_sig == sig)) >= self.threshold:
+                    clusters.add(root_of(other_cluster))
+            cluster = min(clusters) if clusters else doc_id
+            for c in clusters - {cluster}:
+                roots[c] = cluster
+            if clusters:
+                n_dup += 1
+            known[doc_id] = (sig, cluster)
+            for k in ks:
+                local.setdefault(k, []).append(doc_id)
+                band_rows.append((k, doc_id))
+            rows.append([doc_id, source, units[i][0], sig.tobytes(), cluster])
+
+        with self.db:
+            for row in rows:
+                row[4] = root_of(row[4])
+            self.db.executemany("INSERT INTO docs (id, source, line, sig, cluster) VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT INTO bands (key, doc_id) VALUES (?, ?)", band_rows)
+            # Gộp cụm: mọi dòng của cụm cũ trỏ thẳng về gốc mới
+            for old in roots:
+                self.db.execute("UPDATE docs SET cluster = ? WHERE cluster = ?", (root_of(old), old))
+        return len(rows), n_dup
+
+    def sources(self) -> List[str]:
+        return [r[0] for r in self.db.execute("SELECT source FROM files")]
+
+    def mark_file(self, source: str, sha: str) -> None:
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files (source, sha256) VALUES (?, ?)", (source, sha))
+
+    def duplicates(self) -> Iterator[Tuple[str, int, int, int]]:
+        """(source, line, id, cluster) của mọi dòng thuộc cụm có từ 2 dòng trở lên."""
+        q = ("SELECT source, line, id, cluster FROM docs WHERE cluster IN "
+             "(SELECT cluster FROM docs GROUP BY cluster HAVING COUNT(*) > 1) ORDER BY cluster, id")
+        yield from self.db.execute(q)
+
+
+def source_key(path: Path) -> str:
+    """Khoá source trong index: đường dẫn tuyệt đối (a.txt, ./a.txt, chạy từ thư mục khác -> cùng một khoá)."""
+    return str(path.resolve())
+
+
+def collect_inputs(inputs: List[str]) -> Tuple[List[Path], Path]:
+    """Các file input + thư mục gốc chung (thư mục input, hoặc tổ tiên chung khi có nhiều input)."""
+    files, roots = [], []
+    for item in inputs:
+        p = Path(item)
+        if p.is_dir():
+            files.extend(sorted(q for q in p.rglob('*') if q.suffix.lower() in ('.txt', '.jsonl')))
+            roots.append(p.resolve())
+        elif p.is_file():
+            files.append(p)
+            roots.append(p.resolve().parent)
+        else:
+            print(f"Không tìm thấy: {item}")
+    root = Path(os.path.commonpath(roots)) if roots else Path('.')
+    return files, root
+
+
+def index_file(index: DedupIndex, path: Path, min_chars: int) -> Tuple[int, int]:
+    source = source_key(path)
+    total = dup = 0
+    batch = []
+    for line_no, text in iter_units(path):
+        norm = normalize(text)
+        if len(norm) < min_chars:
+            continue
+        batch.append((line_no, norm))
+        if len(batch) >= _BATCH:
+            n, d = index.add_batch(source, batch)
+            total, dup, batch = total + n, dup + d, []
+    if batch:
+        n, d = index.add_batch(source, batch)
+        total, dup = total + n, dup + d
+    return total, dup
+
+
+def write_deduped(path: Path, out_path: Path, drop_lines: Set[int]) -> int:
+    kept = 0
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'r', encoding='utf-8') as f, open(out_path, 'w', encoding='utf-8') as w:
+        for line_no, line in enumerate(f, 1):
+            if line_no in drop_lines:
+                continue
+            w.write(line)
+            kept += 1
+    return kept
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--inputs', nargs='+', default=['book_data/final_txt/Done'],
+                    help='File hoặc thư mục (.txt: mỗi dòng một đơn vị, .jsonl: trường "text")')
+    ap.add_argument('--index', default='runs/dedup/index.sqlite3', help='Index dùng lại giữa các lần chạy')
+    ap.add_argument('--threshold', type=float, default=0.8, help='Jaccard ước lượng tối thiểu để coi là trùng')
+    ap.add_argument('--num_perm', type=int, default=128)
+    ap.add_argument('--bands', type=int, default=16, help='Số dải LSH (num_perm / bands hàng mỗi dải)')
+    ap.add_argument('--shingle', type=int, default=5, help='Độ dài shingle ký tự')
+    ap.add_argument('--min_chars', type=int, default=20, help='Dòng ngắn hơn (sau chuẩn hoá) không xét trùng')
+    ap.add_argument('--drop_list', default=None, help='TSV source<TAB>line<TAB>cluster của các dòng nên bỏ')
+    ap.add_argument('--clusters', default=None, help='JSONL {source, line, id, cluster, keep} cho mọi cụm >= 2 dòng')
+    ap.add_argument('--out_dir', default=None, help='Ghi bản đã bỏ dòng trùng của các file input')
+    args = ap.parse_args()
+
+    index = DedupIndex(args.index, num_perm=args.num_perm, bands=args.bands, shingle=args.shingle,
+                       threshold=args.threshold)
+    files, input_root = collect_inputs(args.inputs)
+    if not files:
+        print("Không có file .txt/.jsonl nào để xử lý")
+        return
+
+    # Index cũ khoá theo đường dẫn như lúc gõ (tương đối, phụ thuộc thư mục chạy) -> bỏ, index lại theo source_key
+    legacy = [s for s in index.sources() if not os.path.isabs(s)]
+    for source in legacy:
+        index.remove_file(source)
+    if legacy:
+        print(f"Bỏ {len(legacy)} file index theo đường dẫn tương đối (bản cũ), sẽ index lại nếu có trong input")
+
+    t0 = time.time()
+    for path in files:
+        sha = file_sha256(path)
+        source = source_key(path)
+        state = index.file_state(source, sha)
+        if state == 'same':
+            print(f"Đã có trong index: {path}")
+            continue
+        if state == 'changed':
+            print(f"File đã thay đổi, index lại: {path}")
+            index.remove_file(source)
+        total, dup = index_file(index, path, args.min_chars)
+        index.mark_file(source, sha)
+        print(f"Index: {path} ({total} dòng, {dup} trùng với dòng đã có)")
+
+    # Trạng thái giữ/bỏ lấy từ toàn bộ index (gộp cụm có thể đổi dòng giữ lại của lần chạy trước)
+    drops: Dict[str, Set[int]] = {}
+    n_clusters = n_drop = 0
+    clusters_f = open(args.clusters, 'w', encoding='utf-8') if args.clusters else None
+    drop_f = open(args.drop_list, 'w', encoding='utf-8') if args.drop_list else None
+    try:
+        for source, line, doc_id, cluster in index.duplicates():
+            keep = doc_id == cluster
+            n_clusters += keep
+            if not keep:
+                n_drop += 1
+                drops.setdefault(source, set()).add(line)
+                if drop_f:
+                    drop_f.write(f"{source}\t{line}\t{cluster}\n")
+            if clusters_f:
+                clusters_f.write(json.dumps({"source": source, "line": line, "id": doc_id,
+                                             "cluster": cluster, "keep": keep}, ensure_ascii=False) + "\n")
+    finally:
+        for f in (clusters_f, drop_f):
+            if f:
+                f.close()
+
+    if args.out_dir:
+        out_dir = Path(args.out_dir)
+        for path in files:
+            # Giữ đường dẫn tương đối so với gốc input: file trùng tên ở thư mục khác không ghi đè nhau
+            out_path = out_dir / path.resolve().relative_to(input_root)
+            kept = write_deduped(path, out_path, drops.get(source_key(path), set()))
+            print(f"Ghi: {out_path} ({kept} dòng)")
+
+    total_docs = index.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+    print(f"\nIndex: {total_docs} dòng, {n_clusters} cụm trùng, {n_drop} dòng nên bỏ ({time.time() - t0:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import argparse
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+# Prelabel bằng mô hình spancat cho cả .txt (mỗi dòng một câu) và .jsonl Doccano ({"text", "label"}).
+#   - nlp.pipe trên toàn bộ luồng câu (n_process > 1 dùng nhiều core), trong mỗi cửa sổ `window` dòng
+#     câu được sắp theo độ dài để batch đều nhau; output vẫn đúng thứ tự dòng input
+#   - Ghi output sau mỗi cửa sổ; checkpoint <output>.ckpt lưu số dòng + byte offset input/output
+#     -> chạy lại sau crash tiếp tục từ cửa sổ cuối đã ghi, file đã xong thì bỏ qua
+#
+# Usage:
+# python -m src.main.nlp.prelabel --model models/spancat_v5/model-best \
+#     --input book_data/final_txt/Done --output runs/preds_v5 --n_process 4
+
+ACCEPTANCE_THRESHOLD = 0.5
+SPANS_KEY = "sc"
+
+
+def load_model(model_path: str):
+    import spacy
+
+    print(f"Đang tải mô hình từ: {model_path}")
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Không tìm thấy mô hình tại '{model_path}'.")
+    return spacy.load(model_path)
+
+
+def predicted_labels(doc, threshold: float, spans_key: str) -> List[list]:
+    spans = doc.spans.get(spans_key, [])
+    scores = getattr(spans, "attrs", {}).get("scores", [1.0] * len(spans))
+    return [[span.start_char, span.end_char, span.label_] for span, score in zip(spans, scores) if score >= threshold]
+
+
+class _Record:
+    __slots__ = ("line_no", "end_offset", "text", "obj")
+
+    def __init__(self, line_no: int, end_offset: int, text: str, obj: Optional[dict]):
+        self.line_no = line_no
+        self.end_offset = end_offset   # byte offset ngay sau dòng này trong file input
+        self.text = text               # "" -> không đưa qua mô hình
+        self.obj = obj                 # None -> bỏ dòng (JSON lỗi / dòng trống của .txt)
+
+
+class _Window:
+    __slots__ = ("wid", "records", "remaining")
+
+    def __init__(self, wid: int, records: List[_Record]):
+        self.wid = wid
+        self.records = records
+        self.remaining = sum(1 for r in records if r.text)
+
+
+def _iter_records(input_path: Path, fmt: str, start_offset: int, start_line: int) -> Iterator[_Record]:
+    offset = start_offset
+    with open(input_path, "rb") as f:
+        f.seek(start_offset)
+        for line_no, raw in enumerate(f, start_line + 1):
+            offset += len(raw)
+            line = raw.decode("utf-8")
+            if fmt == "txt":
+                text = line.strip()
+                yield _Record(line_no, offset, text, {"text": text, "label": []} if text else None)
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Lỗi JSON ở dòng {line_no}, bỏ qua.")
+                yield _Record(line_no, offset, "", None)
+                continue
+            obj["label"] = obj.get("label", [])
+            yield _Record(line_no, offset, obj.get("text", "").strip(), obj)
+
+
+def _iter_windows(records: Iterator[_Record], window: int) -> Iterator[_Window]:
+    buf, wid = [], 0
+    for r in records:
+        buf.append(r)
+        if len(buf) >= window:
+            yield _Window(wid, buf)
+            buf, wid = [], wid + 1
+    if buf:
+        yield _Window(wid, buf)
+
+
+def _fingerprint(path: Path) -> dict:
+    st = path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def model_id(nlp) -> dict:
+    """Định danh mô hình cho checkpoint: đường dẫn + meta + mtime meta.json (train lại cùng chỗ cũng đổi)."""
+    path = getattr(nlp, "path", None)
+    meta_file = Path(path) / "meta.json" if path else None
+    return {
+        "path": str(path) if path else None,
+        "name": nlp.meta.get("name"),
+        "version": nlp.meta.get("version"),
+        "pipeline": list(nlp.pipe_names),
+        "meta_mtime_ns": meta_file.stat().st_mtime_ns if meta_file and meta_file.exists() else None,
+    }
+
+
+def _read_checkpoint(ckpt_path: Path, input_path: Path, settings: dict) -> Optional[dict]:
+    if not ckpt_path.exists():
+        return None
+    try:
+        ckpt = json.loads(ckpt_path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None
+    if ckpt.get("input") != str(input_path) or ckpt.get("fingerprint") != _fingerprint(input_path):
+        print(f"Input đã thay đổi, chạy lại từ đầu: {input_path}")
+        return None
+    if ckpt.get("settings") != settings:
+        print(f"Mô hình/threshold/spans_key đã thay đổi, chạy lại từ đầu: {input_path}")
+        return None
+    return ckpt
+
+
+def _write_checkpoint(ckpt_path: Path, state: dict) -> None:
+    tmp = ckpt_path.with_suffix(ckpt_path.suffix + ".tmp")
+    tmp.write_text(json.dumps(state), encoding="utf-8")
+    os.replace(tmp, ckpt_path)
+
+
+def prelabel_file(nlp, input_path, output_path, *, fmt: Optional[str] = None,
+                  threshold: float = ACCEPTANCE_THRESHOLD, spans_key: str = SPANS_KEY,
+                  batch_size: int = 256, n_process: int = 1, window: int = 4096, restart: bool = False) -> dict:
+    """
+    Prelabel một file; fmt = 'txt' | 'jsonl' (mặc định theo đuôi file).
+    .txt  : mỗi dòng không rỗng -> {"text", "label": nhãn dự đoán}
+    .jsonl: giữ nguyên record, thêm nhãn dự đoán chưa có vào "label" (dòng JSON lỗi bị bỏ)
+    """
+    input_path, output_path = Path(input_path), Path(output_path)
+    if output_path.resolve() == input_path.resolve():
+        raise ValueError(f"Output trùng với input, sẽ ghi đè dữ liệu gốc: {output_path}")
+    fmt = fmt or ("jsonl" if input_path.suffix.lower() == ".jsonl" else "txt")
+    ckpt_path = output_path.with_name(output_path.name + ".ckpt")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Kết quả phụ thuộc mô hình + threshold + spans_key: đổi bất kỳ cái nào thì checkpoint không còn đúng
+    settings = {"model": model_id(nlp), "threshold": threshold, "spans_key": spans_key, "format": fmt}
+    ckpt = None if restart else _read_checkpoint(ckpt_path, input_path, settings)
+    if ckpt and (not output_path.exists() or output_path.stat().st_size < ckpt["out_offset"]):
+        ckpt = None  # output bị xoá/cắt ngắn -> không tin checkpoint
+    if ckpt and ckpt.get("done"):
+        print(f"Đã xong trước đó, bỏ qua: {input_path}")
+        return {"lines": ckpt["lines"], "docs": 0, "resumed": True}
+    state = {
+        "input": str(input_path),
+        "fingerprint": _fingerprint(input_path),
+        "settings": settings,
+        "lines": ckpt["lines"] if ckpt else 0,
+        "in_offset": ckpt["in_offset"] if ckpt else 0,
+        "out_offset": ckpt["out_offset"] if ckpt else 0,
+        "done": False,
+    }
+    if ckpt:
+        print(f"Tiếp tục {input_path} từ dòng {state['lines'] + 1}")
+
+    t0 = time.time()
+    n_docs = 0
+    pending = deque()
+    by_id = {}
+
+    def text_stream():
+        # Câu trong mỗi cửa sổ đi vào nlp.pipe theo thứ tự độ dài; context (id cửa sổ, vị trí) để xếp lại.
+        # Context chỉ là số: với n_process > 1 spaCy pickle context sang process con và trả về bản sao.
+        records = _iter_records(input_path, fmt, state["in_offset"], state["lines"])
+        for win in _iter_windows(records, window):
+            pending.append(win)
+            by_id[win.wid] = win
+            order = sorted((i for i, r in enumerate(win.records) if r.text), key=lambda i: len(win.records[i].text))
+            for i in order:
+                yield win.records[i].text, (win.wid, i)
+
+    mode = "r+b" if output_path.exists() and state["out_offset"] else "wb"
+    with open(output_path, mode) as out:
+        out.seek(state["out_offset"])
+        out.truncate()
+
+        def flush_ready():
+            while pending and pending[0].remaining == 0:
+                win = pending.popleft()
+                del by_id[win.wid]
+                for r in win.records:
+                    if r.obj is not None:
+                        out.write((json.dumps(r.obj, ensure_ascii=False) + "\n").encode("utf-8"))
+                out.flush()
+                os.fsync(out.fileno())
+                last = win.records[-1]
+                state.update(lines=last.line_no, in_offset=last.end_offset, out_offset=out.tell())
+                _write_checkpoint(ckpt_path, state)
+
+        for doc, (wid, i) in nlp.pipe(text_stream(), as_tuples=True, batch_size=batch_size, n_process=n_process):
+            win = by_id[wid]
+            obj = win.records[i].obj
+            labels = obj["label"]
+            existing = set(tuple(l) for l in labels)
+            for new_label in predicted_labels(doc, threshold, spans_key):
+                if tuple(new_label) not in existing:
+                    labels.append(new_label)
+                    existing.add(tuple(new_label))
+            win.remaining -= 1
+            n_docs += 1
+            flush_ready()
+        # cửa sổ cuối không có câu nào cho mô hình (toàn dòng trống / JSON lỗi)
+        for win in pending:
+            win.remaining = 0
+        flush_ready()
+
+    state["done"] = True
+    _write_checkpoint(ckpt_path, state)
+    dt = time.time() - t0
+    print(f"Đã lưu: {output_path} ({n_docs} câu, {dt:.1f}s, {n_docs / dt if dt else 0:.0f} câu/s)")
+    return {"lines": state["lines"], "docs": n_docs, "resumed": bool(ckpt)}
+
+
+def prelabel_folder(nlp, input_folder, output_folder, *, exts=(".txt", ".jsonl"), **kwargs) -> None:
+    """
+    Mọi file có đuôi trong `exts` trong thư mục; 'final_x.txt' -> 'x.jsonl' như prelabel4txt cũ.
+    Kiểm tra trước khi chạy: output không được trùng một file input hay output của file khác
+    (vd. final_x.txt và x.jsonl cùng ra x.jsonl).
+    """
+    input_folder, output_folder = Path(input_folder), Path(output_folder)
+    files = sorted(p for p in input_folder.iterdir() if p.suffix.lower() in exts)
+    if not files:
+        print(f"Không tìm thấy file {'/'.join(exts)} nào trong '{input_folder}'.")
+        return
+    jobs = [(path, output_folder / path.name.replace("final_", "").replace(".txt", ".jsonl")) for path in files]
+    inputs = {path.resolve(): path for path in files}
+    by_out: Dict[Path, List[Path]] = {}
+    for path, out_path in jobs:
+        by_out.setdefault(out_path.resolve(), []).append(path)
+    for out, srcs in by_out.items():
+        if out in inputs:
+            raise ValueError(f"Output {out} trùng file input {inputs[out]} (nguồn: {', '.join(map(str, srcs))})")
+        if len(srcs) > 1:
+            raise ValueError(f"Nhiều file cùng ghi ra {out}: {', '.join(map(str, srcs))}")
+    for path, out_path in jobs:
+        print(f"\nĐang đọc dữ liệu từ: {path}")
+        prelabel_file(nlp, path, out_path, **kwargs)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default="models/spancat_v5/model-best")
+    ap.add_argument("--input", default="book_data/final_txt/Done", help="File .txt/.jsonl hoặc thư mục")
+    ap.add_argument("--output", default="runs/preds_v5", help="File .jsonl (input là file) hoặc thư mục")
+    ap.add_argument("--format", choices=["txt", "jsonl"], default=None, help="Mặc định theo đuôi file")
+    ap.add_argument("--threshold", type=float, default=ACCEPTANCE_THRESHOLD)
+    ap.add_argument("--spans_key", default=SPANS_KEY)
+    ap.add_argument("--batch_size", type=int, default=256)
+    ap.add_argument("--n_process", type=int, default=1, help="Số process của nlp.pipe")
+    ap.add_argument("--window", type=int, default=4096, help="Số dòng mỗi lần sắp theo độ dài + ghi checkpoint")
+    ap.add_argument("--restart", action="store_true", help="Bỏ qua checkpoint, chạy lại từ đầu")
+    args = ap.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"Không tìm thấy input '{args.input}'.")
+        exit(1)
+    try:
+        nlp = load_model(args.model)
+    except Exception as e:
+        print(f"Lỗi khi load mô hình: {e}")
+        exit(1)
+
+    kwargs = dict(threshold=args.threshold, spans_key=args.spans_key, batch_size=args.batch_size,
+                  n_process=args.n_process, window=args.window, restart=args.restart)
+    if os.path.isdir(args.input):
+        prelabel_folder(nlp, args.input, args.output, **kwargs)
+    else:
+        prelabel_file(nlp, args.input, args.output, fmt=args.format, **kwargs)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
-import spacy
-import json
+try:
+    from .prelabel import load_model, prelabel_file
+except ImportError:  # chạy trực tiếp: python src/main/nlp/prelabel4jsonl.py
+    from prelabel import load_model, prelabel_file
+import os
 
 MODEL_PATH = "models/ner_v4/model-best"
 INPUT_JSONL_FILE = "book_data/labeled/json_files/v3/lamsonthucluc_trangphuc_danhlam_1334_vnsl.jsonl"
@@ -7,61 +10,22 @@ OUTPUT_JSONL_FILE = "book_data/labeled/json_files/v4/lamsonthucluc_trangphuc_dan
 
 ACCEPTANCE_THRESHOLD = 0.5
 SPANS_KEY = "sc"
+N_PROCESS = 1   # > 1: nlp.pipe chạy nhiều process
 
-print(f"Đang tải mô hình từ: {MODEL_PATH}")
-try:
-    nlp_spancat = spacy.load(MODEL_PATH)
-except IOError:
-    print(f"Không tìm thấy mô hình tại '{MODEL_PATH}'.")
-    exit()
-
-print(f"Đang đọc dữ liệu từ: {INPUT_JSONL_FILE}")
-try:
-    with open(INPUT_JSONL_FILE, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-except FileNotFoundError:
-    print(f"Không tìm thấy file đầu vào '{INPUT_JSONL_FILE}'.")
-    exit()
-
-output_data = []
-for i, line in enumerate(lines):
+if __name__ == "__main__":
     try:
-        obj = json.loads(line)
-    except json.JSONDecodeError:
-        print(f"Lỗi JSON ở dòng {i+1}, bỏ qua.")
-        continue
-
-    text = obj.get("text", "").strip()
-    if not text:
-        obj["label"] = obj.get("label", [])
-        output_data.append(obj)
-        continue
-
-    doc = nlp_spancat(text)
-    labels = obj.get("label", [])
-
-    existing = set(tuple(l) for l in labels)
-
-    spans = doc.spans.get(SPANS_KEY, [])
-    scores = getattr(spans, "attrs", {}).get("scores", [1.0]*len(spans))
-
-    print(f"\nDòng {i+1}: {text}")
-    if not spans:
-        print("Không tìm thấy span nào.")
-
-    for span, score in zip(spans, scores):
-        new_label = (span.start_char, span.end_char, span.label_)
-        print(f"Tìm thấy: '{span.text}' ({span.label_}) - Điểm: {score:.2f}")
-        if score >= ACCEPTANCE_THRESHOLD and new_label not in existing:
-            labels.append(list(new_label))
-            existing.add(new_label)
+        nlp_spancat = load_model(MODEL_PATH)
+    except Exception:
+        print(f"Không tìm thấy mô hình tại '{MODEL_PATH}'.")
+        exit()
 
-    obj["label"] = labels
-    output_data.append(obj)
+    if not os.path.exists(INPUT_JSONL_FILE):
+        print(f"Không tìm thấy file đầu vào '{INPUT_JSONL_FILE}'.")
+        exit()
 
-print(f"\nĐang lưu kết quả vào: {OUTPUT_JSONL_FILE}")
-with open(OUTPUT_JSONL_FILE, 'w', encoding='utf-8') as f:
-    for item in output_data:
-        f.write(json.dumps(item, ensure_ascii=False) + '\n')
+    # Giữ nguyên record, thêm nhãn dự đoán chưa có vào "label" (xem prelabel.py)
+    print(f"Đang đọc dữ liệu từ: {INPUT_JSONL_FILE}")
+    prelabel_file(nlp_spancat, INPUT_JSONL_FILE, OUTPUT_JSONL_FILE, fmt="jsonl",
+                  threshold=ACCEPTANCE_THRESHOLD, spans_key=SPANS_KEY, n_process=N_PROCESS)
 
-print("Done")
\ No newline at end of file
+    print("Done")
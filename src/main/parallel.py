@@ -0,0 +1,16 @@
+from collections import deque
+
+# Tiện ích dùng chung cho các script chạy song song (extract/*, nlp/*).
+
+def ordered_map(ex, fn, tasks, window: int):
+    """
+    ex.submit(fn, *task) cho từng task, trả kết quả đúng thứ tự task.
+    Khác ex.map: tối đa `window` future đang chờ -> không nạp cả kho vào hàng đợi (giới hạn RAM).
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(ex.submit(fn, *task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,248 @@
+import os, io, json, hashlib, argparse, threading, time
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+# Hậu xử lý ảnh: tạo các bản (rendition) nhỏ gọn từ ảnh gốc, cache theo sha256 nội dung ảnh gốc.
+#   thumb   : WebP cạnh dài 256px (gallery)
+#   web     : WebP cạnh dài 1280px
+#   archive : PNG nén tối ưu, giữ nguyên kích thước
+#   avif    : AVIF cạnh dài 1280px (chỉ khi Pillow hỗ trợ)
+#
+# Usage (offline, trên thư mục ảnh của batch_generate_images.py):
+# python -m src.main.postprocess.renditions --in_dir runs/images --out_dir runs/images/renditions --renditions thumb,web
+
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+
+
+@dataclass(frozen=True)
+class Rendition:
+    name: str
+    format: str                      # WEBP | PNG | AVIF | JPEG
+    max_side: Optional[int] = None   # None: giữ kích thước gốc
+    quality: int = 80
+
+    @property
+    def ext(self) -> str:
+        return {"WEBP": ".webp", "PNG": ".png", "AVIF": ".avif", "JPEG": ".jpg"}[self.format]
+
+    @property
+    def mime(self) -> str:
+        return {"WEBP": "image/webp", "PNG": "image/png", "AVIF": "image/avif", "JPEG": "image/jpeg"}[self.format]
+
+    @property
+    def key(self) -> str:
+        """Đổi tham số -> đổi khoá cache (không dùng nhầm bản cũ)."""
+        return f"{self.name}-{self.max_side or 'full'}-q{self.quality}"
+
+
+def avif_supported() -> bool:
+    try:
+        from PIL import features
+        return bool(features.check("avif"))
+    except Exception:
+        return False
+
+
+def default_renditions() -> Dict[str, Rendition]:
+    # avif luôn có trong bảng; chỉ kiểm tra Pillow khi avif thực sự được chọn (parse_renditions)
+    # -> dựng bảng không import PIL
+    return {
+        "thumb": Rendition("thumb", "WEBP", 256, 75),
+        "web": Rendition("web", "WEBP", 1280, 82),
+        "archive": Rendition("archive", "PNG"),
+        "avif": Rendition("avif", "AVIF", 1280, 60),
+    }
+
+
+def parse_renditions(spec: str, available: Optional[Dict[str, Rendition]] = None) -> List[Rendition]:
+    """'thumb,web=960' -> [thumb, web (cạnh dài 960)]"""
+    available = available or default_renditions()
+    out = []
+    for item in (s.strip() for s in spec.split(",")):
+        if not item:
+            continue
+        name, _, size = item.partition("=")
+        if name not in available:
+            raise ValueError(f"Rendition không hỗ trợ: {name} ({', '.join(available)})")
+        r = available[name]
+        if r.format == "AVIF" and not avif_supported():
+            raise ValueError(f"Rendition {name}: Pillow không hỗ trợ AVIF")
+        if size:
+            r = Rendition(r.name, r.format, int(size), r.quality)
+        out.append(r)
+    return out
+
+
+def make_rendition(data: bytes, r: Rendition) -> bytes:
+    """Chạy trong worker process: decode -> thu nhỏ (nếu cần) -> encode."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as im:
+        im.load()
+        if r.max_side and max(im.size) > r.max_side:
+            im.thumbnail((r.max_side, r.max_side), Image.LANCZOS)
+        if r.format == "JPEG" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        buf = io.BytesIO()
+        if r.format == "PNG":
+            im.save(buf, format="PNG", optimize=True)
+        elif r.format == "WEBP":
+            im.save(buf, format="WEBP", quality=r.quality, method=4)
+        else:
+            im.save(buf, format=r.format, quality=r.quality)
+        return buf.getvalue()
+
+
+class RenditionStore:
+    """
+    root/ab/<sha256>.<rendition key>.<ext> ; ghi atomically (tmp + replace).
+    max_bytes: vượt thì xoá các bản ít được đọc gần đây nhất (mtime được chạm mỗi lần get).
+    """
+
+    def __init__(self, root, max_bytes: Optional[int] = None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None  # tính lười ở lần put đầu tiên (chỉ cần khi có max_bytes)
+
+    def path(self, digest: str, r: Rendition) -> Path:
+        return self.root / digest[:2] / f"{digest}.{r.key}{r.ext}"
+
+    def get(self, digest: str, r: Rendition) -> Optional[bytes]:
+        p = self.path(digest, r)
+        try:
+            data = p.read_bytes()
+        except FileNotFoundError:
+            return None
+        if self.max_bytes:
+            try:
+                os.utime(p)
+            except OSError:
+                pass
+        return data
+
+    def put(self, digest: str, r: Rendition, data: bytes) -> Path:
+        p = self.path(digest, r)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(p.suffix + f".tmp{os.getpid()}")
+        tmp.write_bytes(data)
+        if self.max_bytes:
+            with self._lock:
+                old = p.stat().st_size if p.exists() else 0
+                os.replace(tmp, p)
+                if self._total is None:
+                    self._total = self._scan()
+                else:
+                    self._total += len(data) - old
+                if self._total > self.max_bytes:
+                    self._evict(keep=p)
+        else:
+            os.replace(tmp, p)
+        return p
+
+    def remove(self, digest: str) -> int:
+        """Xoá mọi bản của một ảnh gốc (khi ảnh gốc bị xoá khỏi cache); trả số byte giải phóng."""
+        freed = 0
+        with self._lock:
+            for p in (self.root / digest[:2]).glob(f"{digest}.*"):
+                if ".tmp" in p.suffix:
+                    continue  # bản đang ghi dở của put() khác: để put tự replace/dọn
+                try:
+                    size = p.stat().st_size
+                    p.unlink()
+                except FileNotFoundError:
+                    continue
+                freed += size
+            if self._total is not None:
+                self._total -= freed
+        return freed
+
+    def _files(self):
+        return [p for p in self.root.glob("*/*") if p.is_file() and ".tmp" not in p.suffix]
+
+    def _scan(self) -> int:
+        return sum(p.stat().st_size for p in self._files())
+
+    def _evict(self, keep: Path) -> None:
+        # Xoá tới 90% giới hạn để không phải quét lại sau mỗi lần put
+        target = int(self.max_bytes * 0.9)
+        files = []
+        for p in self._files():
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        self._total = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files, key=lambda t: t[0]):
+            if self._total <= target:
+                break
+            if p == keep:
+                continue
+            p.unlink(missing_ok=True)
+            self._total -= size
+
+
+def iter_images(in_dir: Path, skip: Optional[Path] = None) -> Iterable[Path]:
+    for p in sorted(in_dir.rglob("*")):
+        if skip is not None and skip in p.resolve().parents:
+            continue
+        if p.is_file() and p.suffix.lower() in IMAGE_EXTS:
+            yield p
+
+
+def _process_file(path: str, renditions: List[Rendition], out_root: str) -> dict:
+    """Worker: đọc ảnh, bỏ qua bản đã có trong cache, tạo + ghi các bản còn thiếu."""
+    data = Path(path).read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    store = RenditionStore(out_root)
+    todo = [r for r in renditions if not store.path(digest, r).exists()]
+    for r in todo:
+        store.put(digest, r, make_rendition(data, r))
+    return {
+        "source": path,
+        "sha256": digest,
+        "renditions": {r.name: str(store.path(digest, r)) for r in renditions},
+        "created": len(todo),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in_dir", default="runs/images")
+    ap.add_argument("--out_dir", default=None, help="Mặc định: <in_dir>/renditions")
+    ap.add_argument("--renditions", default="thumb,web",
+                    help="Danh sách, vd 'thumb,web=960,archive' (" + ", ".join(default_renditions()) + ")")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--manifest", default=None, help="Ghi JSONL {source, sha256, renditions} (mặc định <out_dir>/manifest.jsonl)")
+    args = ap.parse_args()
+
+    in_dir = Path(args.in_dir)
+    out_dir = Path(args.out_dir) if args.out_dir else in_dir / "renditions"
+    renditions = parse_renditions(args.renditions)
+    manifest = Path(args.manifest) if args.manifest else out_dir / "manifest.jsonl"
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    files = list(iter_images(in_dir, skip=out_dir.resolve() if out_dir.resolve() != in_dir.resolve() else None))
+    t0 = time.time()
+    created = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as ex, \
+         open(manifest, "w", encoding="utf-8") as w:
+        futs = [ex.submit(_process_file, str(p), renditions, str(out_dir)) for p in files]
+        for fut in as_completed(futs):
+            try:
+                rec = fut.result()
+            except Exception as e:
+                print(f"[ERR] {e}")
+                continue
+            created += rec.pop("created")
+            w.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    print(f"Done -> {out_dir} | images={len(files)}, renditions_created={created}, "
+          f"cached={len(files) * len(renditions) - created}, {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
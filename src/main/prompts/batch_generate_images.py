@@ -1,4 +1,5 @@
 import os, json, base64, argparse, hashlib, time, urllib.parse, mimetypes
+import email.parser, email.policy
 from pathlib import Path
 import requests
 from dotenv import load_dotenv
@@ -37,6 +38,58 @@ def _translate_vi2en(text: str, model) -> str:
     except Exception:
         return text
 
+def _parse_batch_translation(raw: str, n: int) -> dict:
+    """JSON [{"id": i, "en": "..."}] (hoặc list chuỗi theo thứ tự) -> {i: en}; item hỏng bị bỏ qua."""
+    raw = (raw or "").strip()
+    start, end = raw.find("["), raw.rfind("]")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        items = json.loads(raw[start:end + 1])
+    except Exception:
+        return {}
+    out = {}
+    for pos, it in enumerate(items if isinstance(items, list) else []):
+        if isinstance(it, dict):
+            idx, en = it.get("id"), it.get("en")
+        else:
+            idx, en = pos, it
+        if isinstance(idx, int) and 0 <= idx < n and isinstance(en, str) and en.strip():
+            out[idx] = en.strip()
+    return out
+
+def _translate_batch_vi2en(texts, model):
+    """
+    Dịch nhiều prompt trong một request (JSON có id), item nào thiếu/parse lỗi
+    thì dịch lại riêng bằng _translate_vi2en. Trả về (list bản dịch, số item phải dịch lại).
+    """
+    if not texts or not model:
+        return list(texts), 0
+    if len(texts) == 1:
+        return [_translate_vi2en(texts[0], model)], 0
+    payload = json.dumps([{"id": i, "vi": t} for i, t in enumerate(texts)], ensure_ascii=False)
+    prompt = (
+        "Translate each Vietnamese text below to precise English for an image generation prompt. "
+        "Keep proper nouns (people, dynasties, places) faithfully transliterated; do not summarize or add content. "
+        "Preserve list structure and punctuation.\n"
+        'Return ONLY a JSON array with one object per input, same ids: [{"id": 0, "en": "..."}, ...]\n\n'
+        f"Input:\n{payload}"
+    )
+    parsed = {}
+    try:
+        resp = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+        parsed = _parse_batch_translation(getattr(resp, "text", None) or "", len(texts))
+    except Exception as e:
+        print(f"[WARN] batch translation failed ({len(texts)} items): {e}")
+    out, retried = [], 0
+    for i, t in enumerate(texts):
+        if i in parsed:
+            out.append(parsed[i])
+        else:
+            out.append(_translate_vi2en(t, model))
+            retried += 1
+    return out, retried
+
 # ---------- Helpers ----------
 def _parse_data_uri(uri: str):
     assert uri.startswith("data:")
@@ -61,10 +114,37 @@ def _fix_b64(s: str) -> str:
     s += "=" * (-len(s) % 4)
     return s
 
-def save_image_from_response(resp_obj, out_dir: Path, idx: int, prompt_text: str):
+def _split_multipart(content_type: str, body: bytes):
+    """Tách multipart/mixed từ backend -> [(mime, bytes), ...]."""
+    head = f"Content-Type: {content_type}\r\n\r\n".encode("ascii")
+    msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(head + body)
+    return [(p.get_content_type(), p.get_payload(decode=True)) for p in msg.iter_parts()]
+
+def _save_raw_images(images, out_dir: Path, idx: int, h: str):
+    saved = []
+    for k, (mime, data) in enumerate(images):
+        ext = _pick_ext_from_mime(mime, ".png")
+        suffix = "" if k == 0 else f"_{k}"
+        out_path = out_dir / f"{idx:05d}_{h}{suffix}{ext}"
+        with open(out_path, "wb") as f:
+            f.write(data)
+        saved.append(str(out_path))
+    return saved[0] if saved else None
+
+def save_image_from_response(resp_obj, out_dir: Path, idx: int, prompt_text: str, api_base: str = ""):
+    h = hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()[:10]
+
+    # 0) Response nhị phân (response_format=binary|multipart): ghi thẳng bytes, không qua base64
+    if isinstance(resp_obj, requests.Response):
+        ctype = resp_obj.headers.get("Content-Type", "")
+        if ctype.startswith("image/"):
+            return _save_raw_images([(ctype.split(";", 1)[0], resp_obj.content)], out_dir, idx, h)
+        if ctype.startswith("multipart/"):
+            return _save_raw_images(_split_multipart(ctype, resp_obj.content), out_dir, idx, h)
+        resp_obj = resp_obj.json()
+
     image_url = resp_obj.get("image_url")
     image_b64 = resp_obj.get("image_base64")
-    h = hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()[:10]
 
     # 1) Base64 trả về từ backend (/generate hiện trả images[0] không kèm 'data:')
     if image_b64:
@@ -109,6 +189,16 @@ def save_image_from_response(resp_obj, out_dir: Path, idx: int, prompt_text: str
                 f.write(r.content)
             return str(out_path)
 
+    # 3) response_format=urls: tải từng ảnh từ /images/{sha256}
+    images = resp_obj.get("images")
+    if images and api_base:
+        fetched = []
+        for ref in images:
+            r = requests.get(urllib.parse.urljoin(api_base, ref["url"]), timeout=60)
+            r.raise_for_status()
+            fetched.append((ref.get("mime") or r.headers.get("Content-Type", "image/png"), r.content))
+        return _save_raw_images(fetched, out_dir, idx, h)
+
     return None
 
 def main():
@@ -118,8 +208,14 @@ def main():
     ap.add_argument("--out_dir", default="runs/images")
     ap.add_argument("--sleep", type=float, default=0.0)
     ap.add_argument("--translate", action="store_true", help="Translate VI->EN via Gemini before sending to backend")
+    ap.add_argument("--translate_batch_size", type=int, default=20,
+                    help="Số prompt dịch trong một request Gemini (1 = dịch từng dòng như cũ)")
     ap.add_argument("--provider", choices=["auto", "local", "cloud"], default="auto",
                     help="Hint provider for backend /generate (auto|local|cloud)")
+    ap.add_argument("--response_format", choices=["json", "binary", "multipart", "urls"], default="multipart",
+                    help="Backend response format; multipart saves all images without base64")
+    ap.add_argument("--image_cache", choices=["reuse", "refresh", "off"], default="reuse",
+                    help="Backend image cache: reuse cached images, force fresh ones, or bypass (needs IMAGE_CACHE_DIR on server)")
     args = ap.parse_args()
 
     api_gen = args.api_base.rstrip("/") + "/generate"
@@ -131,7 +227,57 @@ def main():
         if err:
             print(f"[WARN] Translation disabled: {err}")
 
-    ok, fail = 0, 0
+    def generate_one(i, final_prompt):
+        payload = {"prompt": final_prompt}
+        if args.provider:
+            payload["provider"] = args.provider
+        payload["image_cache"] = args.image_cache
+        payload["response_format"] = args.response_format
+
+        try:
+            r = requests.post(api_gen, json=payload, timeout=180)
+            if r.status_code == 503:
+                print(f"[WARN] line {i}: cloud provider not configured on server (HTTP 503).")
+                return False
+            r.raise_for_status()
+            saved = save_image_from_response(r, out_dir, i, final_prompt, args.api_base.rstrip("/") + "/")
+            if saved:
+                return True
+            print(f"[ERR] line {i}: response missing image_url/base64")
+            return False
+        except requests.HTTPError as e:
+            try:
+                msg = r.text[:300]
+            except Exception:
+                msg = str(e)
+            print(f"[ERR] line {i}: HTTP {getattr(r, 'status_code', '?')} - {msg}")
+            return False
+        except Exception as e:
+            print(f"[ERR] line {i}: {e}")
+            return False
+        finally:
+            if args.sleep > 0:
+                time.sleep(args.sleep)
+
+    ok, fail, retried = 0, 0, 0
+    batch_size = max(1, args.translate_batch_size) if model else 1
+
+    def flush(batch):
+        nonlocal ok, fail, retried
+        if not batch:
+            return
+        if model and batch_size > 1:
+            finals, n_retry = _translate_batch_vi2en([p for _, p in batch], model)
+            retried += n_retry
+        else:
+            finals = [_translate_vi2en(p, model) if model else p for _, p in batch]
+        for (i, _), final_prompt in zip(batch, finals):
+            if generate_one(i, final_prompt):
+                ok += 1
+            else:
+                fail += 1
+
+    batch = []
     with open(args.prompts, "r", encoding="utf-8") as f:
         for i, line in enumerate(f, 1):
             obj = json.loads(line)
@@ -139,41 +285,14 @@ def main():
             if not vi_prompt:
                 print(f"[ERR] line {i}: missing 'prompt' in input JSONL")
                 fail += 1; continue
+            batch.append((i, vi_prompt))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        flush(batch)
 
-            final_prompt = _translate_vi2en(vi_prompt, model) if model else vi_prompt
-
-            payload = {"prompt": final_prompt}
-            if args.provider:
-                payload["provider"] = args.provider
-
-            try:
-                r = requests.post(api_gen, json=payload, timeout=180)
-                if r.status_code == 503:
-                    print(f"[WARN] line {i}: cloud provider not configured on server (HTTP 503).")
-                    fail += 1
-                    continue
-                r.raise_for_status()
-                data = r.json()
-                saved = save_image_from_response(data, out_dir, i, final_prompt)
-                if saved:
-                    ok += 1
-                else:
-                    print(f"[ERR] line {i}: response missing image_url/base64")
-                    fail += 1
-            except requests.HTTPError as e:
-                try:
-                    msg = r.text[:300]
-                except Exception:
-                    msg = str(e)
-                print(f"[ERR] line {i}: HTTP {getattr(r, 'status_code', '?')} - {msg}")
-                fail += 1
-            except Exception as e:
-                print(f"[ERR] line {i}: {e}")
-                fail += 1
-
-            if args.sleep > 0:
-                time.sleep(args.sleep)
-
+    if model and batch_size > 1:
+        print(f"[INFO] batched translation: batch_size={batch_size}, per-item fallbacks={retried}")
     print(f"Done. Saved: {ok}, Failed: {fail}, Out: {out_dir}")
 
 if __name__ == "__main__":
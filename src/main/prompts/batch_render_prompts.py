@@ -1,9 +1,10 @@
 import json, argparse, re
 from pathlib import Path
 
-# Load templates & schema from repo
-TEMPLATES = json.loads(Path("src/main/prompts/prompt_templates.json").read_text(encoding="utf-8"))
-SCHEMAS   = json.loads(Path("src/main/prompts/prompt_schema.json").read_text(encoding="utf-8"))
+# Load templates & schema cạnh file này (không phụ thuộc thư mục đang chạy; backend /pipeline cũng import)
+_HERE = Path(__file__).resolve().parent
+TEMPLATES = json.loads((_HERE / "prompt_templates.json").read_text(encoding="utf-8"))
+SCHEMAS   = json.loads((_HERE / "prompt_schema.json").read_text(encoding="utf-8"))
 
 # Usage:
 # python src/main/prompts/batch_render_prompts.py --input runs/fields_all.jsonl --style portrait --out runs/prompts/portrait.jsonl
@@ -13,12 +14,15 @@ PLACEHOLDER_RE = re.compile(r"\[([a-zA-Z0-9_]+)\]")
 def extract_placeholders(t: str):
     return list({m.group(1) for m in PLACEHOLDER_RE.finditer(t)})
 
+def missing_fields(style, fields):
+    required = SCHEMAS.get(style, {}).get("required", [])
+    return [h for h in required if not fields.get(h)]
+
 def render(style, fields, extra=""):
     temp = TEMPLATES[style]
     holes = extract_placeholders(temp)
-    required = set(SCHEMAS.get(style, {}).get("required", []))
 
-    missing = [h for h in required if not fields.get(h)]
+    missing = missing_fields(style, fields)
     if missing:
         raise ValueError(f"Thiếu bắt buộc: {', '.join(missing)}")
 
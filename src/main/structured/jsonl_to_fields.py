@@ -1,7 +1,6 @@
 import json, argparse
 from collections import defaultdict
 import sys
-sys.stdout.reconfigure(encoding="utf-8")
 
 # python src/main/structured/jsonl_to_fields.py --input runs/preds_all.jsonl --limit 999999 > runs/fields_all.jsonl
 
@@ -26,6 +25,7 @@ def line_to_fields(text, labels):
     return out
 
 if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding="utf-8")
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", required=True, help="path to .jsonl")
     ap.add_argument("--limit", type=int, default=20)
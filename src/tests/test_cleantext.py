@@ -0,0 +1,42 @@
+import pytest
+
+from src.main.extract.cleantext import (
+    RE_CTRL, _clean_text_reference, clean_text, process_all_texts, split_chunks,
+)
+
+# Mẫu nhỏ phủ các luật của clean_text: số trang, dòng số La Mã, gạch nối cuối dòng,
+# nối tên riêng qua dòng, năm-năm, ký tự bullet, chữ cái tách rời, đoạn văn nhiều dòng trống
+FIXTURES = [
+    "--- Trang 1 ---\nNhà Trần khởi nghĩa năm 1288 , trên sông Bạch\nĐằng .\n\n\n\n12\nIV\n"
+    "Quân Nguyên - Mông thua to.Trận chiến kéo dài 1287 - 1288 .\n\n"
+    "Hưng Đạo Vương viết Hịch tướng sĩ.\n\nVII\n\nHết chương.\n",
+    "• Lý Thường Kiệt viết bài thơ Nam quốc sơn hà ;\n◆ quân Tống rút lui!\n\n"
+    "Triều đại nhà Lý kéo dài hơn hai thế kỷ, từ năm 1009 đến năm 1225 .\n--- trang 7 --3\n",
+    "Hồ Quý Ly lập ra nhà Hồ, đổi quốc hiệu là Đại Ngu. Ông thực hiện nhiều cải cách-\n"
+    "  táo bạo về tiền tệ\t\tvà ruộng đất.\n\n\n\nNăm 1407 , nhà Minh xâm lược .\n" * 3,
+    "Đinh\nBộ Lĩnh dẹp loạn 12 sứ quân .\x07\x0b\n\n\n7\n\nNgô Quyền (898 - 944) đánh tan quân Nam Hán ;"
+    " l ị c h s ử ghi lại : “ chiến thắng ” .\n\n  Sau đó Ngô Quyền xưng vương, đóng đô ở Cổ Loa?\n",
+]
+
+
+def _chunked(raw: str, chunk_chars: int) -> str:
+    """Giống process_all_texts: xoá ký tự điều khiển, cắt chunk, làm sạch từng chunk rồi ghép."""
+    return " ".join(clean_text(c) for c in split_chunks(RE_CTRL.sub("", raw), chunk_chars))
+
+
+@pytest.mark.parametrize("raw", FIXTURES)
+@pytest.mark.parametrize("chunk_chars", [1, 16, 40, 120, 1_000_000])
+def test_chunked_matches_reference(raw, chunk_chars):
+    assert _chunked(raw, chunk_chars) == _clean_text_reference(raw)
+
+
+def test_small_chunks_actually_cut():
+    # Các kích thước nhỏ ở trên phải thực sự tạo nhiều chunk, nếu không phép so sánh vô nghĩa
+    for raw in FIXTURES:
+        assert len(split_chunks(RE_CTRL.sub("", raw), 16)) > 1
+
+
+def test_process_all_texts_verify(tmp_path):
+    for i, raw in enumerate(FIXTURES):
+        (tmp_path / f"f{i}.txt").write_text(raw, encoding="utf-8")
+    assert process_all_texts(str(tmp_path), str(tmp_path / "out"), workers=1, chunk_chars=16, verify=True) == 0